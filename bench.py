@@ -0,0 +1,431 @@
+# /bin/bash
+""" Набор бенчмарков горячих путей бота
+
+    Работает без доступа к сети: SSH-сервер поднимается внутри процесса
+    на paramiko, PostgreSQL запускается во временном каталоге через
+    initdb/pg_ctl (раздел пропускается, если они не найдены в PATH или
+    PG_BIN), а обработчики вызываются с синтетическими объектами Update
+    и заглушкой вместо telegram.Bot.
+
+    Для каждого замера выводятся p50/p95/p99 задержки, пропускная
+    способность и пиковый объем выделенной памяти. Результаты
+    сравниваются с сохраненной базовой линией:
+
+        python bench.py --save-baseline     # сохранить bench_baseline.json
+        python bench.py                     # сравнить с ней
+        python bench.py --only extract,ssh  # запустить часть разделов
+"""
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import socket
+import string
+import argparse
+import tempfile
+import threading
+import subprocess
+import tracemalloc
+
+BASELINE_FILE = "bench_baseline.json"
+
+
+def percentile(values: list, fraction: float):
+    """ Возвращает перцентиль fraction (0..1) отсортированного списка """
+
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def measure(name: str, func, repeat: int = 50, warmup: int = 3, items: int = 1):
+    """ Замеряет задержку и память вызова func
+
+        Args:
+            name: имя замера в отчете.
+            func: функция без аргументов.
+            repeat: количество замеряемых вызовов.
+            warmup: количество вызовов для прогрева.
+            items: сколько единиц работы обрабатывает один вызов,
+                для расчета пропускной способности.
+
+        Returns:
+            Возвращает словарь с результатами замера.
+    """
+
+    for _ in range(warmup):
+        func()
+
+    latencies = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        func()
+        latencies.append(time.perf_counter() - started)
+    latencies.sort()
+
+    tracemalloc.start()
+    func()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    mean = sum(latencies) / len(latencies)
+    result = {
+        "name": name,
+        "p50": percentile(latencies, 0.50) * 1000,
+        "p95": percentile(latencies, 0.95) * 1000,
+        "p99": percentile(latencies, 0.99) * 1000,
+        "throughput": items / mean if mean else 0.0,
+        "peakKB": peak / 1024,
+    }
+    print(f"{name:<40} p50 {result['p50']:9.3f} мс  p95 {result['p95']:9.3f} мс  "
+          f"p99 {result['p99']:9.3f} мс  {result['throughput']:12.0f} ед/с  "
+          f"память {result['peakKB']:9.1f} КБ", flush=True)
+    return result
+
+
+def generateCorpus(size: int, seed: int = 1):
+    """ Генерирует текст длиной около size символов с email-ами и номерами """
+
+    rnd = random.Random(seed)
+    words = ["лог", "server", "error", "user", "запрос", "ok", "timeout", "db"]
+    parts = []
+    length = 0
+    while length < size:
+        roll = rnd.random()
+        if roll < 0.05:
+            word = f"user{rnd.randint(0, 9999)}.{rnd.choice(words)}@example{rnd.randint(0, 99)}.com"
+        elif roll < 0.10:
+            word = f"8 ({rnd.randint(900, 999)}) {rnd.randint(100, 999)}-{rnd.randint(10, 99)}-{rnd.randint(10, 99)}"
+        else:
+            word = rnd.choice(words)
+        parts.append(word)
+        length += len(word) + 1
+    return " ".join(parts)
+
+
+def generatePasswords(count: int, seed: int = 2):
+    rnd = random.Random(seed)
+    alphabet = string.ascii_letters + string.digits + "!@#$%^&*()"
+    return ["".join(rnd.choice(alphabet) for _ in range(rnd.randint(4, 16))) for _ in range(count)]
+
+
+def benchExtract(results: list):
+    import tools
+
+    for size in (10_000, 100_000, 1_000_000, 10_000_000):
+        text = generateCorpus(size)
+        repeat = 20 if size <= 1_000_000 else 3
+
+        def scan():
+            extractor = tools.TextExtractor().scan(text)
+            return extractor.numberedEmails(), extractor.numberedPhoneNumbers()
+
+        results.append(measure(f"extract.scan {size // 1000}K", scan, repeat=repeat, warmup=1, items=size))
+
+        def feed():
+            extractor = tools.TextExtractor()
+            for i in range(0, len(text), 1 << 16):
+                extractor.feed(text[i:i + (1 << 16)])
+            return extractor.finish()
+
+        results.append(measure(f"extract.feed {size // 1000}K", feed, repeat=repeat, warmup=1, items=size))
+
+
+def benchPasswords(results: list):
+    import tools
+
+    common = tools.CommonPasswords(generatePasswords(10_000))
+    for count in (1_000, 100_000):
+        passwords = generatePasswords(count)
+        results.append(measure(f"verifyPassword x{count}",
+                               lambda: [tools.verifyPassword(password) for password in passwords],
+                               repeat=10, warmup=1, items=count))
+        results.append(measure(f"PasswordAudit x{count}",
+                               lambda: tools.PasswordAudit(common).feed(passwords),
+                               repeat=10, warmup=1, items=count))
+
+
+class StubSSHServer:
+    """ SSH-сервер внутри процесса для замеров пути remoteCmdExecutionBySSH
+
+        Принимает любой пароль и выполняет команды локальной оболочкой.
+    """
+
+    def __init__(self):
+        import paramiko
+
+        self.paramiko = paramiko
+        self.hostKey = paramiko.RSAKey.generate(2048)
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind(("127.0.0.1", 0))
+        self.sock.listen(100)
+        self.port = self.sock.getsockname()[1]
+        self.transports = []
+        threading.Thread(target=self._accept, daemon=True).start()
+
+    def _accept(self):
+        paramiko = self.paramiko
+
+        class Interface(paramiko.ServerInterface):
+            def check_auth_password(self, username, password):
+                return paramiko.AUTH_SUCCESSFUL
+
+            def get_allowed_auths(self, username):
+                return "password"
+
+            def check_channel_request(self, kind, chanid):
+                return paramiko.OPEN_SUCCEEDED
+
+            def check_channel_exec_request(self, channel, command):
+                threading.Thread(target=runCommand, args=(channel, command), daemon=True).start()
+                return True
+
+        def runCommand(channel, command):
+            process = subprocess.run(["sh", "-c", command.decode()], capture_output=True)
+            channel.sendall(process.stdout)
+            channel.sendall_stderr(process.stderr)
+            channel.send_exit_status(process.returncode)
+            channel.close()
+
+        while True:
+            try:
+                client, _ = self.sock.accept()
+            except OSError:
+                return
+            transport = paramiko.Transport(client)
+            transport.add_server_key(self.hostKey)
+            transport.start_server(server=Interface())
+            self.transports.append(transport)
+
+    def close(self):
+        self.sock.close()
+        for transport in self.transports:
+            transport.close()
+
+
+def benchSSH(results: list):
+    import tools
+
+    server = StubSSHServer()
+    os.environ.update(RM_HOST="127.0.0.1", RM_PORT=str(server.port), RM_USER="bench", RM_PASSWORD="bench")
+    tools.getConfig.cache_clear()
+
+    def cold():
+        manager = tools.SSHConnectionManager()
+        try:
+            manager.execCommand("127.0.0.1", server.port, "bench", "bench", "uname -r")
+        finally:
+            manager.closeAll()
+
+    try:
+        results.append(measure("ssh.connect+exec (cold)", cold, repeat=10, warmup=1))
+        results.append(measure("ssh.exec (pooled)", lambda: tools.remoteCmdExecutionBySSH("uname -r")))
+        results.append(measure("ssh.3 x exec (pooled)",
+                               lambda: [tools.remoteCmdExecutionBySSH(c) for c in ("uname -p", "uname -n", "uname -v")]))
+        results.append(measure("ssh.batch of 3",
+                               lambda: tools.remoteBatchExecutionBySSH(["uname -p", "uname -n", "uname -v"])))
+        results.append(measure("ssh.cached", lambda: tools.cachedRemoteCmdExecutionBySSH("uname -r"),
+                               repeat=1000))
+    finally:
+        tools.sshManager.closeAll()
+        server.close()
+
+
+def startPostgres(directory: str):
+    """ Запускает временный экземпляр PostgreSQL в каталоге directory
+
+        Returns:
+            Возвращает путь к pg_ctl для последующей остановки или None,
+            если initdb/pg_ctl не найдены.
+    """
+
+    binDir = os.getenv("PG_BIN")
+    initdb = os.path.join(binDir, "initdb") if binDir else shutil.which("initdb")
+    pgCtl = os.path.join(binDir, "pg_ctl") if binDir else shutil.which("pg_ctl")
+    if not initdb or not pgCtl or not os.path.exists(initdb):
+        return None
+
+    with socket.socket() as probe:
+        probe.bind(("127.0.0.1", 0))
+        port = probe.getsockname()[1]
+
+    dataDir = os.path.join(directory, "data")
+    subprocess.run([initdb, "-D", dataDir, "-U", "bench", "-A", "trust"], check=True, capture_output=True)
+    subprocess.run([pgCtl, "-D", dataDir, "-w", "-l", os.path.join(directory, "pg.log"),
+                    "-o", f"-p {port} -k {directory} -c listen_addresses=''", "start"],
+                   check=True, capture_output=True)
+    os.environ.update(DB_HOST=directory, DB_PORT=str(port), DB_USER="bench", DB_PASSWORD="",
+                      DB_DATABASE="postgres")
+    return pgCtl
+
+
+def benchDB(results: list):
+    directory = tempfile.mkdtemp(prefix="bench-pg-")
+    pgCtl = startPostgres(directory)
+    if pgCtl is None:
+        print("db: initdb/pg_ctl не найдены, раздел пропущен")
+        shutil.rmtree(directory, ignore_errors=True)
+        return
+
+    import tools
+    tools.getConfig.cache_clear()
+
+    try:
+        tools.migrateDB()
+        with tools.dbPool.connection() as connection:
+            with connection.cursor() as cursor:
+                cursor.execute("INSERT INTO emails (email) SELECT 'user' || i || '@example.com' "
+                               "FROM generate_series(1, 100000) AS i;")
+            connection.commit()
+
+        values = [f"user{i}@example.com" for i in range(0, 1000, 2)] + \
+                 [f"missing{i}@example.com" for i in range(500)]
+
+        results.append(measure("db.rowExists x1", lambda: tools.rowExistsInBDTable("emails", "email", values[0]),
+                               repeat=200))
+        results.append(measure("db.rowExists x1000 (loop)",
+                               lambda: [tools.rowExistsInBDTable("emails", "email", v) for v in values],
+                               repeat=5, items=len(values)))
+        results.append(measure("db.rowsExist x1000 (set)",
+                               lambda: tools.rowsExistInBDTable("emails", "email", values),
+                               repeat=50, items=len(values)))
+        results.append(measure("db.insertMany x1000",
+                               lambda: tools.insertManyInBDTable("emails", "email", values),
+                               repeat=20, items=len(values)))
+        results.append(measure("db.page", lambda: tools.getDBTablePage("emails", afterId=50000), repeat=100))
+        results.append(measure("db.getAllRows 100K", lambda: tools.getAllRowFromDBTable("emails"),
+                               repeat=5, warmup=1, items=100000))
+        print("db.pool", tools.dbPool.stats())
+    finally:
+        tools.dbPool.closeAll()
+        subprocess.run([pgCtl, "-D", os.path.join(directory, "data"), "-m", "fast", "stop"], capture_output=True)
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+class FakeBot:
+    """ Заглушка telegram.Bot, запоминающая отправленные сообщения
+
+        Атрибуты и методы, которые читает PTB, заданы явно: неизвестное
+        обращение должно падать, а не возвращать заглушку.
+    """
+
+    defaults = None
+
+    def __init__(self):
+        self.sent = []
+
+    def send_message(self, chat_id, text, *args, **kwargs):
+        self.sent.append(text)
+
+    def edit_message_text(self, text, *args, **kwargs):
+        self.sent.append(text)
+
+
+def syntheticUpdate(bot, text: str):
+    from telegram import Update
+
+    data = {
+        "update_id": 1,
+        "message": {
+            "message_id": 1,
+            "date": int(time.time()),
+            "chat": {"id": 1, "type": "private"},
+            "from": {"id": 1, "is_bot": False, "first_name": "Bench"},
+            "text": text,
+        },
+    }
+    return Update.de_json(data, bot)
+
+
+def benchHandlers(results: list):
+    from types import SimpleNamespace
+    import bot as botModule
+    import tools
+
+    server = StubSSHServer()
+    os.environ.update(RM_HOST="127.0.0.1", RM_PORT=str(server.port), RM_USER="bench", RM_PASSWORD="bench")
+    tools.getConfig.cache_clear()
+    fakeBot = FakeBot()
+
+    def call(handler, text, args=()):
+        update = syntheticUpdate(fakeBot, text)
+        context = SimpleNamespace(args=list(args), user_data={}, bot=fakeBot, dispatcher=None)
+        return lambda: handler(update, context)
+
+    corpus = generateCorpus(20_000)
+    try:
+        results.append(measure("handler /get_release", call(botModule.getReleaseCommand, "/get_release")))
+        results.append(measure("handler /get_uname (cached)", call(botModule.getUnameCommand, "/get_uname")))
+        results.append(measure("handler /get_df refresh",
+                               call(botModule.getDfCommand, "/get_df refresh", ["refresh"])))
+        results.append(measure("handler /verify_password",
+                               call(botModule.verifyPasswordAnswer, "Passw0rd!")))
+        results.append(measure("findPhoneNumbers 20K (uncached)",
+                               lambda: tools.findPhoneNumbers(corpus + str(random.random()))))
+    finally:
+        tools.sshManager.closeAll()
+        server.close()
+
+
+SECTIONS = {
+    "extract": benchExtract,
+    "password": benchPasswords,
+    "ssh": benchSSH,
+    "db": benchDB,
+    "handlers": benchHandlers,
+}
+
+
+def compareWithBaseline(results: list, baseline: dict, threshold: float):
+    """ Выводит изменение p50 относительно базовой линии
+
+        Returns:
+            Возвращает количество замеров, замедлившихся больше чем на threshold.
+    """
+
+    regressions = 0
+    print("\nСравнение с базовой линией (p50):")
+    for result in results:
+        previous = baseline.get(result["name"])
+        if previous is None:
+            continue
+        change = (result["p50"] - previous["p50"]) / previous["p50"] if previous["p50"] else 0.0
+        mark = ""
+        if change > threshold:
+            mark = "  <-- замедление"
+            regressions += 1
+        print(f"{result['name']:<40} {previous['p50']:9.3f} -> {result['p50']:9.3f} мс ({change:+.1%}){mark}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Бенчмарки горячих путей бота")
+    parser.add_argument("--only", default=",".join(SECTIONS), help="разделы через запятую")
+    parser.add_argument("--baseline", default=BASELINE_FILE)
+    parser.add_argument("--save-baseline", action="store_true", help="сохранить результаты как базовую линию")
+    parser.add_argument("--threshold", type=float, default=0.2, help="допустимое замедление p50")
+    args = parser.parse_args()
+
+    # Логи бота, как и при его работе, пишутся в LOG_FILE, а не в вывод бенчмарка
+    import tools
+    tools.setupLogging()
+
+    results = []
+    for section in args.only.split(","):
+        SECTIONS[section](results)
+
+    if args.save_baseline:
+        with open(args.baseline, "w") as file:
+            json.dump({result["name"]: result for result in results}, file, ensure_ascii=False, indent=2)
+        print(f"\nБазовая линия сохранена в {args.baseline}")
+        return
+
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as file:
+            if compareWithBaseline(results, json.load(file), args.threshold):
+                sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,11 +1,184 @@
 # /bin/bash
+import time
+
+# Начало импорта модулей, для отчета о времени запуска
+_importStarted = time.perf_counter()
+
+import hmac
+import html
+import json
+import math
+import codecs
+import queue
+import shlex
+import signal
 import logging
+import tempfile
+import threading
+import multiprocessing
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 from uuid import uuid4
+from functools import wraps
+from collections import deque
 
-from telegram import Update
-from telegram.ext import Updater, ConversationHandler, CommandHandler, MessageHandler, Filters, CallbackContext
+from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
+from telegram.ext import (Updater, ConversationHandler, CommandHandler, MessageHandler, CallbackQueryHandler,
+                          TypeHandler, Filters, CallbackContext)
+from telegram.ext.utils.promise import Promise
+from telegram.error import TelegramError
 
 from tools import *
+from config import getConfig
+from persistence import SQLitePersistence
+from metrics import COMMAND_SECONDS, COMMAND_ERRORS, STARTUP, startMetricsServer
+
+
+class UserOrderedRunner:
+    """ Выполняет обработчики в пуле потоков диспетчера с сохранением порядка
+
+        Задачи одного пользователя ставятся в его очередь и выполняются
+        строго по одной в порядке поступления, а задачи разных
+        пользователей выполняются параллельно. Ожидающие задачи не
+        занимают потоки пула: для каждой непустой очереди в пуле
+        работает один поток, разбирающий ее.
+    """
+
+    def __init__(self):
+        self._queues = {}
+        self._lock = threading.Lock()
+
+    def submit(self, dispatcher, key, promise: Promise):
+        with self._lock:
+            queue = self._queues.get(key)
+            if queue is not None:
+                queue.append(promise)
+                return
+            self._queues[key] = deque([promise])
+
+        dispatcher.run_async(self._drain, dispatcher, key)
+
+    def _drain(self, dispatcher, key):
+        while True:
+            with self._lock:
+                queue = self._queues[key]
+                if not queue:
+                    del self._queues[key]
+                    return
+                promise = queue.popleft()
+
+            promise.run()
+            if promise.exception is not None:
+                dispatcher.dispatch_error(promise.update, promise.exception, promise=promise)
+            else:
+                dispatcher.update_persistence(update=promise.update)
+
+
+userRunner = UserOrderedRunner()
+
+
+def instrumented(callback, backend: str = None):
+    """ Записывает длительность и ошибки обработчика в метрики и лог
+
+        Метка command равна имени функции обработчика. На время
+        выполнения команда и id пользователя попадают в logContext и
+        добавляются ко всем записям лога, сделанным внутри обработчика.
+        По завершении пишется запись с длительностью и бэкендом.
+        Если обращение к бэкенду отклонено ограничителем частоты
+        (RateLimitExceeded), пользователю отправляется сообщение о том,
+        через сколько секунд повторить запрос, а если запрос не пройдет
+        никогда (RequestTooLarge) - о допустимом размере; состояние
+        диалога при этом не меняется.
+
+        Args:
+            callback: исходный обработчик.
+            backend: имя бэкенда, с которым работает обработчик.
+
+        Returns:
+            Возвращает обработчик, который можно зарегистрировать вместо исходного.
+    """
+
+    command = callback.__name__
+
+    @wraps(callback)
+    def wrapper(update: Update, context: CallbackContext):
+        user = update.effective_user
+        token = logContext.set({"command": command, "userId": user.id if user else None, "backend": backend})
+        started = time.perf_counter()
+        try:
+            with COMMAND_SECONDS.time(command=command):
+                return callback(update, context)
+        except RateLimitExceeded as error:
+            logging.info("Запрос отклонен: %s", error)
+            if update.effective_message:
+                update.effective_message.reply_text(text=f"Слишком много запросов, повторите через "
+                                                         f"{math.ceil(error.retryAfter)} с")
+            return None
+        except RequestTooLarge as error:
+            logging.info("Запрос отклонен: %s", error)
+            if update.effective_message:
+                update.effective_message.reply_text(text=f"{error}, разбейте его на части")
+            return None
+        except Exception:
+            COMMAND_ERRORS.inc(command=command)
+            logging.exception("Ошибка при выполнении команды")
+            raise
+        finally:
+            logging.info("Команда выполнена", extra={"duration": round(time.perf_counter() - started, 6)})
+            logContext.reset(token)
+
+    return wrapper
+
+
+def offload(backend: str, callback):
+    """ Переносит выполнение обработчика из потока диспетчера в пул потоков
+
+        Обработчик выполняется через userRunner с сохранением порядка
+        сообщений пользователя и занимает место в лимите бэкенда.
+        Длительность выполнения записывается в метрики и лог, как в instrumented.
+        Возвращаемый Promise поддерживается ConversationHandler, поэтому
+        обработчики диалогов можно переносить так же.
+
+        Args:
+            backend: имя бэкенда из BACKEND_CONCURRENCY ('ssh', 'db') или None,
+                если обработчик сам занимает лимиты нужных бэкендов.
+            callback: исходный обработчик.
+
+        Returns:
+            Возвращает обработчик, который можно зарегистрировать вместо исходного.
+    """
+
+    callback = instrumented(callback, backend)
+
+    @wraps(callback)
+    def wrapper(update: Update, context: CallbackContext):
+        def run():
+            if backend is None:
+                return callback(update, context)
+            with backendSlot(backend):
+                return callback(update, context)
+
+        user = update.effective_user
+        promise = Promise(run, (), {}, update=update)
+        userRunner.submit(context.dispatcher, user.id if user else None, promise)
+        return promise
+
+    return wrapper
+
+
+def forceRefresh(context: CallbackContext):
+    """ Проверяет, запрошено ли обновление закэшированного результата
+
+        Обновление запрашивается первым аргументом 'refresh',
+        например '/get_free refresh'.
+
+        Args:
+            context: объект telegram.ext.CallbackContext.
+
+        Returns:
+            Возвращает True, если кэш команды нужно обновить.
+    """
+
+    return bool(context.args) and context.args[0] == "refresh"
 
 
 def startCommand(update: Update, context: CallbackContext):
@@ -52,7 +225,14 @@ def helpCommand(update: Update, context: CallbackContext):
                                    "\n<b>База данных</b>\n"
                                    "/get_repl_logs - логи о репликации БД\n"
                                    "/get_emails - вывод email-ов из БД\n"
-                                   "/get_phone_numbers - вывод телефонных номеров\n",
+                                   "/get_phone_numbers - вывод телефонных номеров\n"
+                                   "\nДобавьте аргумент refresh к команде /get_*, "
+                                   "чтобы получить свежие данные в обход кэша. "
+                                   "Команды раздела «Информация о сервере» и /get_repl_logs "
+                                   "с аргументом @хост / @группа выполняются на других серверах, "
+                                   "например /get_df @db-cluster. "
+                                   "/get_df, /get_free и /get_mpstat с аргументом history "
+                                   "показывают историю за последний час\n",
                               parse_mode="HTML")
 
 
@@ -62,6 +242,115 @@ def echo(update: Update, context: CallbackContext):
     update.message.reply_text(update.message.text)
 
 
+# Максимальный размер файла, который бот может скачать через Bot API
+MAX_DOCUMENT_SIZE = 20 * 1024 * 1024
+# Минимальный интервал между обновлениями сообщения о прогрессе, секунды
+PROGRESS_INTERVAL = 2
+
+
+def replyLongText(update: Update, text: str):
+    """ Отправляет текст несколькими сообщениями, если он не помещается в одно
+
+        Args:
+            update: объект telegram.update.Update.
+            text: текст сообщения.
+    """
+
+    for part in splitMessage(text):
+        update.message.reply_text(text=part)
+
+
+def replyOutput(update: Update, data: bytes, table: bool = False, title: str = None):
+    """ Отправляет пользователю вывод удаленной команды
+
+        Вывод подготавливается renderOutput: декодируется, при
+        table=True выравнивается моноширинным блоком и делится на
+        сообщения в пределах лимита Telegram.
+
+        Args:
+            update: объект telegram.update.Update.
+            data: вывод команды.
+            table: вывод является таблицей (df, free, ps, ss).
+            title: заголовок первого сообщения.
+    """
+
+    for text, parseMode in renderOutput(data, table, title):
+        update.message.reply_text(text=text, parse_mode=parseMode)
+
+
+def processDocument(update: Update, context: CallbackContext, process, extensions=SCANNABLE_EXTENSIONS):
+    """ Скачивает присланный файл и обрабатывает его, показывая прогресс
+
+        Файл скачивается во временный файл и обрабатывается функцией
+        process в пределах лимита бэкенда 'scan', а сообщение о
+        прогрессе обновляется не чаще PROGRESS_INTERVAL секунд.
+
+        Args:
+            update: объект telegram.update.Update.
+            context: объект telegram.ext.CallbackContext.
+            process: функция process(путь, progress), возвращающая результат.
+            extensions: допустимые расширения файла.
+
+        Returns:
+            Возвращает кортеж (результат process, сообщение о прогрессе)
+            или None, если файл не подходит для обработки.
+    """
+
+    document = update.message.document
+    if not (document.file_name or "").lower().endswith(extensions):
+        update.message.reply_text(text="Поддерживаются файлы: " + ", ".join(extensions))
+        return None
+    if document.file_size and document.file_size > MAX_DOCUMENT_SIZE:
+        update.message.reply_text(text="Файл слишком большой, максимум 20 МБ")
+        return None
+
+    progressMessage = update.message.reply_text(text="Загрузка файла...")
+    lastEdit = time.monotonic()
+
+    def progress(done: int, total: int):
+        nonlocal lastEdit
+        if time.monotonic() - lastEdit < PROGRESS_INTERVAL:
+            return
+        lastEdit = time.monotonic()
+        try:
+            progressMessage.edit_text(text=f"Обработка файла: {done * 100 // max(total, 1)}%")
+        except TelegramError:
+            pass
+
+    with tempfile.NamedTemporaryFile(suffix=os.path.splitext(document.file_name)[1]) as tmp:
+        context.bot.get_file(document.file_id).download(custom_path=tmp.name)
+        with backendSlot("scan"):
+            result = process(tmp.name, progress)
+
+    return result, progressMessage
+
+
+def scanDocument(update: Update, context: CallbackContext):
+    """ Сканирует присланный файл на email-ы и телефонные номера
+
+        В конце в сообщении о прогрессе выводится количество найденных
+        значений.
+
+        Args:
+            update: объект telegram.update.Update.
+            context: объект telegram.ext.CallbackContext.
+
+        Returns:
+            Возвращает TextExtractor с найденными значениями или None,
+            если файл не подходит для сканирования.
+    """
+
+    processed = processDocument(update, context, scanFileForContacts)
+    if processed is None:
+        return None
+
+    extractor, progressMessage = processed
+    progressMessage.edit_text(text=f"Сканирование завершено.\n"
+                                   f"Найдено email-ов: {len(extractor.emails)}\n"
+                                   f"Найдено телефонных номеров: {len(extractor.phoneNumbers)}")
+    return extractor
+
+
 def findEmailsCommand(update: Update, context: CallbackContext):
     """ Запрашивает текст для поиска в ответ на команду '/find_email'.
 
@@ -77,7 +366,7 @@ def findEmailsCommand(update: Update, context: CallbackContext):
             Возврщает обработчику строку-состояние 'findEmailsAnswer'
     """
 
-    update.message.reply_text(text="Введите текст для поиска email-ов")
+    update.message.reply_text(text="Введите текст для поиска email-ов или пришлите файл (txt, csv, log, gz)")
     return "findEmailsAnswer"
 
 
@@ -86,9 +375,10 @@ def findEmailsAnswer(update: Update, context: CallbackContext):
 
         Является вторым этапом диалога в процессе которого пользователю
         отправляется сообщение со списком всех найденных email-ов
-        или сообщение об их отсутствии.
-        Проверяет найденные email на предмет их наличия в БД и
-        предлагает записать отсутствующие в записях.
+        или сообщение об их отсутствии. Текст для поиска можно прислать
+        сообщением или файлом.
+        Проверяет найденные email на предмет их наличия в БД одним
+        запросом и предлагает записать отсутствующие в записях.
 
         Args:
             update: объект telegram.update.Update.
@@ -99,14 +389,23 @@ def findEmailsAnswer(update: Update, context: CallbackContext):
     """
 
     message = ""
-    emails = findEmails(update.message.text)
+    if update.message.document:
+        extractor = scanDocument(update, context)
+        if extractor is None:
+            return "findEmailsAnswer"
+        emails = extractor.numberedEmails()
+    else:
+        emails = findEmails(update.message.text)
     context.user_data['emails'] = emails
     notInBD = False
 
     if emails:
+        # Лимит БД занимается только на время запроса, а не загрузки и сканирования файла
+        with backendSlot("db"):
+            existing = rowsExistInBDTable("emails", "email", [email for _, email in emails])
 
         for emailNumber, email in emails:
-            if rowExistsInBDTable("emails", "email", email):
+            if email in existing:
                 message += f"✓ {emailNumber}: {email}\n"
             else:
                 message += f"✕ {emailNumber}: {email}\n"
@@ -117,11 +416,11 @@ def findEmailsAnswer(update: Update, context: CallbackContext):
 
     if notInBD:
         message += "\nДобавить новые email-ы в БД?\n[Да/Нет]"
-        update.message.reply_text(text=message)
+        replyLongText(update, message)
         return "findEmailsBDAnswer"
     else:
         message += "\nВсе Email-ы есть в БД"
-        update.message.reply_text(text=message)
+        replyLongText(update, message)
         return ConversationHandler.END
 
 
@@ -131,7 +430,8 @@ def findEmailsBDAnswer(update: Update, context: CallbackContext):
         Является третьим этапом диалога в процессе которого пользователю
         отправляется сообщение со списком всех найденных email-ов
         или сообщение об их отсутствии.
-        Записывает отсутствующие в БД email-ы при согласии пользователя.
+        Записывает отсутствующие в БД email-ы одной транзакцией
+        при согласии пользователя.
 
         Args:
             update: объект telegram.update.Update.
@@ -147,12 +447,12 @@ def findEmailsBDAnswer(update: Update, context: CallbackContext):
         emails = context.user_data['emails']
 
         if emails:
-            for emailNumber, email in emails:
-                if not rowExistsInBDTable("emails", "email", email):
-                    if insertInBDTable('emails', 'email', email):
-                        message = "Email-ы успешно добавлены"
-                    else:
-                        message = "Произошла ошибка при работе с PostgreSQL"
+            result = insertManyInBDTable("emails", "email", [email for _, email in emails])
+            if result is not None:
+                inserted, skipped = result
+                message = f"Email-ы успешно добавлены: {inserted}, уже были в БД: {skipped}"
+            else:
+                message = "Произошла ошибка при работе с PostgreSQL"
     else:
         message = "Спасибо, что пользуетесь нашим сервисом!"
 
@@ -175,7 +475,8 @@ def findPhoneNumbersCommand(update: Update, context: CallbackContext):
             Возврщает обработчику строку-состояние 'findPhoneNumbersAnswer'
     """
 
-    update.message.reply_text(text="Введите текст для поиска номеров телефонов")
+    update.message.reply_text(text="Введите текст для поиска номеров телефонов "
+                                   "или пришлите файл (txt, csv, log, gz)")
     return "findPhoneNumbersAnswer"
 
 
@@ -184,9 +485,10 @@ def findPhoneNumbersAnswer(update: Update, context: CallbackContext):
 
         Является вторым этапом диалога в процессе которого пользователю
         отправляется сообщение со списком всех найденных телефонных
-        номеров или сообщение об их отсутствии.
+        номеров или сообщение об их отсутствии. Текст для поиска можно
+        прислать сообщением или файлом.
         Проверяет найденные телефонные номера на предмет их наличия в
-        БД и предлагает записать отсутствующие в записях.
+        БД одним запросом и предлагает записать отсутствующие в записях.
 
         Args:
             update: объект telegram.update.Update.
@@ -198,13 +500,22 @@ def findPhoneNumbersAnswer(update: Update, context: CallbackContext):
     """
 
     message = ""
-    phoneNumbers = findPhoneNumbers(update.message.text)
+    if update.message.document:
+        extractor = scanDocument(update, context)
+        if extractor is None:
+            return "findPhoneNumbersAnswer"
+        phoneNumbers = extractor.numberedPhoneNumbers()
+    else:
+        phoneNumbers = findPhoneNumbers(update.message.text)
     context.user_data['phoneNumbers'] = phoneNumbers
     notInBD = False
 
     if phoneNumbers:
+        with backendSlot("db"):
+            existing = rowsExistInBDTable("numbers", "number", [phoneNumber for _, phoneNumber in phoneNumbers])
+
         for phoneNumberNumber, phoneNumber in phoneNumbers:
-            if rowExistsInBDTable("numbers", "number", phoneNumber):
+            if phoneNumber in existing:
                 message += f"✓ {phoneNumberNumber}: {phoneNumber}\n"
             else:
                 message += f"✕ {phoneNumberNumber}: {phoneNumber}\n"
@@ -215,11 +526,11 @@ def findPhoneNumbersAnswer(update: Update, context: CallbackContext):
 
     if notInBD:
         message += "\nДобавить новые телефонные номера в БД?\n[Да/Нет]"
-        update.message.reply_text(text=message)
+        replyLongText(update, message)
         return "findPhoneNumbersBDAnswer"
     else:
         message += "\nВсе телефонные номера есть в БД"
-        update.message.reply_text(text=message)
+        replyLongText(update, message)
         return ConversationHandler.END
 
 
@@ -229,8 +540,8 @@ def findPhoneNumbersBDAnswer(update: Update, context: CallbackContext):
         Является третьим этапом диалога в процессе которого пользователю
         отправляется сообщение со списком всех найденных телефонных номеров
         или сообщение об их отсутствии.
-        Записывает отсутствующие в БД телефонные номера при согласии
-        пользователя.
+        Записывает отсутствующие в БД телефонные номера одной
+        транзакцией при согласии пользователя.
 
         Args:
             update: объект telegram.update.Update.
@@ -246,12 +557,12 @@ def findPhoneNumbersBDAnswer(update: Update, context: CallbackContext):
         phoneNumbers = context.user_data['phoneNumbers']
 
         if phoneNumbers:
-            for phoneNumberNumber, phoneNumber in phoneNumbers:
-                if not rowExistsInBDTable("numbers", "number", phoneNumber):
-                    if insertInBDTable("numbers", "number", phoneNumber):
-                        message = "Телефонные номера успешно добавлены"
-                    else:
-                        message = "Произошла ошибка при работе с PostgreSQL"
+            result = insertManyInBDTable("numbers", "number", [phoneNumber for _, phoneNumber in phoneNumbers])
+            if result is not None:
+                inserted, skipped = result
+                message = f"Телефонные номера успешно добавлены: {inserted}, уже были в БД: {skipped}"
+            else:
+                message = "Произошла ошибка при работе с PostgreSQL"
     else:
         message = "Спасибо, что пользуетесь нашим сервисом!"
 
@@ -273,15 +584,53 @@ def verifyPasswordCommand(update: Update, context: CallbackContext):
             Возврщает обработчику строку-состояние 'verifyPasswordAnswer'
     """
 
-    update.message.reply_text(text="Введите пароль")
+    update.message.reply_text(text="Введите пароль, несколько паролей по одному в строке или пришлите файл с паролями")
     return "verifyPasswordAnswer"
 
 
+# Подписи корзин гистограммы энтропии ENTROPY_BUCKETS
+ENTROPY_LABELS = ("< 28 бит", "28–35 бит", "36–59 бит", "60–127 бит", "≥ 128 бит")
+# Названия классов символов для сводки
+CLASS_LABELS = {"lower": "строчных букв", "upper": "заглавных букв", "digit": "цифр", "special": "спецсимволов"}
+
+
+def passwordAuditReport(audit: PasswordAudit):
+    """ Формирует текстовую сводку проверки набора паролей с гистограммой энтропии
+
+        Args:
+            audit: объект PasswordAudit.
+
+        Returns:
+            Возвращает текст сводки.
+    """
+
+    if not audit.total:
+        return "Пароли не найдены!"
+
+    percent = lambda count: f"{count} ({count * 100 / audit.total:.1f}%)"
+    widest = max(audit.entropyHistogram)
+    lines = [f"Проверено паролей: {audit.total}",
+             f"Сложных: {percent(audit.strong)}",
+             f"Простых: {percent(audit.total - audit.strong)}",
+             f"Из списка распространенных: {percent(audit.commonCount)}",
+             f"Короче 8 символов: {percent(audit.short)}",
+             f"Средняя энтропия: {audit.entropySum / audit.total:.1f} бит",
+             "",
+             "Энтропия:"]
+    for label, count in zip(ENTROPY_LABELS, audit.entropyHistogram):
+        bar = "█" * round(count * 20 / widest) if widest else ""
+        lines.append(f"{label:>10} {bar} {count}")
+    lines += ["", "Без:"] + [f"{CLASS_LABELS[name]}: {percent(count)}" for name, count in audit.missing.items()]
+    return "<pre>" + html.escape("\n".join(lines)) + "</pre>"
+
+
 def verifyPasswordAnswer(update: Update, context: CallbackContext):
     """ Отправляет пользователю сообщение о надежности пароля.
 
         Является вторым этапом диалога в процессе которого пользователю
-        отправляется уведомление о надежности пароля.
+        отправляется уведомление о надежности пароля. Если прислано
+        несколько паролей (по одному в строке) или файл с паролями,
+        отправляется одна сводка PasswordAudit вместо ответа на каждый.
 
         Args:
             update: объект telegram.update.Update.
@@ -292,10 +641,294 @@ def verifyPasswordAnswer(update: Update, context: CallbackContext):
             сообщающую об окончании диалога
     """
 
-    update.message.reply_text(text=verifyPassword(update.message.text))
+    if update.message.document:
+        processed = processDocument(update, context, lambda path, progress:
+                                    auditPasswordFile(path, progress, getCommonPasswords()))
+        if processed is None:
+            return "verifyPasswordAnswer"
+        audit, progressMessage = processed
+        progressMessage.edit_text(text="Проверка завершена.")
+    else:
+        lines = [line for line in update.message.text.splitlines() if line]
+        if len(lines) <= 1:
+            update.message.reply_text(text=verifyPassword(update.message.text))
+            return ConversationHandler.END
+        with backendSlot("scan"):
+            audit = PasswordAudit(getCommonPasswords()).feed(lines)
+
+    update.message.reply_text(text=passwordAuditReport(audit), parse_mode="HTML")
     return ConversationHandler.END
 
 
+# Минимальный интервал между правками сообщения с потоковым выводом, секунды
+STREAM_EDIT_INTERVAL = 1.5
+
+
+def streamCommandReply(update: Update, command: str):
+    """ Выполняет команду и показывает ее вывод по мере поступления
+
+        Отправляет сообщение и правит его не чаще STREAM_EDIT_INTERVAL
+        секунд, показывая последние MESSAGE_LIMIT символов вывода.
+        По завершении сообщение дополняется пометкой, если вывод был
+        обрезан или команда не уложилась во время.
+
+        Args:
+            update: объект telegram.update.Update.
+            command: команда для удаленного выполнения на сервере.
+    """
+
+    message = update.message.reply_text(text="Выполнение команды...")
+    decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+    tail = ""
+    shown = ""
+    lastEdit = time.monotonic()
+
+    def show(suffix: str = ""):
+        nonlocal shown, lastEdit
+        text = (tail + suffix)[-MESSAGE_LIMIT:]
+        if text.strip() and text != shown:
+            try:
+                message.edit_text(text=text)
+                shown = text
+            except TelegramError as error:
+                logging.warning("Не удалось обновить сообщение: %s", error)
+        lastEdit = time.monotonic()
+
+    def onChunk(data: bytes):
+        nonlocal tail
+        tail = (tail + decoder.decode(data))[-MESSAGE_LIMIT:]
+        if time.monotonic() - lastEdit >= STREAM_EDIT_INTERVAL:
+            show()
+
+    result = remoteStreamExecutionBySSH(command, onChunk)
+    tail = (tail + decoder.decode(b"", final=True))[-MESSAGE_LIMIT:]
+
+    suffix = ""
+    if result.truncated:
+        suffix = "\n[вывод обрезан]"
+    elif result.timedOut:
+        suffix = "\n[превышено время выполнения]"
+    elif not tail.strip():
+        suffix = "Вывод пуст"
+    show(suffix)
+
+
+# Максимальное количество хостов, вывод которых отправляется отдельными
+# сообщениями; для большего числа хостов отправляется только сводка
+FANOUT_DETAIL_LIMIT = 10
+
+
+def replyParsedOutput(update: Update, data: bytes, table: bool = False, transform=None, alerts=None, title=None):
+    """ Отправляет вывод команды, предварительно обработав его
+
+        Args:
+            update: объект telegram.update.Update.
+            data: вывод команды.
+            table: вывод является таблицей.
+            transform: функция, преобразующая текст вывода перед отправкой.
+            alerts: функция, возвращающая список предупреждений по тексту вывода.
+            title: заголовок сообщения.
+    """
+
+    text = decodeOutput(data)
+    replyOutput(update, transform(text) if transform else text, table, title)
+    if alerts:
+        warnings = alerts(text)
+        if warnings:
+            update.message.reply_text(text="\n".join(warnings))
+
+
+# Количество процессов в ответе на /get_ps
+PS_LIMIT = 10
+
+
+def topProcesses(text: str):
+    """ Оставляет в выводе ps PS_LIMIT процессов с наибольшей загрузкой процессора """
+
+    processes = sorted(parsePs(text), key=lambda process: (process.cpu, process.memory), reverse=True)
+    lines = ["PID USER %CPU %MEM COMMAND"]
+    lines += [f"{process.pid} {process.user} {process.cpu} {process.memory} {process.command}"
+              for process in processes[:PS_LIMIT]]
+    return "\n".join(lines)
+
+
+def listeningSockets(text: str):
+    """ Оставляет в выводе ss сокеты в режиме прослушивания, отсортированные по протоколу и порту """
+
+    def port(socket):
+        value = socket.local.rpartition(":")[2]
+        return int(value) if value.isdigit() else 0
+
+    sockets = [socket for socket in parseSs(text) if socket.state in ("LISTEN", "UNCONN")]
+    lines = ["Netid State Local"]
+    lines += [f"{socket.netid or '-'} {socket.state} {socket.local}"
+              for socket in sorted(sockets, key=lambda socket: (socket.netid or "", port(socket)))]
+    return "\n".join(lines)
+
+
+def splitTargets(args: list):
+    """ Делит аргументы команды на цели вида '@хост' или '@группа' и остальные
+
+        Returns:
+            Возвращает кортеж (цели, остальные аргументы).
+    """
+
+    args = args or []
+    return [arg for arg in args if arg.startswith("@")], [arg for arg in args if not arg.startswith("@")]
+
+
+def fanOutReply(update: Update, command: str, targets: list, table: bool = False, transform=None, alerts=None,
+                cost: int = 1):
+    """ Выполняет команду на хостах и группах инвентаря и отправляет результаты
+
+        Вывод каждого хоста отправляется по мере его ответа (если хостов
+        не больше FANOUT_DETAIL_LIMIT), иначе обновляется сообщение о
+        прогрессе. В конце отправляется сводка: успешные хосты, ошибки,
+        таймауты и самые медленные хосты.
+
+        Args:
+            update: объект telegram.update.Update.
+            command: команда для удаленного выполнения.
+            targets: имена хостов и групп, например ['@db-cluster'].
+            table: вывод является таблицей.
+            transform: функция, преобразующая текст вывода перед отправкой.
+            alerts: функция, возвращающая список предупреждений по тексту вывода.
+            cost: стоимость выполнения на одном хосте для ограничителя частоты.
+
+        Raises:
+            RateLimitExceeded: запрос отклонен.
+            RequestTooLarge: хостов или команд больше, чем пропустит ограничитель.
+    """
+
+    try:
+        names = getInventory().resolve(targets)
+    except KeyError as error:
+        update.message.reply_text(text=f"Неизвестный хост или группа: {error.args[0]}")
+        return
+
+    hostResults = fanOutCommand(names, command, cost=cost)
+    detailed = len(names) <= FANOUT_DETAIL_LIMIT
+    progressMessage = update.message.reply_text(text=f"Выполнение на хостах: 0/{len(names)}")
+    lastEdit = time.monotonic()
+    results = []
+
+    for result in hostResults:
+        results.append(result)
+        if detailed:
+            if result.error:
+                update.message.reply_text(text=f"{result.name}\nОшибка: {result.error}")
+            else:
+                replyParsedOutput(update, result.output, table, transform, alerts, title=result.name)
+        elif time.monotonic() - lastEdit >= PROGRESS_INTERVAL:
+            lastEdit = time.monotonic()
+            try:
+                progressMessage.edit_text(text=f"Выполнение на хостах: {len(results)}/{len(names)}")
+            except TelegramError:
+                pass
+
+    failed = [result for result in results if result.error]
+    timedOut = [result for result in results if result.timedOut]
+    slowest = sorted(results, key=lambda result: result.duration, reverse=True)[:5]
+
+    summary = f"Выполнено на хостах: {len(results) - len(failed) - len(timedOut)}/{len(names)}\n"
+    if failed:
+        summary += "\nОшибки:\n" + "".join(f"{result.name}: {result.error}\n" for result in failed)
+    if timedOut:
+        summary += "\nПревышено время:\n" + "".join(f"{result.name}\n" for result in timedOut)
+    summary += "\nСамые медленные:\n" + "".join(f"{result.name}: {result.duration:.2f} с\n"
+                                                for result in slowest)
+    replyLongText(update, summary)
+
+
+def remoteCommandReply(update: Update, context: CallbackContext, command: str, table: bool = False,
+                       transform=None, alerts=None):
+    """ Выполняет команду и отправляет пользователю ее вывод
+
+        Если среди аргументов есть цели вида '@хост' или '@группа',
+        команда выполняется на них через fanOutReply. Иначе она
+        выполняется на основном сервере через кэш (аргумент 'refresh'
+        обновляет его).
+
+        Args:
+            update: объект telegram.update.Update.
+            context: объект telegram.ext.CallbackContext.
+            command: команда для удаленного выполнения.
+            table: вывод является таблицей.
+            transform: функция, преобразующая текст вывода перед отправкой.
+            alerts: функция, возвращающая список предупреждений по тексту вывода.
+    """
+
+    targets, _ = splitTargets(context.args)
+    if targets:
+        fanOutReply(update, command, targets, table, transform, alerts)
+        return
+
+    data = cachedRemoteCmdExecutionBySSH(command, forceRefresh(context))
+    replyParsedOutput(update, data, table, transform, alerts)
+
+
+# Поле MetricPoint и подпись истории для команд сборщика метрик
+HISTORY_FIELDS = {
+    "free": ("memory", "Использование памяти"),
+    "df": ("disk", "Заполненность самого заполненного раздела"),
+    "mpstat": ("cpu", "Загрузка процессора"),
+}
+
+
+def historyReply(update: Update, name: str):
+    """ Отправляет min/avg/max и спарклайн метрики за историю сборщика
+
+        Args:
+            update: объект telegram.update.Update.
+            name: имя команды из COLLECTED_COMMANDS.
+    """
+
+    field, title = HISTORY_FIELDS[name]
+    summary = metricsCollector.summary(field)
+    if summary is None:
+        update.message.reply_text(text="История пока недоступна: сборщик метрик не сделал ни одного замера")
+        return
+
+    low, average, high, values = summary
+    minutes = round(metricsCollector.history / 60)
+    update.message.reply_text(text=f"{title} за {minutes} мин ({len(values)} замеров)\n"
+                                   f"мин {low:.0f}% / сред {average:.0f}% / макс {high:.0f}%\n"
+                                   f"{sparkline(values)}")
+
+
+def collectedCommandReply(update: Update, context: CallbackContext, name: str, table: bool = False, alerts=None):
+    """ Отвечает на команду последним замером фонового сборщика метрик
+
+        Без SSH-запроса отвечает, если замер есть и не устарел. С
+        аргументом 'history' отправляет историю метрики. Аргументы
+        'refresh' и '@хост' и отсутствие свежего замера передают
+        команду в remoteCommandReply.
+
+        Args:
+            update: объект telegram.update.Update.
+            context: объект telegram.ext.CallbackContext.
+            name: имя команды из COLLECTED_COMMANDS.
+            table: вывод является таблицей.
+            alerts: функция, возвращающая список предупреждений по тексту вывода.
+    """
+
+    args = context.args or []
+    if "history" in args:
+        historyReply(update, name)
+        return
+
+    sample = None
+    if not forceRefresh(context) and not any(arg.startswith("@") for arg in args):
+        sample = metricsCollector.latest(name)
+    if sample is None:
+        remoteCommandReply(update, context, COLLECTED_COMMANDS[name], table, alerts=alerts)
+        return
+
+    timestamp, text = sample
+    replyParsedOutput(update, text, table, alerts=alerts,
+                      title=f"Замер {time.strftime('%H:%M:%S', time.localtime(timestamp))}")
+
+
 def getReleaseCommand(update: Update, context: CallbackContext):
     """ Отправляет пользователю информацию о релизе
 
@@ -307,26 +940,32 @@ def getReleaseCommand(update: Update, context: CallbackContext):
             context: объект telegram.ext.CallbackContext.
     """
 
-    command = "uname -r"
-    data = remoteCmdExecutionBySSH(command)
-    data = str(data).replace('\\n', '\n')[2:-1]
-    update.message.reply_text(data)
+    remoteCommandReply(update, context, "uname -r")
 
 
 def getUnameCommand(update: Update, context: CallbackContext):
     """ Отправляет пользователю информацию о системе
 
         Отправляет сообщение, содержащее вывод команды 'uname -pnv'
-        удаленного сервера в удобном формате.
+        удаленного сервера в удобном формате. Все три значения
+        получаются за одно SSH-выполнение. С целями '@хост' или
+        '@группа' выполняется на них через fanOutReply.
 
         Args:
             update: объект telegram.update.Update.
             context: объект telegram.ext.CallbackContext.
     """
 
-    processorVersion = str(remoteCmdExecutionBySSH("uname -p")).replace('\\n', '\n')[2:-1]
-    hostname = str(remoteCmdExecutionBySSH("uname -n")).replace('\\n', '\n')[2:-1]
-    kernelVersion = str(remoteCmdExecutionBySSH("uname -v")).replace('\\n', '\n')[2:-1]
+    targets, _ = splitTargets(context.args)
+    if targets:
+        fanOutReply(update, "uname -pnv", targets)
+        return
+
+    processorVersion, hostname, kernelVersion = (
+        decodeOutput(result.output)
+        for result in cachedRemoteBatchExecutionBySSH(["uname -p", "uname -n", "uname -v"],
+                                                      forceRefresh(context))
+    )
 
     data = (f"Версия роцессора: {processorVersion}"
             f"Имя хоста: {hostname}"
@@ -345,61 +984,52 @@ def getUptimeCommand(update: Update, context: CallbackContext):
             context: объект telegram.ext.CallbackContext.
     """
 
-    command = "uptime -p"
-    data = remoteCmdExecutionBySSH(command)
-    data = str(data).replace('\\n', '\n')[2:-1]
-    update.message.reply_text(data)
+    remoteCommandReply(update, context, "uptime -p")
 
 
 def getDfCommand(update: Update, context: CallbackContext):
     """ Отправляет пользователю информацию о состоянии файловой системы
 
         Отправляет сообщение, содержащее вывод команды 'df'
-        удаленного сервера.
+        удаленного сервера, и предупреждения о заполненных разделах.
+        С аргументом 'history' отправляет историю заполненности.
 
         Args:
             update: объект telegram.update.Update.
             context: объект telegram.ext.CallbackContext.
     """
 
-    command = "df"
-    data = remoteCmdExecutionBySSH(command)
-    data = str(data).replace('\\n', '\n').replace('\\t', '\t')[2:-1]
-    update.message.reply_text(data)
+    collectedCommandReply(update, context, "df", table=True, alerts=lambda text: dfAlerts(parseDf(text)))
 
 
 def getFreeCommand(update: Update, context: CallbackContext):
     """ Отправляет пользователю информацию о состоянии ОЗУ
 
         Отправляет сообщение, содержащее вывод команды 'free -h'
-        удаленного сервера.
+        удаленного сервера, и предупреждение о нехватке памяти.
+        С аргументом 'history' отправляет историю использования памяти.
 
         Args:
             update: объект telegram.update.Update.
             context: объект telegram.ext.CallbackContext.
     """
 
-    command = "free -h"
-    data = remoteCmdExecutionBySSH(command)
-    data = 'ram' + str(data).replace('\\n', '\n')[2:-1]
-    update.message.reply_text(data)
+    collectedCommandReply(update, context, "free", table=True, alerts=lambda text: memoryAlerts(parseFree(text)))
 
 
 def getMpstatCommand(update: Update, context: CallbackContext):
     """ Отправляет пользователю информацию о производительности системы
 
-        Отправляет сообщение, содержащее вывод команды 'mpstat'
-        удаленного сервера.
+        Отправляет сообщение, содержащее вывод команды 'mpstat -P ALL'
+        удаленного сервера, и предупреждения о загруженных процессорах.
+        С аргументом 'history' отправляет историю загрузки процессора.
 
         Args:
             update: объект telegram.update.Update.
             context: объект telegram.ext.CallbackContext.
     """
 
-    command = "mpstat"
-    data = remoteCmdExecutionBySSH(command)
-    data = str(data).replace('\\n', '\n')[2:-1]
-    update.message.reply_text(data)
+    collectedCommandReply(update, context, "mpstat", alerts=lambda text: cpuAlerts(parseMpstat(text)))
 
 
 def getWCommand(update: Update, context: CallbackContext):
@@ -413,10 +1043,7 @@ def getWCommand(update: Update, context: CallbackContext):
             context: объект telegram.ext.CallbackContext.
     """
 
-    command = "w"
-    data = remoteCmdExecutionBySSH(command)
-    data = str(data).replace('\\n', '\n')[2:-1]
-    update.message.reply_text(data)
+    remoteCommandReply(update, context, "w")
 
 
 def getAuthsCommand(update: Update, context: CallbackContext):
@@ -430,17 +1057,15 @@ def getAuthsCommand(update: Update, context: CallbackContext):
             context: объект telegram.ext.CallbackContext.
     """
 
-    command = "last -n 10"
-    data = remoteCmdExecutionBySSH(command)
-    data = str(data).replace('\\n', '\n')[2:-1]
-    update.message.reply_text(data)
+    remoteCommandReply(update, context, "last -n 10")
 
 
 def getCriticalCommand(update: Update, context: CallbackContext):
     """ Отправляет пользователю информацию о 5 последних критических событиях
 
         Отправляет сообщение, содержащее вывод команды 'journalctl -p crit -n 5'
-        удаленного сервера.
+        удаленного сервера, и обновляет его по мере поступления вывода.
+        С целями '@хост' или '@группа' выполняется на них через fanOutReply.
 
         Args:
             update: объект telegram.update.Update.
@@ -448,43 +1073,41 @@ def getCriticalCommand(update: Update, context: CallbackContext):
     """
 
     command = "journalctl -p crit -n 5"
-    data = remoteCmdExecutionBySSH(command)
-    data = str(data).replace('\\n', '\n')[2:-1]
-    update.message.reply_text(data)
+    targets, _ = splitTargets(context.args)
+    if targets:
+        fanOutReply(update, command, targets)
+        return
+
+    streamCommandReply(update, command)
 
 
 def getPsCommand(update: Update, context: CallbackContext):
-    """ Отправляет пользователю информацию о некоторых запущенных процессах
+    """ Отправляет пользователю информацию о самых загруженных процессах
 
-        Отправляет сообщение, содержащее вывод команды 'ps | head'
-        удаленного сервера.
+        Получает список всех процессов удаленного сервера и отправляет
+        PS_LIMIT процессов с наибольшей загрузкой процессора.
 
         Args:
             update: объект telegram.update.Update.
             context: объект telegram.ext.CallbackContext.
     """
 
-    command = "ps | head"
-    data = remoteCmdExecutionBySSH(command)
-    data = str(data).replace('\\n', '\n')[2:-1]
-    update.message.reply_text(data)
+    remoteCommandReply(update, context, "ps -eo pid,user,pcpu,pmem,comm", table=True, transform=topProcesses)
 
 
 def getSsCommand(update: Update, context: CallbackContext):
-    """ Отправляет пользователю информацию о некоторых используемых портах
+    """ Отправляет пользователю информацию о прослушиваемых портах
 
-        Отправляет сообщение, содержащее вывод команды 'ss | head'
-        удаленного сервера.
+        Отправляет сообщение со списком TCP и UDP сокетов удаленного
+        сервера в режиме прослушивания (вывод 'ss -tuln'), отсортированным
+        по протоколу и порту.
 
         Args:
             update: объект telegram.update.Update.
             context: объект telegram.ext.CallbackContext.
     """
 
-    command = "ss | head"
-    data = remoteCmdExecutionBySSH(command)
-    data = str(data).replace('\\n', '\n')[2:-1]
-    update.message.reply_text(data)
+    remoteCommandReply(update, context, "ss -tuln", table=True, transform=listeningSockets)
 
 
 def getAptListCommand(update: Update, context: CallbackContext):
@@ -494,7 +1117,9 @@ def getAptListCommand(update: Update, context: CallbackContext):
         сообщение, содержащее вывод команды 'apt list | head'
         удаленного сервера. При наличии аргуметов, содержащих
         газвания пакетов отправляет информацию о них из команды
-        'apt show packetName'.
+        'apt show packetName', запрашивая все пакеты за одно
+        SSH-выполнение. Аргументы '@хост' и '@группа' не считаются
+        пакетами: команда выполняется на этих хостах через fanOutReply.
 
         Args:
             update: объект telegram.update.Update.
@@ -502,24 +1127,45 @@ def getAptListCommand(update: Update, context: CallbackContext):
     """
 
     data = ""
-    if context.args:
-        injectionSymbols = ['|', '&']
-        for packet in context.args:
-            if any(injectionSymbol in packet for injectionSymbol in injectionSymbols):
+    refresh = forceRefresh(context)
+    targets, args = splitTargets(context.args[1:] if refresh else context.args)
+    if args:
+        injectionSymbols = ['|', '&', ';', '(', ')', '`', '$']
+        packets = [packet for packet in args
+                   if not any(injectionSymbol in packet for injectionSymbol in injectionSymbols)]
+        commands = [f"apt show {shlex.quote(packet)}" for packet in packets]
+
+        if targets:
+            rejected = "".join(f"INCORRECT PACKAGE NAME: {packet}\n" for packet in args if packet not in packets)
+            if rejected:
+                update.message.reply_text(text=rejected)
+            try:
+                if commands:
+                    fanOutReply(update, "; ".join(commands), targets, cost=len(commands))
+            except RequestTooLarge as error:
+                update.message.reply_text(text=f"Слишком много пакетов для этих хостов, не больше "
+                                               f"{error.maxCost} пакетов на все хосты за раз")
+            return
+
+        try:
+            results = iter(cachedRemoteBatchExecutionBySSH(commands, refresh))
+        except RequestTooLarge as error:
+            update.message.reply_text(text=f"Слишком много пакетов, не больше {error.maxCost} за раз")
+            return
+
+        for packet in args:
+            if packet not in packets:
                 data += f"INCORRECT PACKAGE NAME: {packet}\n"
             else:
-                command = f"apt show {packet}"
-                tmpData = remoteCmdExecutionBySSH(command)
-                tmpData = str(tmpData).replace('\\n', '\n')[2:-1]
+                data += decodeOutput(next(results).output)
 
-                data += tmpData
-
-        update.message.reply_text(data)
+        replyLongText(update, data)
+    elif targets:
+        fanOutReply(update, "apt list | head", targets)
     else:
         command = "apt list | head"
-        data = remoteCmdExecutionBySSH(command)
-        data = str(data).replace('\\n', '\n')[2:-1]
-        update.message.reply_text(data)
+        data = cachedRemoteCmdExecutionBySSH(command, forceRefresh(context))
+        replyOutput(update, data)
 
 
 def getServicesCommand(update: Update, context: CallbackContext):
@@ -533,10 +1179,7 @@ def getServicesCommand(update: Update, context: CallbackContext):
             context: объект telegram.ext.CallbackContext.
     """
 
-    command = "systemctl list-units --type service --state running | head"
-    data = remoteCmdExecutionBySSH(command)
-    data = str(data).replace('\\n', '\n')[2:-1]
-    update.message.reply_text(data)
+    remoteCommandReply(update, context, "systemctl list-units --type service --state running | head")
 
 
 def getReplLogCommand(update: Update, context: CallbackContext):
@@ -544,8 +1187,9 @@ def getReplLogCommand(update: Update, context: CallbackContext):
 
         Отправляет сообщение, содержащее вывод команды
         'cat /var/log/postgresql/*.log | grep repl_user | hea'
-        удаленного сервера. Нужны права на чтение для ssh пользователя:
+        удаленного сервера, и обновляет его по мере поступления вывода. Нужны права на чтение для ssh пользователя:
         'sudo chmod o+r /var/log/postgresql/postgresql-15-main.log'
+        С целями '@хост' или '@группа' выполняется на них через fanOutReply.
 
         Args:
             update: объект telegram.update.Update.
@@ -553,108 +1197,542 @@ def getReplLogCommand(update: Update, context: CallbackContext):
     """
 
     command = "cat /var/log/postgresql/*.log | grep -i repl | tail -n 20"
-    data = remoteCmdExecutionBySSH(command)
-    data = str(data).replace('\\n', '\n')[2:-1]
-    update.message.reply_text(data)
+    targets, _ = splitTargets(context.args)
+    if targets:
+        fanOutReply(update, command, targets)
+        return
+
+    streamCommandReply(update, command)
+
+
+# Таблицы, которые можно листать через inline-клавиатуру
+PAGED_TABLES = ("emails", "numbers")
+
+
+def tablePageReply(table: str, afterId: int = None, beforeId: int = None):
+    """ Формирует текст и клавиатуру навигации для страницы таблицы
+
+        Args:
+            table: таблица, из которой получаются записи.
+            afterId: id, после которого начинается страница.
+            beforeId: id, перед которым заканчивается страница.
+
+        Returns:
+            Возвращает кортеж (текст сообщения, InlineKeyboardMarkup или None).
+    """
+
+    page = getDBTablePage(table, afterId=afterId, beforeId=beforeId)
+    if page is None:
+        return "Ошибка при работе с PostgreSQL", None
+
+    buttons = []
+    if page.hasPrev:
+        buttons.append(InlineKeyboardButton("◀", callback_data=f"page:{table}:prev:{page.firstId}"))
+    if page.hasNext:
+        buttons.append(InlineKeyboardButton("▶", callback_data=f"page:{table}:next:{page.lastId}"))
+
+    return page.text or "Записи не найдены", InlineKeyboardMarkup([buttons]) if buttons else None
+
+
+def tablePageCallback(update: Update, context: CallbackContext):
+    """ Переключает страницу таблицы по нажатию кнопки навигации
+
+        Данные кнопки имеют вид 'page:<таблица>:<prev|next>:<id>'.
+
+        Args:
+            update: объект telegram.update.Update.
+            context: объект telegram.ext.CallbackContext.
+    """
+
+    query = update.callback_query
+    _, table, direction, rowId = query.data.split(":")
+    query.answer()
+
+    if table not in PAGED_TABLES:
+        return
+
+    if direction == "next":
+        text, markup = tablePageReply(table, afterId=int(rowId))
+    else:
+        text, markup = tablePageReply(table, beforeId=int(rowId))
+    query.edit_message_text(text=text, reply_markup=markup)
 
 
 def getEmailsCommand(update: Update, context: CallbackContext):
     """ Отправляет пользователю список email-ов из базы данных
 
+        Список разбит на страницы с кнопками навигации.
+
         Args:
             update: объект telegram.update.Update.
             context: объект telegram.ext.CallbackContext.
-
-        Returns:
-            Возврщает обработчику строку-состояние 'findEmailsAnswer'
     """
 
-    update.message.reply_text(text=getAllRowFromDBTable("emails"))
+    text, markup = tablePageReply("emails")
+    update.message.reply_text(text=text, reply_markup=markup)
 
 
 def getPhoneNumbersCommand(update: Update, context: CallbackContext):
     """ Отправляет пользователю список телефонных номеров из базы данных
 
+        Список разбит на страницы с кнопками навигации.
+
         Args:
             update: объект telegram.update.Update.
             context: объект telegram.ext.CallbackContext.
+    """
 
-        Returns:
-            Возврщает обработчику строку-состояние 'findPhoneNumbersAnswer'
+    text, markup = tablePageReply("numbers")
+    update.message.reply_text(text=text, reply_markup=markup)
+
+
+class WebhookRequestHandler(BaseHTTPRequestHandler):
+    """ Принимает обновления Telegram, отправленные на webhook
+
+        Проверяет путь и секретный токен из заголовка
+        'X-Telegram-Bot-Api-Secret-Token' и кладет обновление в
+        ограниченную очередь диспетчера. Если очередь заполнена,
+        отвечает 503, и Telegram повторит доставку позже.
     """
 
-    update.message.reply_text(text=getAllRowFromDBTable("numbers"))
+    server: "WebhookServer"
 
+    def do_POST(self):
+        if self.path != self.server.path:
+            self.send_error(404)
+            return
 
-def main():
-    # включаем логирование
-    logging.basicConfig(
-        filename='logfile.txt',
-        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-        level=logging.INFO
-    )
-    logger = logging.getLogger(__name__)
+        token = self.headers.get("X-Telegram-Bot-Api-Secret-Token", "")
+        if not hmac.compare_digest(token.encode(), self.server.secret.encode()):
+            self.send_error(403)
+            return
+
+        try:
+            body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+            data = json.loads(body)
+            if not isinstance(data, dict):
+                raise ValueError("Обновление должно быть JSON-объектом")
+            update = Update.de_json(data, self.server.bot)
+            if update is None:
+                raise ValueError("Пустое обновление")
+        except (ValueError, TypeError, KeyError, AttributeError):
+            self.send_error(400)
+            return
+
+        try:
+            self.server.updateQueue.put_nowait(update)
+        except queue.Full:
+            self.send_response(503)
+            self.send_header("Retry-After", "1")
+            self.end_headers()
+            return
+
+        self.send_response(200)
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        pass
+
+
+class WebhookServer(ThreadingHTTPServer):
+    """ Локальный HTTP-сервер для приема обновлений через webhook
+
+        Args:
+            address: адрес и порт для прослушивания.
+            path: путь, на который Telegram отправляет обновления.
+            secret: секретный токен, переданный Telegram при установке webhook.
+            bot: объект telegram.Bot для разбора обновлений.
+            updateQueue: очередь обновлений диспетчера.
+    """
 
-    # подключаем переменные окружения
-    load_dotenv()
-    TOKEN = os.getenv("TOKEN")
+    daemon_threads = True
+
+    def __init__(self, address, path: str, secret: str, bot, updateQueue: queue.Queue):
+        super().__init__(address, WebhookRequestHandler)
+        self.path = path
+        self.secret = secret
+        self.bot = bot
+        self.updateQueue = updateQueue
+
+
+def startWebhook(updater: Updater):
+    """ Запускает бота в режиме webhook
+
+        Заменяет очередь обновлений диспетчера на ограниченную
+        (WEBHOOK_QUEUE_SIZE), запускает диспетчер и HTTP-сервер на
+        WEBHOOK_LISTEN:WEBHOOK_PORT. Если задан WEBHOOK_URL, регистрирует
+        webhook в Telegram с секретным токеном WEBHOOK_SECRET; без него
+        сервер принимает обновления только локально, например от
+        webhook_harness.py.
+
+        Args:
+            updater: объект telegram.ext.Updater с зарегистрированными обработчиками.
+    """
+
+    secret = os.getenv("WEBHOOK_SECRET")
+    if not secret:
+        raise RuntimeError("Для режима webhook необходимо задать WEBHOOK_SECRET")
+
+    path = os.getenv("WEBHOOK_PATH", "/webhook")
+    address = (os.getenv("WEBHOOK_LISTEN", "127.0.0.1"), int(os.getenv("WEBHOOK_PORT", 8443)))
 
-    updater = Updater(TOKEN, use_context=True)
     dp = updater.dispatcher
+    dp.update_queue = updater.update_queue = queue.Queue(maxsize=int(os.getenv("WEBHOOK_QUEUE_SIZE", 1000)))
+
+    url = os.getenv("WEBHOOK_URL")
+    if url:
+        updater.bot.set_webhook(url=url.rstrip("/") + path, api_kwargs={"secret_token": secret})
+
+    threading.Thread(target=dp.start, name="dispatcher", daemon=True).start()
+    if updater.job_queue is not None:
+        updater.job_queue.start()
+
+    server = WebhookServer(address, path, secret, updater.bot, dp.update_queue)
+    logging.info("Webhook слушает %s:%s%s", address[0], address[1], path)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        if updater.job_queue is not None:
+            updater.job_queue.stop()
+        if dp.persistence:
+            dp.update_persistence()
+            dp.persistence.flush()
+        dp.stop()
+
+
+def buildUpdater(token: str):
+    """ Создает Updater со всеми обработчиками бота и хранилищем состояния
+
+        Args:
+            token: токен бота.
+
+        Returns:
+            Возвращает объект telegram.ext.Updater, готовый к запуску.
+    """
+
+    # Состояние диалогов и user_data в файле PERSISTENCE_FILE, пустое значение отключает
+    persistence = None
+    if os.getenv("PERSISTENCE_FILE", "bot_state.sqlite3"):
+        persistence = SQLitePersistence(os.getenv("PERSISTENCE_FILE", "bot_state.sqlite3"),
+                                        ttl=float(os.getenv("PERSISTENCE_TTL", 7 * 24 * 3600)),
+                                        idleTimeout=float(os.getenv("PERSISTENCE_IDLE_TIMEOUT", 3600)),
+                                        maxEntries=int(os.getenv("PERSISTENCE_MAX_ENTRIES", 10000)),
+                                        batchSize=int(os.getenv("PERSISTENCE_BATCH_SIZE", 100)))
+
+    updater = Updater(token, use_context=True, workers=getConfig().botWorkers, persistence=persistence)
+    dp = updater.dispatcher
+
+    if persistence is not None:
+        updater.job_queue.run_repeating(lambda context: persistence.flushPending(),
+                                        interval=float(os.getenv("PERSISTENCE_FLUSH_INTERVAL", 5)))
+        updater.job_queue.run_repeating(lambda context: persistence.evict(context.dispatcher),
+                                        interval=float(os.getenv("PERSISTENCE_EVICT_INTERVAL", 300)))
 
     # Обработчики диалогов
     convHandlerFindPhoneNumbers = ConversationHandler(
-        entry_points=[CommandHandler('find_phone_number', findPhoneNumbersCommand)],
+        entry_points=[CommandHandler('find_phone_number', instrumented(findPhoneNumbersCommand))],
         states={
-            'findPhoneNumbersAnswer': [MessageHandler(Filters.text & ~Filters.command, findPhoneNumbersAnswer)],
-            'findPhoneNumbersBDAnswer': [MessageHandler(Filters.text & ~Filters.command, findPhoneNumbersBDAnswer)],
+            'findPhoneNumbersAnswer': [MessageHandler((Filters.text & ~Filters.command) | Filters.document,
+                                                      offload(None, findPhoneNumbersAnswer))],
+            'findPhoneNumbersBDAnswer': [MessageHandler(Filters.text & ~Filters.command,
+                                                        offload("db", findPhoneNumbersBDAnswer))],
         },
-        fallbacks=[]
+        fallbacks=[],
+        name="findPhoneNumbers",
+        persistent=persistence is not None
     )
     convHandlerFindEmails = ConversationHandler(
-        entry_points=[CommandHandler('find_email', findEmailsCommand)],
+        entry_points=[CommandHandler('find_email', instrumented(findEmailsCommand))],
         states={
-            'findEmailsAnswer': [MessageHandler(Filters.text & ~Filters.command, findEmailsAnswer)],
-            'findEmailsBDAnswer': [MessageHandler(Filters.text & ~Filters.command, findEmailsBDAnswer)],
+            'findEmailsAnswer': [MessageHandler((Filters.text & ~Filters.command) | Filters.document,
+                                                offload(None, findEmailsAnswer))],
+            'findEmailsBDAnswer': [MessageHandler(Filters.text & ~Filters.command,
+                                                  offload("db", findEmailsBDAnswer))],
         },
-        fallbacks=[]
+        fallbacks=[],
+        name="findEmails",
+        persistent=persistence is not None
     )
     convHandlerVerifyPassword = ConversationHandler(
-        entry_points=[CommandHandler('verify_password', verifyPasswordCommand)],
+        entry_points=[CommandHandler('verify_password', instrumented(verifyPasswordCommand))],
         states={
-            'verifyPasswordAnswer': [MessageHandler(Filters.text & ~Filters.command, verifyPasswordAnswer)],
+            'verifyPasswordAnswer': [MessageHandler((Filters.text & ~Filters.command) | Filters.document,
+                                                    offload(None, verifyPasswordAnswer))],
         },
-        fallbacks=[]
+        fallbacks=[],
+        name="verifyPassword",
+        persistent=persistence is not None
     )
 
     # Регистрируем обработчики команд
-    dp.add_handler(CommandHandler("start", startCommand))
-    dp.add_handler(CommandHandler("help", helpCommand))
+    dp.add_handler(CommandHandler("start", instrumented(startCommand)))
+    dp.add_handler(CommandHandler("help", instrumented(helpCommand)))
     dp.add_handler(convHandlerFindPhoneNumbers)
     dp.add_handler(convHandlerFindEmails)
     dp.add_handler(convHandlerVerifyPassword)
-    dp.add_handler(CommandHandler("get_release", getReleaseCommand))
-    dp.add_handler(CommandHandler("get_uname", getUnameCommand))
-    dp.add_handler(CommandHandler("get_uptime", getUptimeCommand))
-    dp.add_handler(CommandHandler("get_df", getDfCommand))
-    dp.add_handler(CommandHandler("get_free", getFreeCommand))
-    dp.add_handler(CommandHandler("get_mpstat", getMpstatCommand))
-    dp.add_handler(CommandHandler("get_w", getWCommand))
-    dp.add_handler(CommandHandler("get_auths", getAuthsCommand))
-    dp.add_handler(CommandHandler("get_critical", getCriticalCommand))
-    dp.add_handler(CommandHandler("get_ps", getPsCommand))
-    dp.add_handler(CommandHandler("get_ss", getSsCommand))
-    dp.add_handler(CommandHandler("get_apt_list", getAptListCommand))
-    dp.add_handler(CommandHandler("get_services", getServicesCommand))
-    dp.add_handler(CommandHandler("get_repl_logs", getReplLogCommand))
-    dp.add_handler(CommandHandler("get_emails", getEmailsCommand))
-    dp.add_handler(CommandHandler("get_phone_numbers", getPhoneNumbersCommand))
+    dp.add_handler(CommandHandler("get_release", offload("ssh", getReleaseCommand)))
+    dp.add_handler(CommandHandler("get_uname", offload("ssh", getUnameCommand)))
+    dp.add_handler(CommandHandler("get_uptime", offload("ssh", getUptimeCommand)))
+    dp.add_handler(CommandHandler("get_df", offload("ssh", getDfCommand)))
+    dp.add_handler(CommandHandler("get_free", offload("ssh", getFreeCommand)))
+    dp.add_handler(CommandHandler("get_mpstat", offload("ssh", getMpstatCommand)))
+    dp.add_handler(CommandHandler("get_w", offload("ssh", getWCommand)))
+    dp.add_handler(CommandHandler("get_auths", offload("ssh", getAuthsCommand)))
+    dp.add_handler(CommandHandler("get_critical", offload("ssh", getCriticalCommand)))
+    dp.add_handler(CommandHandler("get_ps", offload("ssh", getPsCommand)))
+    dp.add_handler(CommandHandler("get_ss", offload("ssh", getSsCommand)))
+    dp.add_handler(CommandHandler("get_apt_list", offload("ssh", getAptListCommand)))
+    dp.add_handler(CommandHandler("get_services", offload("ssh", getServicesCommand)))
+    dp.add_handler(CommandHandler("get_repl_logs", offload("ssh", getReplLogCommand)))
+    dp.add_handler(CommandHandler("get_emails", offload("db", getEmailsCommand)))
+    dp.add_handler(CommandHandler("get_phone_numbers", offload("db", getPhoneNumbersCommand)))
+    dp.add_handler(CallbackQueryHandler(offload("db", tablePageCallback), pattern=r"^page:"))
 
     # Регистрируем обработчик текстовых сообщений
-    dp.add_handler(MessageHandler(Filters.text & ~Filters.command, echo))
+    dp.add_handler(MessageHandler(Filters.text & ~Filters.command, instrumented(echo)))
 
-    # Запускаем бота
-    updater.start_polling()
+    return updater
+
+
+def startMetrics(offset: int = 0):
+    """ Запускает сервер метрик Prometheus на METRICS_HOST:METRICS_PORT + offset, METRICS_PORT=0 отключает """
+
+    config = getConfig()
+    if config.metricsPort:
+        startMetricsServer(config.metricsHost, config.metricsPort + offset)
+
+
+def startCollector():
+    """ Запускает фоновый сбор free/df/mpstat основного сервера, COLLECTOR_INTERVAL=0 отключает """
+
+    if getConfig().rmHost and getConfig().collectorInterval:
+        metricsCollector.start()
+
+
+def startWarmUp():
+    """ Запускает в фоне прогрев SSH- и DB-подключений (warmUp), WARMUP=0 отключает """
+
+    if getConfig().warmUp:
+        threading.Thread(target=warmUp, name="warmup", daemon=True).start()
+    else:
+        logging.info("Время запуска: %s", STARTUP.report())
+
+
+def runWorker(index: int, count: int, updates, semaphores: dict, cache, collected, logQueue):
+    """ Точка входа процесса-воркера многопроцессного режима
+
+        Обрабатывает обновления из своей очереди собственным
+        диспетчером со всеми обработчиками бота. Лимиты бэкендов и кэш
+        команд общие для всех воркеров, состояние диалогов - общий
+        файл PERSISTENCE_FILE. Замеры сборщика метрик воркер читает из
+        общего словаря, а записи лога отправляет процессу приема
+        обновлений, который один пишет LOG_FILE. Получив None, воркер
+        дорабатывает уже принятые обновления, сохраняет состояние и
+        завершается.
+
+        Args:
+            index: номер воркера.
+            count: количество воркеров.
+            updates: очередь обновлений воркера (словари Update.to_dict()).
+            semaphores: межпроцессные семафоры лимитов бэкендов.
+            cache: общий для процессов словарь кэша команд.
+            collected: общий для процессов словарь замеров сборщика метрик.
+            logQueue: очередь записей лога процесса приема обновлений.
+    """
+
+    # Ctrl+C получает вся группа процессов, останавливает воркеры только пул
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    setupLogging(logQueue)
+    useSharedState(semaphores, cache, count, collected)
+    startMetrics(offset=index + 1)
+
+    with STARTUP.phase("handlers"):
+        updater = buildUpdater(getConfig().token)
+    dp = updater.dispatcher
+    threading.Thread(target=dp.start, name="dispatcher", daemon=True).start()
+    updater.job_queue.start()
+    logging.info("Воркер %s/%s запущен", index + 1, count)
+    startWarmUp()
+
+    while True:
+        data = updates.get()
+        if data is None:
+            break
+        dp.update_queue.put(Update.de_json(data, updater.bot))
+
+    updater.job_queue.stop()
+    dp.stop()
+    if dp.persistence:
+        dp.update_persistence()
+        dp.persistence.flush()
+    logging.info("Воркер %s/%s остановлен", index + 1, count)
+
+
+class WorkerPool:
+    """ Пул процессов-воркеров, между которыми распределяются обновления
+
+        Обновления распределяются по остатку от деления id пользователя
+        на количество воркеров, поэтому сообщения одного пользователя
+        всегда обрабатываются одним воркером по порядку, а его user_data
+        в общем файле состояния меняет только этот воркер, в каком бы
+        чате он ни писал. При изменении количества воркеров (resize)
+        прием обновлений приостанавливается, текущие воркеры
+        дорабатывают свои очереди и сохраняют состояние диалогов, после
+        чего запускаются новые, загружающие его.
+        Упавший воркер перезапускается при следующем обновлении для него.
+        Записи лога воркеров пишет в LOG_FILE этот процесс, а замеры
+        сборщика метрик воркеры читают из общего словаря collected.
+
+        Args:
+            count: количество воркеров.
+            queueSize: размер очереди каждого воркера.
+    """
+
+    def __init__(self, count: int, queueSize: int = 1000):
+        self.count = count
+        self.queueSize = queueSize
+        self._context = multiprocessing.get_context("spawn")
+        self._manager = self._context.Manager()
+        self._cache = self._manager.dict()
+        self.collected = self._manager.dict()
+        self._logs = self._context.Queue()
+        self._logForwarder = None
+        self._semaphores = {backend: self._context.BoundedSemaphore(limit)
+                            for backend, limit in BACKEND_CONCURRENCY.items()}
+        self._workers = []
+        self._lock = threading.Lock()
+
+    def _spawn(self, index: int, updates=None):
+        updates = updates or self._context.Queue(maxsize=self.queueSize)
+        process = self._context.Process(target=runWorker, name=f"bot-worker-{index}",
+                                        args=(index, self.count, updates, self._semaphores, self._cache,
+                                              self.collected, self._logs))
+        process.start()
+        return process, updates
+
+    def start(self):
+        self._logForwarder = forwardLogs(self._logs)
+        with self._lock:
+            self._workers = [self._spawn(index) for index in range(self.count)]
+
+    def _stopWorkers(self):
+        for _, updates in self._workers:
+            updates.put(None)
+        for process, _ in self._workers:
+            process.join()
+        self._workers = []
+
+    def route(self, update: Update):
+        """ Передает обновление воркеру, отвечающему за его пользователя """
+
+        chat, user = update.effective_chat, update.effective_user
+        shard = user.id if user else chat.id if chat else update.update_id
+        data = update.to_dict()
+        with self._lock:
+            index = shard % self.count
+            process, updates = self._workers[index]
+            if not process.is_alive():
+                logging.error("Воркер %s завершился с кодом %s, перезапуск", index + 1, process.exitcode)
+                self._workers[index] = self._spawn(index, updates)
+            updates.put(data)
+
+    def resize(self, count: int):
+        """ Меняет количество воркеров без потери диалогов и порядка сообщений """
+
+        count = max(1, count)
+        with self._lock:
+            if count == self.count:
+                return
+            logging.info("Изменение количества воркеров: %s -> %s", self.count, count)
+            self._stopWorkers()
+            self.count = count
+            self._workers = [self._spawn(index) for index in range(count)]
+
+    def stop(self):
+        with self._lock:
+            self._stopWorkers()
+        if self._logForwarder is not None:
+            self._logForwarder.stop()
+        self._manager.shutdown()
+
+
+def runIngestion(token: str, count: int):
+    """ Запускает многопроцессный режим: прием обновлений и пул воркеров
+
+        Этот процесс получает обновления (long polling или webhook) и
+        передает их в WorkerPool, а также единственный опрашивает
+        сервер сборщиком метрик и пишет лог. SIGUSR1 добавляет воркер,
+        SIGUSR2 убирает.
+
+        Args:
+            token: токен бота.
+            count: начальное количество воркеров.
+    """
+
+    pool = WorkerPool(count, getConfig().workerQueueSize)
+    pool.start()
+    metricsCollector.shared = pool.collected
+    startCollector()
+
+    updater = Updater(token, use_context=True, workers=0)
+    updater.dispatcher.add_handler(TypeHandler(Update, lambda update, context: pool.route(update)))
+
+    def resizeOnSignal(signum, frame):
+        delta = 1 if signum == signal.SIGUSR1 else -1
+        threading.Thread(target=pool.resize, args=(pool.count + delta,), name="resize", daemon=True).start()
+
+    signal.signal(signal.SIGUSR1, resizeOnSignal)
+    signal.signal(signal.SIGUSR2, resizeOnSignal)
+
+    try:
+        if getConfig().botMode == "webhook":
+            startWebhook(updater)
+        else:
+            with STARTUP.phase("polling"):
+                updater.start_polling()
+            logging.info("Время запуска: %s", STARTUP.report())
+            updater.idle()
+    finally:
+        metricsCollector.stop()
+        pool.stop()
+
+
+def main():
+    STARTUP.record("imports", time.perf_counter() - _importStarted)
+
+    # включаем логирование
+    with STARTUP.phase("logging"):
+        setupLogging()
+
+    # переменные окружения и .env уже загружены при импорте tools
+    config = getConfig()
+
+    # Метрики в формате Prometheus на METRICS_HOST:METRICS_PORT/metrics
+    with STARTUP.phase("metrics"):
+        startMetrics()
+
+    # Многопроцессный режим: BOT_WORKER_PROCESSES воркеров за общим приемом обновлений
+    if config.workerProcesses:
+        runIngestion(config.token, config.workerProcesses)
+        return
+
+    startCollector()
+    with STARTUP.phase("handlers"):
+        updater = buildUpdater(config.token)
+
+    # Запускаем бота: webhook, если выбран в BOT_MODE, иначе long polling.
+    # SSH- и DB-подключения прогреваются в фоне, уже после запуска приема
+    if config.botMode == "webhook":
+        startWarmUp()
+        startWebhook(updater)
+        return
+
+    with STARTUP.phase("polling"):
+        updater.start_polling()
+    startWarmUp()
 
     # Останавливаем бота при нажатии Ctrl+C
     updater.idle()
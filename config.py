@@ -0,0 +1,77 @@
+# /bin/bash
+""" Конфигурация бота
+
+    Переменные окружения (и файл .env) читаются один раз при первом
+    вызове getConfig(); дальше все модули используют один неизменяемый
+    объект Config. Настройки отдельных подсистем (лимиты, кэши, пулы)
+    по-прежнему читаются из окружения при импорте модуля tools.
+"""
+import os
+from typing import NamedTuple, Optional
+from functools import lru_cache
+
+from dotenv import load_dotenv
+
+
+def _flag(value: str) -> bool:
+    return value.strip().lower() not in ("", "0", "false", "no", "off")
+
+
+class Config(NamedTuple):
+    """ Основные настройки бота: токен, режим работы и подключения к бэкендам """
+
+    token: Optional[str]
+    botMode: str
+    botWorkers: int
+    workerProcesses: int
+    workerQueueSize: int
+    rmHost: Optional[str]
+    rmPort: int
+    rmUser: Optional[str]
+    rmPassword: Optional[str]
+    dbHost: Optional[str]
+    dbPort: Optional[str]
+    dbUser: Optional[str]
+    dbPassword: Optional[str]
+    dbDatabase: Optional[str]
+    metricsHost: str
+    metricsPort: int
+    collectorInterval: float
+    warmUp: bool
+
+    @classmethod
+    def fromEnv(cls, environ=os.environ):
+        """ Собирает настройки из словаря переменных окружения
+
+            Raises:
+                ValueError: числовая настройка задана не числом.
+        """
+
+        return cls(
+            token=environ.get("TOKEN"),
+            botMode=environ.get("BOT_MODE", "polling"),
+            botWorkers=int(environ.get("BOT_WORKERS", 8)),
+            workerProcesses=int(environ.get("BOT_WORKER_PROCESSES", 0)),
+            workerQueueSize=int(environ.get("WORKER_QUEUE_SIZE", 1000)),
+            rmHost=environ.get("RM_HOST"),
+            rmPort=int(environ.get("RM_PORT", 22)),
+            rmUser=environ.get("RM_USER"),
+            rmPassword=environ.get("RM_PASSWORD"),
+            dbHost=environ.get("DB_HOST"),
+            dbPort=environ.get("DB_PORT"),
+            dbUser=environ.get("DB_USER"),
+            dbPassword=environ.get("DB_PASSWORD"),
+            dbDatabase=environ.get("DB_DATABASE"),
+            metricsHost=environ.get("METRICS_HOST", "127.0.0.1"),
+            metricsPort=int(environ.get("METRICS_PORT", 9108)),
+            collectorInterval=float(environ.get("COLLECTOR_INTERVAL", 30)),
+            warmUp=_flag(environ.get("WARMUP", "1")),
+        )
+
+
+@lru_cache(maxsize=1)
+def getConfig() -> Config:
+    """ Загружает .env и возвращает настройки, при повторных вызовах - те же самые """
+
+    load_dotenv()
+    return Config.fromEnv()
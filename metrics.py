@@ -0,0 +1,236 @@
+# /bin/bash
+""" Метрики бота в формате Prometheus
+
+    Минимальная реализация счетчиков и гистограмм без внешних
+    зависимостей и HTTP-сервер, отдающий их по адресу /metrics.
+"""
+import time
+import threading
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+_registry = []
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+def _formatLabels(labelNames, labelValues, extra=()):
+    pairs = list(zip(labelNames, labelValues)) + list(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in pairs) + "}"
+
+
+class Counter:
+    """ Монотонно возрастающий счетчик с метками
+
+        Args:
+            name: имя метрики.
+            documentation: описание метрики.
+            labelNames: имена меток.
+    """
+
+    kind = "counter"
+
+    def __init__(self, name: str, documentation: str, labelNames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelNames = tuple(labelNames)
+        self._values = {}
+        self._lock = threading.Lock()
+        _registry.append(self)
+
+    def inc(self, amount: float = 1, **labels):
+        key = tuple(str(labels[name]) for name in self.labelNames)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def samples(self):
+        with self._lock:
+            items = list(self._values.items())
+        for key, value in items:
+            yield self.name + _formatLabels(self.labelNames, key), value
+
+
+class Histogram:
+    """ Гистограмма распределения значений (обычно длительностей) с метками
+
+        Args:
+            name: имя метрики.
+            documentation: описание метрики.
+            labelNames: имена меток.
+            buckets: верхние границы корзин по возрастанию.
+    """
+
+    kind = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelNames=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelNames = tuple(labelNames)
+        self.buckets = tuple(buckets)
+        self._values = {}
+        self._lock = threading.Lock()
+        _registry.append(self)
+
+    def observe(self, value: float, **labels):
+        key = tuple(str(labels[name]) for name in self.labelNames)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                state = self._values[key] = [[0] * len(self.buckets), 0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    state[0][i] += 1
+            state[1] += value
+            state[2] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        """ Замеряет длительность блока кода, в том числе завершившегося ошибкой """
+
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def samples(self):
+        with self._lock:
+            items = [(key, (list(state[0]), state[1], state[2])) for key, state in self._values.items()]
+        for key, (counts, total, count) in items:
+            for bound, bucketCount in zip(self.buckets, counts):
+                yield self.name + "_bucket" + _formatLabels(self.labelNames, key, [("le", bound)]), bucketCount
+            yield self.name + "_bucket" + _formatLabels(self.labelNames, key, [("le", "+Inf")]), count
+            yield self.name + "_sum" + _formatLabels(self.labelNames, key), total
+            yield self.name + "_count" + _formatLabels(self.labelNames, key), count
+
+
+class CallbackMetric:
+    """ Метрика, значения которой вычисляются при каждом чтении
+
+        Подходит для уже существующих счетчиков и состояний, например
+        статистики пула подключений или кэша.
+
+        Args:
+            name: имя метрики.
+            documentation: описание метрики.
+            callback: функция, возвращающая число или словарь
+                {значение метки: число}.
+            kind: тип метрики, 'gauge' или 'counter'.
+            labelName: имя метки, если callback возвращает словарь.
+    """
+
+    def __init__(self, name: str, documentation: str, callback, kind: str = "gauge", labelName: str = None):
+        self.name = name
+        self.documentation = documentation
+        self.callback = callback
+        self.kind = kind
+        self.labelName = labelName
+        _registry.append(self)
+
+    def samples(self):
+        value = self.callback()
+        if isinstance(value, dict):
+            for label, item in value.items():
+                yield self.name + _formatLabels((self.labelName,), (label,)), item
+        else:
+            yield self.name, value
+
+
+class PhaseTimer:
+    """ Длительности этапов процесса, например запуска бота
+
+        Этапы запоминаются в порядке завершения; повторный замер этапа
+        с тем же именем заменяет предыдущий.
+    """
+
+    def __init__(self):
+        self.phases = {}
+        self._lock = threading.Lock()
+
+    def record(self, name: str, seconds: float):
+        with self._lock:
+            self.phases.pop(name, None)
+            self.phases[name] = seconds
+
+    @contextmanager
+    def phase(self, name: str):
+        """ Замеряет длительность блока кода как этап name """
+
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, time.perf_counter() - started)
+
+    def report(self) -> str:
+        """ Возвращает строку вида 'этап 0.123 с, ...' """
+
+        with self._lock:
+            items = list(self.phases.items())
+        return ", ".join(f"{name} {seconds:.3f} с" for name, seconds in items)
+
+
+def render():
+    """ Возвращает все зарегистрированные метрики в текстовом формате Prometheus """
+
+    lines = []
+    for metric in _registry:
+        lines.append(f"# HELP {metric.name} {metric.documentation}")
+        lines.append(f"# TYPE {metric.name} {metric.kind}")
+        for sample, value in metric.samples():
+            lines.append(f"{sample} {value}")
+    return "\n".join(lines) + "\n"
+
+
+class _MetricsRequestHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path != "/metrics":
+            self.send_error(404)
+            return
+        body = render().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def startMetricsServer(host: str, port: int):
+    """ Запускает HTTP-сервер метрик в фоновом потоке
+
+        Args:
+            host: адрес для прослушивания.
+            port: порт для прослушивания.
+
+        Returns:
+            Возвращает объект запущенного сервера.
+    """
+
+    server = ThreadingHTTPServer((host, port), _MetricsRequestHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="metrics", daemon=True).start()
+    return server
+
+
+COMMAND_SECONDS = Histogram("bot_command_duration_seconds", "Длительность обработки команды", ["command"])
+COMMAND_ERRORS = Counter("bot_command_errors_total", "Ошибки при обработке команды", ["command"])
+SSH_CONNECT_SECONDS = Histogram("ssh_connect_duration_seconds", "Длительность установки SSH-подключения", ["host"])
+SSH_EXEC_SECONDS = Histogram("ssh_exec_duration_seconds", "Длительность выполнения команды по SSH", ["host"])
+SSH_ERRORS = Counter("ssh_errors_total", "Ошибки SSH-подключений и каналов", ["host"])
+DB_QUERY_SECONDS = Histogram("db_query_duration_seconds", "Длительность запроса к PostgreSQL", ["query"])
+DB_CHECKOUT_SECONDS = Histogram("db_checkout_duration_seconds", "Время получения подключения из пула")
+DB_ERRORS = Counter("db_errors_total", "Ошибки при работе с PostgreSQL", ["query"])
+RATE_LIMITED = Counter("bot_rate_limited_total", "Запросы, задержанные или отклоненные ограничителем частоты",
+                       ["scope", "action"])
+STARTUP = PhaseTimer()
+CallbackMetric("bot_startup_phase_seconds", "Длительность этапов запуска бота",
+               lambda: dict(STARTUP.phases), labelName="phase")
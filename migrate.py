@@ -0,0 +1,44 @@
+# /bin/bash
+""" Применение миграций схемы БД
+
+    Создает таблицы emails и numbers, если их нет, нормализует уже
+    записанные значения, удаляет дубликаты и создает уникальные
+    индексы. Повторный запуск применяет только новые миграции:
+
+        python migrate.py
+        python migrate.py --status
+"""
+import sys
+import argparse
+
+from tools import SCHEMA_MIGRATIONS, dbPool, migrateDB, setupLogging
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Миграции схемы БД бота")
+    parser.add_argument("--status", action="store_true", help="показать примененные миграции и выйти")
+    args = parser.parse_args()
+    setupLogging()
+
+    try:
+        if args.status:
+            with dbPool.connection() as connection:
+                with connection.cursor() as cursor:
+                    cursor.execute("SELECT to_regclass('schema_migrations') IS NOT NULL;")
+                    done = set()
+                    if cursor.fetchone()[0]:
+                        cursor.execute("SELECT version FROM schema_migrations;")
+                        done = {row[0] for row in cursor.fetchall()}
+            for version, description, _ in sorted(SCHEMA_MIGRATIONS):
+                print(f"{'✓' if version in done else ' '} {version}: {description}")
+            return 0
+
+        applied = migrateDB()
+        print(f"Применено миграций: {len(applied)}" + (f" ({', '.join(map(str, applied))})" if applied else ""))
+        return 0
+    finally:
+        dbPool.closeAll()
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,304 @@
+# /bin/bash
+""" Хранение состояния диалогов и user_data между перезапусками бота
+
+    SQLitePersistence сохраняет состояния ConversationHandler-ов,
+    user_data и chat_data в локальный файл SQLite. Изменения копятся в
+    памяти и записываются пачками, а давно не использовавшиеся записи
+    выгружаются из памяти и удаляются из файла по истечении TTL.
+"""
+import json
+import time
+import pickle
+import sqlite3
+import logging
+import threading
+from collections import defaultdict
+
+from telegram.ext import BasePersistence, ConversationHandler
+from telegram.ext.utils.promise import Promise
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS data (
+    kind TEXT NOT NULL,
+    id INTEGER NOT NULL,
+    value BLOB NOT NULL,
+    updated REAL NOT NULL,
+    PRIMARY KEY (kind, id)
+);
+CREATE INDEX IF NOT EXISTS data_updated ON data (updated);
+CREATE TABLE IF NOT EXISTS conversations (
+    name TEXT NOT NULL,
+    key TEXT NOT NULL,
+    state BLOB NOT NULL,
+    updated REAL NOT NULL,
+    PRIMARY KEY (name, key)
+);
+CREATE INDEX IF NOT EXISTS conversations_updated ON conversations (updated);
+"""
+
+
+class SQLitePersistence(BasePersistence):
+    """ Хранилище состояния бота в файле SQLite
+
+        Изменения user_data, chat_data и состояний диалогов
+        записываются в файл пачками: при вызове flushPending() (бот
+        вызывает его по таймеру), при накоплении batchSize изменений и
+        при остановке бота (flush()).
+
+        Если диалог ожидает завершения обработчика (состояние -
+        Promise), при записи сохраняется результат обработчика, если он
+        уже завершился, а иначе предыдущее состояние, и запись
+        повторяется при следующем сбросе. Если запись не удалась,
+        изменения остаются в очереди до следующего сброса.
+
+        Память ограничена: evict() выгружает из памяти диспетчера
+        данные пользователей и чатов, не обращавшихся дольше idleTimeout
+        секунд, а также самые давние сверх maxEntries. Выгруженные
+        данные остаются в файле и подгружаются при следующем сообщении
+        пользователя (refresh_user_data). Записи и диалоги, не
+        обновлявшиеся дольше ttl секунд, удаляются совсем.
+
+        Args:
+            path: путь к файлу SQLite.
+            ttl: время жизни записи без обновлений в секундах.
+            idleTimeout: время простоя, после которого данные выгружаются из памяти.
+            maxEntries: максимальное количество пользователей и чатов в памяти.
+            batchSize: количество изменений, при котором запись выполняется сразу.
+    """
+
+    def __init__(self, path: str, ttl: float = 7 * 24 * 3600, idleTimeout: float = 3600,
+                 maxEntries: int = 10000, batchSize: int = 100):
+        super().__init__(store_user_data=True, store_chat_data=True, store_bot_data=False)
+        self.path = path
+        self.ttl = ttl
+        self.idleTimeout = idleTimeout
+        self.maxEntries = maxEntries
+        self.batchSize = batchSize
+
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        self._connection.execute("PRAGMA journal_mode=WAL;")
+        self._connection.executescript(_SCHEMA)
+        self._dbLock = threading.Lock()
+
+        self._lock = threading.Lock()
+        self._pendingData = {}
+        self._pendingConversations = {}
+        self._lastSeen = {}
+        self._conversations = {}
+        self._conversationSeen = {}
+
+    def _loadData(self, kind: str):
+        data = defaultdict(dict)
+        since = time.time() - self.idleTimeout
+        with self._dbLock:
+            rows = self._connection.execute(
+                "SELECT id, value, updated FROM data WHERE kind = ? AND updated >= ? ORDER BY updated DESC LIMIT ?;",
+                (kind, since, self.maxEntries)).fetchall()
+        for entryId, value, updated in rows:
+            data[entryId] = pickle.loads(value)
+            self._lastSeen[(kind, entryId)] = updated
+        return data
+
+    def _loadEntry(self, kind: str, entryId: int):
+        with self._dbLock:
+            row = self._connection.execute("SELECT value FROM data WHERE kind = ? AND id = ? AND updated >= ?;",
+                                           (kind, entryId, time.time() - self.ttl)).fetchone()
+        return pickle.loads(row[0]) if row else None
+
+    def get_user_data(self):
+        return self._loadData("user")
+
+    def get_chat_data(self):
+        return self._loadData("chat")
+
+    def get_bot_data(self):
+        return {}
+
+    def get_conversations(self, name: str):
+        conversations = {}
+        since = time.time() - self.ttl
+        with self._dbLock:
+            rows = self._connection.execute("SELECT key, state, updated FROM conversations "
+                                            "WHERE name = ? AND updated >= ?;", (name, since)).fetchall()
+        for key, state, updated in rows:
+            key = tuple(json.loads(key))
+            conversations[key] = pickle.loads(state)
+            self._conversationSeen[(name, key)] = updated
+        self._conversations[name] = conversations
+        return conversations
+
+    @staticmethod
+    def _resolveState(state):
+        """ Возвращает (сохраняемое состояние, окончательно ли оно) так же, как ConversationHandler
+
+            Состояние может быть вложенным, ((старое, Promise), Promise),
+            если следующий обработчик запустился до завершения
+            предыдущего; кортежи разворачиваются до обычного состояния,
+            так что Promise в файл никогда не попадает.
+        """
+
+        final = True
+        while isinstance(state, tuple) and len(state) == 2 and isinstance(state[1], Promise):
+            oldState, promise = state
+            if not promise.done.is_set():
+                final = False
+            elif promise.exception is None and promise.result() is not None:
+                state = promise.result()
+                break
+            state = oldState
+        return (None if state == ConversationHandler.END else state), final
+
+    def update_conversation(self, name: str, key: tuple, new_state):
+        with self._lock:
+            self._pendingConversations[(name, key)] = new_state
+            if new_state is None:
+                self._conversationSeen.pop((name, key), None)
+            else:
+                self._conversationSeen[(name, key)] = time.time()
+        self._flushIfFull()
+
+    def _updateData(self, kind: str, entryId: int, data: dict):
+        with self._lock:
+            self._pendingData[(kind, entryId)] = data
+            self._lastSeen[(kind, entryId)] = time.time()
+        self._flushIfFull()
+
+    def update_user_data(self, user_id: int, data: dict):
+        self._updateData("user", user_id, data)
+
+    def update_chat_data(self, chat_id: int, data: dict):
+        self._updateData("chat", chat_id, data)
+
+    def update_bot_data(self, data: dict):
+        pass
+
+    def _refreshData(self, kind: str, entryId: int, data: dict):
+        # Данные, выгруженные из памяти evict(), подгружаются из файла
+        if data:
+            return
+        stored = self._loadEntry(kind, entryId)
+        if stored:
+            data.update(stored)
+            with self._lock:
+                self._lastSeen[(kind, entryId)] = time.time()
+
+    def refresh_user_data(self, user_id: int, user_data: dict):
+        self._refreshData("user", user_id, user_data)
+
+    def refresh_chat_data(self, chat_id: int, chat_data: dict):
+        self._refreshData("chat", chat_id, chat_data)
+
+    def refresh_bot_data(self, bot_data: dict):
+        pass
+
+    def _flushIfFull(self):
+        if len(self._pendingData) + len(self._pendingConversations) >= self.batchSize:
+            self.flushPending()
+
+    def flushPending(self):
+        """ Записывает накопленные изменения в файл одной транзакцией
+
+            Returns:
+                Возвращает количество записанных изменений.
+        """
+
+        with self._lock:
+            pendingData, self._pendingData = self._pendingData, {}
+            pendingConversations, self._pendingConversations = self._pendingConversations, {}
+            lastSeen = {key: self._lastSeen.get(key, time.time()) for key in pendingData}
+            conversationSeen = {key: self._conversationSeen.get(key, time.time()) for key in pendingConversations}
+        if not pendingData and not pendingConversations:
+            return 0
+
+        dataRows, dataDeleted, conversationRows, conversationDeleted = [], [], [], []
+        unresolved = {}
+        try:
+            for (kind, entryId), data in pendingData.items():
+                if data:
+                    dataRows.append((kind, entryId, pickle.dumps(data), lastSeen[(kind, entryId)]))
+                else:
+                    dataDeleted.append((kind, entryId))
+            for (name, key), state in pendingConversations.items():
+                state, final = self._resolveState(state)
+                if not final:
+                    unresolved[(name, key)] = pendingConversations[(name, key)]
+                if state is None:
+                    conversationDeleted.append((name, json.dumps(key)))
+                else:
+                    conversationRows.append((name, json.dumps(key), pickle.dumps(state),
+                                             conversationSeen[(name, key)]))
+
+            with self._dbLock, self._connection:
+                self._connection.executemany("INSERT OR REPLACE INTO data (kind, id, value, updated) "
+                                             "VALUES (?, ?, ?, ?);", dataRows)
+                self._connection.executemany("DELETE FROM data WHERE kind = ? AND id = ?;", dataDeleted)
+                self._connection.executemany("INSERT OR REPLACE INTO conversations (name, key, state, updated) "
+                                             "VALUES (?, ?, ?, ?);", conversationRows)
+                self._connection.executemany("DELETE FROM conversations WHERE name = ? AND key = ?;",
+                                             conversationDeleted)
+        except Exception:
+            # Пачка возвращается в очередь, более новые изменения тех же записей не перезаписываются
+            with self._lock:
+                for key, data in pendingData.items():
+                    self._pendingData.setdefault(key, data)
+                for key, state in pendingConversations.items():
+                    self._pendingConversations.setdefault(key, state)
+            logging.exception("Не удалось записать изменения в %s", self.path)
+            raise
+
+        # Диалоги, чьи обработчики еще выполняются, записываются повторно при следующем сбросе
+        if unresolved:
+            with self._lock:
+                for key, state in unresolved.items():
+                    self._pendingConversations.setdefault(key, state)
+
+        return len(pendingData) + len(pendingConversations)
+
+    def evict(self, dispatcher):
+        """ Выгружает простаивающие данные из памяти и удаляет устаревшие
+
+            Args:
+                dispatcher: объект telegram.ext.Dispatcher, из памяти
+                    которого выгружаются user_data и chat_data.
+
+            Returns:
+                Возвращает кортеж (выгружено из памяти, удалено диалогов).
+        """
+
+        self.flushPending()
+        now = time.time()
+
+        unloaded = 0
+        for kind, store in (("user", dispatcher.user_data), ("chat", dispatcher.chat_data)):
+            with self._lock:
+                seen = {entryId: self._lastSeen.get((kind, entryId), 0) for entryId in list(store)}
+            # Недавно обновленные данные не трогаем: их может менять работающий обработчик
+            ordered = sorted(seen, key=seen.get)
+            excess = max(0, len(ordered) - self.maxEntries)
+            for position, entryId in enumerate(ordered):
+                idle = now - seen[entryId]
+                if (idle > self.idleTimeout or position < excess) and idle > 60:
+                    store.pop(entryId, None)
+                    with self._lock:
+                        self._lastSeen.pop((kind, entryId), None)
+                    unloaded += 1
+
+        expired = 0
+        since = now - self.ttl
+        for (name, key), updated in list(self._conversationSeen.items()):
+            if updated < since:
+                self._conversations.get(name, {}).pop(key, None)
+                with self._lock:
+                    self._conversationSeen.pop((name, key), None)
+                expired += 1
+
+        with self._dbLock, self._connection:
+            self._connection.execute("DELETE FROM data WHERE updated < ?;", (since,))
+            self._connection.execute("DELETE FROM conversations WHERE updated < ?;", (since,))
+
+        if unloaded or expired:
+            logging.info("Выгружено из памяти записей: %s, удалено устаревших диалогов: %s", unloaded, expired)
+        return unloaded, expired
+
+    def flush(self):
+        self.flushPending()
@@ -0,0 +1,144 @@
+# /bin/bash
+""" Проверки SQLitePersistence на настоящем ConversationHandler
+
+    Запуск: python -m unittest test_persistence
+"""
+import os
+import json
+import pickle
+import sqlite3
+import tempfile
+import threading
+import unittest
+from queue import Queue
+
+from telegram import Bot, Update, User
+from telegram.ext import CommandHandler, ConversationHandler, Dispatcher, Filters, MessageHandler
+
+from persistence import SQLitePersistence
+
+CHAT_ID = 5
+
+
+class OfflineBot(Bot):
+    """ Бот, который знает себя без запроса getMe к Telegram """
+
+    def get_me(self, timeout=None, api_kwargs=None):
+        self._bot = User(id=123456, first_name="test", is_bot=True, username="test_bot")
+        return self._bot
+
+
+def makeUpdate(bot, updateId: int, text: str):
+    message = {"message_id": updateId, "date": 0, "text": text,
+               "chat": {"id": CHAT_ID, "type": "private"},
+               "from": {"id": CHAT_ID, "is_bot": False, "first_name": "user"}}
+    if text.startswith("/"):
+        message["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text)}]
+    return Update.de_json({"update_id": updateId, "message": message}, bot)
+
+
+class SQLitePersistenceTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, "state.sqlite3")
+        self.persistence = SQLitePersistence(self.path)
+        self.bot = OfflineBot("123456:TEST")
+        self.dispatcher = Dispatcher(self.bot, Queue(), workers=2, persistence=self.persistence)
+
+        self.answerStarted = threading.Event()
+        self.answerRelease = threading.Event()
+        self.waitingRelease = threading.Event()
+
+        def start(update, context):
+            return "answer"
+
+        def answer(update, context):
+            self.answerStarted.set()
+            self.answerRelease.wait(5)
+            return "done"
+
+        def waiting(update, context):
+            self.waitingRelease.wait(5)
+
+        self.conversation = ConversationHandler(
+            entry_points=[CommandHandler("start", start)],
+            states={
+                "answer": [MessageHandler(Filters.text, answer, run_async=True)],
+                ConversationHandler.WAITING: [MessageHandler(Filters.text, waiting, run_async=True)],
+            },
+            fallbacks=[],
+            name="test",
+            persistent=True,
+        )
+        self.dispatcher.add_handler(self.conversation)
+
+        # Потоки для run_async запускает только работающий диспетчер
+        ready = threading.Event()
+        self.thread = threading.Thread(target=self.dispatcher.start, args=(ready,), daemon=True)
+        self.thread.start()
+        self.assertTrue(ready.wait(5))
+
+    def tearDown(self):
+        self.answerRelease.set()
+        self.waitingRelease.set()
+        self.dispatcher.stop()
+        self.thread.join(5)
+        self.persistence._connection.close()
+        self.directory.cleanup()
+
+    def storedState(self):
+        connection = sqlite3.connect(self.path)
+        try:
+            row = connection.execute("SELECT state FROM conversations WHERE name = ? AND key = ?;",
+                                     ("test", json.dumps([CHAT_ID, CHAT_ID]))).fetchone()
+        finally:
+            connection.close()
+        return pickle.loads(row[0]) if row else None
+
+    def startNestedPromises(self):
+        # Второе сообщение приходит, пока обрабатывается первое, и попадает в WAITING:
+        # состояние становится ((answer, Promise), Promise)
+        self.dispatcher.process_update(makeUpdate(self.bot, 1, "/start"))
+        self.dispatcher.process_update(makeUpdate(self.bot, 2, "first"))
+        self.assertTrue(self.answerStarted.wait(5))
+        self.dispatcher.process_update(makeUpdate(self.bot, 3, "second"))
+        state = self.conversation.conversations[(CHAT_ID, CHAT_ID)]
+        self.assertIsInstance(state[0], tuple)
+        return state
+
+    def testNestedPromiseStateIsUnwrapped(self):
+        state = self.startNestedPromises()
+
+        self.persistence.flushPending()
+        self.assertEqual(self.storedState(), "answer")
+
+        self.answerRelease.set()
+        self.waitingRelease.set()
+        self.assertTrue(state[0][1].done.wait(5))
+        self.assertTrue(state[1].done.wait(5))
+
+        self.persistence.flushPending()
+        self.assertEqual(self.storedState(), "done")
+        self.assertEqual(self.persistence._pendingConversations, {})
+
+    def testFailedWriteKeepsBatch(self):
+        self.dispatcher.process_update(makeUpdate(self.bot, 1, "/start"))
+        pending = dict(self.persistence._pendingConversations)
+        self.assertTrue(pending)
+
+        connection = self.persistence._connection
+        self.persistence._connection = sqlite3.connect(":memory:", check_same_thread=False)
+        try:
+            with self.assertRaises(sqlite3.OperationalError):
+                self.persistence.flushPending()
+        finally:
+            self.persistence._connection.close()
+            self.persistence._connection = connection
+        self.assertEqual(self.persistence._pendingConversations, pending)
+
+        self.persistence.flushPending()
+        self.assertEqual(self.storedState(), "answer")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,20 +1,290 @@
 # /bin/bash
+import io
 import os
 import re
+import gzip
+import html
+import hashlib
+import json
+import math
+import select
+import shlex
+import string
+import time
+import queue
+import atexit
 import logging
+import importlib
+import threading
+import contextvars
+from array import array
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler, TimedRotatingFileHandler
+from contextlib import contextmanager, closing
+from uuid import uuid4
+from collections import namedtuple, OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
-import paramiko
-from dotenv import load_dotenv
+from config import getConfig
+from metrics import (CallbackMetric, SSH_CONNECT_SECONDS, SSH_EXEC_SECONDS, SSH_ERRORS,
+                     DB_QUERY_SECONDS, DB_CHECKOUT_SECONDS, DB_ERRORS, RATE_LIMITED, STARTUP)
 
-import psycopg2
-from psycopg2 import Error
 
+# Загружает .env до чтения настроек подсистем ниже
+with STARTUP.phase("config"):
+    getConfig()
 
-logging.basicConfig(
-        filename='logfile.txt',
-        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-        level=logging.INFO
-    )
+
+class LazyModule:
+    """ Модуль, импортируемый при первом обращении к его атрибутам
+
+        paramiko и psycopg2 импортируются долго, а нужны только при
+        первой команде, обращающейся к серверу или БД. Время импорта
+        попадает в отчет о запуске (STARTUP).
+
+        Args:
+            name: полное имя модуля.
+    """
+
+    def __init__(self, name: str):
+        self._name = name
+        self._module = None
+        self._lock = threading.Lock()
+
+    def _load(self):
+        if self._module is None:
+            with self._lock:
+                if self._module is None:
+                    started = time.perf_counter()
+                    module = importlib.import_module(self._name)
+                    STARTUP.record(f"import {self._name}", time.perf_counter() - started)
+                    self._module = module
+        return self._module
+
+    def __getattr__(self, name: str):
+        return getattr(self._load(), name)
+
+
+paramiko = LazyModule("paramiko")
+psycopg2 = LazyModule("psycopg2")
+psycopg2Pool = LazyModule("psycopg2.pool")
+
+# Контекст текущего запроса (команда, пользователь), добавляемый ко всем
+# записям лога, сделанным при его обработке
+logContext = contextvars.ContextVar("logContext", default={})
+
+
+class ContextFilter(logging.Filter):
+    """ Добавляет к записи лога поля из logContext """
+
+    def filter(self, record):
+        for key, value in logContext.get().items():
+            if not hasattr(record, key):
+                setattr(record, key, value)
+        return True
+
+
+class JsonFormatter(logging.Formatter):
+    """ Форматирует запись лога в одну строку JSON
+
+        Помимо времени, уровня, логгера и сообщения в запись попадают
+        поля из FIELDS, если они переданы через extra или logContext.
+    """
+
+    FIELDS = ("command", "userId", "duration", "backend", "query", "host")
+
+    def format(self, record):
+        data = {
+            "time": self.formatTime(record),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        for field in self.FIELDS:
+            value = getattr(record, field, None)
+            if value is not None:
+                data[field] = value
+        if record.exc_info:
+            data["exception"] = self.formatException(record.exc_info)
+        return json.dumps(data, ensure_ascii=False)
+
+
+_logListener = None
+_logHandler = None
+
+
+def setupLogging(logQueue=None):
+    """ Настраивает асинхронное логирование в JSON с ротацией файла
+
+        Записи из потоков обработчиков кладутся в очередь, а в файл
+        LOG_FILE их пишет отдельный поток QueueListener. Файл
+        ротируется по размеру (LOG_ROTATE=size, LOG_MAX_BYTES) или по
+        времени (LOG_ROTATE=time, LOG_WHEN); хранится LOG_BACKUP_COUNT
+        старых файлов. Повторный вызов ничего не делает.
+
+        Args:
+            logQueue: межпроцессная очередь, в которую отправляются
+                записи вместо файла; их пишет в LOG_FILE процесс,
+                вызвавший forwardLogs(). Так ротацией файла занимается
+                только один процесс.
+    """
+
+    global _logListener, _logHandler
+    if _logHandler is not None:
+        return
+
+    if logQueue is None:
+        filename = os.getenv("LOG_FILE", "logfile.txt")
+        backupCount = int(os.getenv("LOG_BACKUP_COUNT", 5))
+        if os.getenv("LOG_ROTATE", "size") == "time":
+            fileHandler = TimedRotatingFileHandler(filename, when=os.getenv("LOG_WHEN", "midnight"),
+                                                   backupCount=backupCount, encoding="utf-8")
+        else:
+            fileHandler = RotatingFileHandler(filename, maxBytes=int(os.getenv("LOG_MAX_BYTES", 10 * 1024 * 1024)),
+                                              backupCount=backupCount, encoding="utf-8")
+        fileHandler.setFormatter(JsonFormatter())
+
+        localQueue = queue.Queue()
+        _logListener = QueueListener(localQueue, fileHandler, respect_handler_level=True)
+        _logListener.start()
+        atexit.register(_logListener.stop)
+        _logHandler = QueueHandler(localQueue)
+    else:
+        _logHandler = QueueHandler(logQueue)
+    _logHandler.addFilter(ContextFilter())
+
+    root = logging.getLogger()
+    root.setLevel(logging.INFO)
+    root.addHandler(_logHandler)
+
+
+def forwardLogs(logQueue):
+    """ Пишет в LOG_FILE записи, которые другие процессы отправляют в logQueue
+
+        Args:
+            logQueue: межпроцессная очередь, переданная в setupLogging() других процессов.
+
+        Returns:
+            Возвращает запущенный QueueListener; его stop() дописывает
+            оставшиеся записи.
+    """
+
+    setupLogging()
+    listener = QueueListener(logQueue, *_logListener.handlers, respect_handler_level=True)
+    listener.start()
+    return listener
+
+
+# Шаблоны компилируются один раз при импорте и объединены в одно
+# выражение, чтобы email-ы и телефонные номера находились за один проход
+EMAIL_PATTERN = r"(?<!\w)\w[-.\w]*@[-.\w]+\.[a-zA-Z]{2,}"
+PHONE_PATTERN = r"(?:8|\+7)[ -]?\(?(?P<code>\d{3})\)?[ -]?(?P<first>\d{3})[ -]?(?P<second>\d{2})[ -]?(?P<third>\d{2})"
+contactsRegex = re.compile(rf"(?P<email>{EMAIL_PATTERN})|(?P<phone>{PHONE_PATTERN})")
+
+
+class TextExtractor:
+    """ Однопроходный поиск email-ов и телефонных номеров в тексте
+
+        Текст можно передавать целиком или частями через feed(), например
+        при чтении большого файла. Найденные значения нормализуются
+        (номер приводится к виду '+7 XXX-XXX-XX-XX', домен email-а к
+        нижнему регистру) и сразу дедуплицируются с сохранением порядка.
+        Чтобы не потерять совпадение на границе частей, последние overlap
+        символов каждой части переносятся в следующую.
+
+        Args:
+            overlap: длина переносимого между частями хвоста текста.
+    """
+
+    def __init__(self, overlap: int = 1024):
+        self.overlap = overlap
+        self.emails = {}
+        self.phoneNumbers = {}
+        self._carry = ""
+
+    def _collect(self, match):
+        if match.lastgroup == "email":
+            local, _, domain = match.group("email").strip().rpartition("@")
+            self.emails.setdefault(f"{local}@{domain.lower()}", None)
+        else:
+            number = "+7 " + "-".join(match.group("code", "first", "second", "third"))
+            self.phoneNumbers.setdefault(number, None)
+
+    def scan(self, text: str):
+        """ Ищет совпадения в готовом тексте без копирования и разбиения """
+
+        for match in contactsRegex.finditer(text):
+            self._collect(match)
+        return self
+
+    def feed(self, chunk: str):
+        """ Обрабатывает очередную часть текста """
+
+        buffer = self._carry + chunk
+        limit = len(buffer) - self.overlap
+        lastEnd = 0
+
+        # Переносится только хвост длиной overlap либо совпадение, пересекающее его границу
+        for match in contactsRegex.finditer(buffer):
+            if match.end() > limit:
+                cut = match.start()
+                break
+            self._collect(match)
+            lastEnd = match.end()
+        else:
+            cut = max(lastEnd, limit)
+
+        self._carry = buffer[cut:]
+        return self
+
+    def finish(self):
+        """ Обрабатывает оставшийся хвост текста после последней части """
+
+        self.scan(self._carry)
+        self._carry = ""
+        return self
+
+    def numberedEmails(self):
+        return tuple(enumerate(self.emails, 1)) or None
+
+    def numberedPhoneNumbers(self):
+        return tuple(enumerate(self.phoneNumbers, 1)) or None
+
+
+# Результаты extractContacts для последних текстов по их SHA-256
+CONTACTS_CACHE_SIZE = 4
+_contactsCache = OrderedDict()
+_contactsCacheLock = threading.Lock()
+
+
+def extractContacts(text: str):
+    """ Находит в тексте email-ы и телефонные номера за один проход
+
+        Результат для последних текстов кэшируется по хэшу текста (сам
+        текст в кэше не хранится), поэтому команды '/find_email' и
+        '/find_phone_number' для одного и того же текста сканируют его
+        один раз.
+
+        Args:
+            text: исходный текст для поиска.
+
+        Returns:
+            Возвращает кортеж (email-ы, телефонные номера) в виде
+            нумерованных неизменяемых кортежей или None при их отсутствии.
+    """
+
+    key = hashlib.sha256(text.encode("utf-8", "surrogatepass")).digest()
+    with _contactsCacheLock:
+        if key in _contactsCache:
+            _contactsCache.move_to_end(key)
+            return _contactsCache[key]
+
+    extractor = TextExtractor().scan(text)
+    result = extractor.numberedEmails(), extractor.numberedPhoneNumbers()
+    with _contactsCacheLock:
+        _contactsCache[key] = result
+        while len(_contactsCache) > CONTACTS_CACHE_SIZE:
+            _contactsCache.popitem(last=False)
+    return result
 
 
 def findPhoneNumbers(text: str):
@@ -24,6 +294,7 @@ def findPhoneNumbers(text: str):
         Подходят следующие шаблоны и некоторые из их комбинаций:
         8XXXXXXXXXX, 8(XXX)XXXXXXX, 8 XXX XXX XX XX,
         8 (XXX) XXX XX XX, 8-XXX-XXX-XX-XX.
+        Повторяющиеся номера выводятся один раз.
 
         Args:
             text: исходный текст для поиска номеров телефонов.
@@ -35,20 +306,9 @@ def findPhoneNumbers(text: str):
 
             1. +7 090-034-51-21
             2. +7 123-456-78-90
-            3. +7 123-456-78-90
     """
 
-    phoneNumRegex = re.compile(r"(8|\+7)[ -]?\(?(\d{3})\)?[ -]?(\d{3})[ -]?(\d{2})[ -]?(\d{2})")
-    phoneNumberList = phoneNumRegex.findall(text)
-
-    if phoneNumberList:
-        numbersList = []
-        for i in range(len(phoneNumberList)):
-            numbersList.append((i + 1, "+7 " + '-'.join(phoneNumberList[i][1:])))
-
-        return numbersList
-    else:
-        return None
+    return extractContacts(text)[1]
 
 
 def findEmails(text: str):
@@ -58,6 +318,7 @@ def findEmails(text: str):
         mail@mail.com, mail.mail@mail.com, mail.mail.mail@mail.com,
         mail123_mail123@mail.com, ... ,
         mail456-mail789@mail.com, ... .
+        Повторяющиеся email-ы выводятся один раз.
 
         Args:
             text: исходный текст для поиска email-ов.
@@ -68,21 +329,449 @@ def findEmails(text: str):
             Пример:
 
             1. mn.commbiuib@mn.com
-            2. mn.commbiuib@mn.com
-            3. mn.comm876biuib@mn.com
+            2. mn.comm876biuib@mn.com
     """
 
-    emailRegex = re.compile(r"\w+[-.\w]*@[-.\w]+\.[a-zA-Z]{2,}")
-    emailsList = emailRegex.findall(text)
+    return extractContacts(text)[0]
 
-    if emailsList:
-        emails = []
-        for i in range(len(emailsList)):
-            emails.append((i + 1, emailsList[i].strip()))
 
-        return emails
-    else:
+# Максимальная длина одного сообщения Telegram
+MESSAGE_LIMIT = 4096
+
+
+def decodeOutput(data: bytes):
+    """ Декодирует вывод удаленной команды в текст
+
+        Вывод декодируется как UTF-8, а если это не удалось, в
+        кодировке RM_ENCODING (по умолчанию cp1251) с заменой
+        некорректных байтов.
+
+        Args:
+            data: вывод команды; строка возвращается без изменений.
+
+        Returns:
+            Возвращает строку с выводом команды.
+    """
+
+    if isinstance(data, str):
+        return data
+    try:
+        return data.decode("utf-8")
+    except UnicodeDecodeError:
+        return data.decode(os.getenv("RM_ENCODING", "cp1251"), errors="replace")
+
+
+def formatTable(text: str):
+    """ Выравнивает табличный вывод команд (df, free, ps, ss) по колонкам
+
+        Количество колонок определяется по самому частому числу полей
+        в строках данных (без заголовка), при равенстве - большее.
+        Последняя колонка забирает остаток строки как есть, поэтому
+        'Mounted on' в заголовке df и пути с пробелами не разбиваются.
+        Заголовку с меньшим числом полей (как у free) пустые ячейки
+        добавляются слева, остальным строкам справа.
+
+        Args:
+            text: вывод команды.
+
+        Returns:
+            Возвращает выровненный текст.
+    """
+
+    lines = [line for line in text.splitlines() if line.strip()]
+    if not lines:
+        return text
+
+    counts = {}
+    for line in lines[1:] or lines:
+        fields = len(line.split())
+        counts[fields] = counts.get(fields, 0) + 1
+    columns = max(counts, key=lambda count: (counts[count], count))
+
+    cells = []
+    for index, line in enumerate(lines):
+        row = line.split(None, columns - 1)
+        if len(row) < columns and index == 0:
+            row = [""] * (columns - len(row)) + row
+        elif len(row) < columns:
+            row = row + [""] * (columns - len(row))
+        cells.append(row)
+
+    widths = [max(len(row[i]) for row in cells) for i in range(columns - 1)]
+    return "\n".join((" ".join(cell.ljust(width) for cell, width in zip(row, widths)) + " " + row[-1]).rstrip()
+                     for row in cells)
+
+
+def splitMessage(text: str, limit: int = MESSAGE_LIMIT, escape=None):
+    """ Разбивает текст на части не длиннее limit символов
+
+        Текст делится по границам строк; строки длиннее limit делятся
+        принудительно. Если задана функция escape (например,
+        html.escape), длина частей считается после экранирования, и
+        части возвращаются уже экранированными.
+
+        Args:
+            text: исходный текст.
+            limit: максимальная длина части.
+            escape: посимвольная функция экранирования или None.
+
+        Returns:
+            Возвращает список частей текста.
+    """
+
+    measure = len if escape is None else (lambda piece: len(escape(piece)))
+    parts = []
+    part = ""
+    size = 0
+    for line in text.splitlines(keepends=True):
+        lineSize = measure(line)
+        while lineSize > limit:
+            if part:
+                parts.append(part)
+                part, size = "", 0
+            end, used = 0, 0
+            for char in line:
+                charSize = measure(char)
+                if used + charSize > limit:
+                    break
+                end += 1
+                used += charSize
+            end = max(end, 1)
+            parts.append(line[:end])
+            lineSize -= measure(line[:end])
+            line = line[end:]
+        if size + lineSize > limit:
+            parts.append(part)
+            part, size = "", 0
+        part += line
+        size += lineSize
+    if part:
+        parts.append(part)
+    if escape is not None:
+        parts = [escape(part) for part in parts]
+    return parts
+
+
+def renderOutput(data: bytes, table: bool = False, title: str = None):
+    """ Готовит вывод удаленной команды к отправке в Telegram
+
+        Вывод декодируется один раз, при table=True выравнивается по
+        колонкам и оформляется моноширинным блоком <pre>, после чего
+        делится на сообщения, помещающиеся в лимит Telegram с учетом
+        HTML-экранирования.
+
+        Args:
+            data: вывод команды.
+            table: вывод является таблицей.
+            title: заголовок первого сообщения, например имя хоста.
+
+        Returns:
+            Возвращает список пар (текст сообщения, parse_mode).
+    """
+
+    text = decodeOutput(data)
+    if not text.strip():
+        text = "Вывод пуст"
+        table = False
+
+    if not table:
+        if title:
+            text = f"{title}\n{text}"
+        return [(part, None) for part in splitMessage(text)]
+
+    text = formatTable(text)
+    header = f"<b>{html.escape(title)}</b>\n" if title else ""
+    # длина частей считается после экранирования, с запасом под теги <pre></pre> и заголовок
+    parts = splitMessage(text, MESSAGE_LIMIT - len("<pre></pre>") - len(header), escape=html.escape)
+    messages = [(f"<pre>{part}</pre>", "HTML") for part in parts]
+    messages[0] = (header + messages[0][0], "HTML")
+    return messages
+
+
+Filesystem = namedtuple("Filesystem", ["device", "size", "used", "available", "usePercent", "mountPoint"])
+MemoryInfo = namedtuple("MemoryInfo", ["kind", "total", "used", "free", "shared", "buffCache", "available"])
+CpuStat = namedtuple("CpuStat", ["cpu", "usr", "sys", "iowait", "idle"])
+Socket = namedtuple("Socket", ["netid", "state", "recvQ", "sendQ", "local", "peer", "process"])
+Process = namedtuple("Process", ["pid", "user", "cpu", "memory", "command"])
+
+_SIZE_UNITS = {"": 1, "B": 1, "K": 1 << 10, "M": 1 << 20, "G": 1 << 30, "T": 1 << 40, "P": 1 << 50}
+_sizeRegex = re.compile(r"^([\d.,]+)\s*([KMGTP]?)i?B?$", re.IGNORECASE)
+
+
+def parseSize(value: str):
+    """ Переводит размер вида '1.9Gi', '512M', '0B' или '1024' в байты
+
+        Returns:
+            Возвращает размер в байтах или None, если значение не распознано.
+    """
+
+    match = _sizeRegex.match(value.strip())
+    if not match:
+        return None
+    return int(float(match.group(1).replace(",", ".")) * _SIZE_UNITS[match.group(2).upper()])
+
+
+def parseDf(text: str):
+    """ Разбирает вывод 'df' на список Filesystem
+
+        size, used и available остаются в единицах вывода df
+        (по умолчанию 1K-блоки), usePercent - целое число процентов.
+    """
+
+    filesystems = []
+    for line in text.splitlines()[1:]:
+        fields = line.split(None, 5)
+        if len(fields) < 6 or not fields[4].endswith("%"):
+            continue
+        device, size, used, available, usePercent, mountPoint = fields
+        filesystems.append(Filesystem(device, int(size) if size.isdigit() else parseSize(size),
+                                      int(used) if used.isdigit() else parseSize(used),
+                                      int(available) if available.isdigit() else parseSize(available),
+                                      int(usePercent.rstrip("%")), mountPoint))
+    return filesystems
+
+
+def parseFree(text: str):
+    """ Разбирает вывод 'free' (в том числе 'free -h') на список MemoryInfo
+
+        Размеры переводятся в байты (для 'free' без ключей - из КиБ);
+        отсутствующие у Swap колонки равны None.
+    """
+
+    lines = [line.split() for line in text.splitlines() if line.strip()]
+    if not lines:
+        return []
+
+    header = lines[0]
+    columns = {"total": "total", "used": "used", "free": "free", "shared": "shared",
+               "buff/cache": "buffCache", "buffers": "buffCache", "available": "available"}
+    records = []
+    for row in lines[1:]:
+        if not row[0].endswith(":"):
+            continue
+        values = dict.fromkeys(MemoryInfo._fields)
+        values["kind"] = row[0].rstrip(":")
+        for name, value in zip(header, row[1:]):
+            if name in columns:
+                size = int(value) * 1024 if value.isdigit() else parseSize(value)
+                values[columns[name]] = size
+        records.append(MemoryInfo(**values))
+    return records
+
+
+def parseMpstat(text: str):
+    """ Разбирает вывод 'mpstat' или 'mpstat -P ALL' на список CpuStat
+
+        Колонки определяются по заголовку и сопоставляются с конца
+        строки, поэтому формат времени (с AM/PM или без) и строки
+        'Average:' не мешают разбору. При наличии строк 'Average:'
+        используются они.
+    """
+
+    header = None
+    stats = {}
+    for line in text.splitlines():
+        fields = line.split()
+        if "%idle" in fields and "CPU" in fields:
+            header = fields
+            continue
+        if header is None or len(fields) < 5:
+            continue
+
+        offset = len(fields) - len(header)
+        value = lambda name: fields[header.index(name) + offset]
+        try:
+            stat = CpuStat(value("CPU"), float(value("%usr")), float(value("%sys")),
+                           float(value("%iowait")), float(value("%idle")))
+        except (ValueError, IndexError):
+            continue
+        if fields[0].startswith("Average") or stat.cpu not in stats:
+            stats[stat.cpu] = stat
+    return list(stats.values())
+
+
+def parseSs(text: str):
+    """ Разбирает вывод 'ss' (например 'ss -tuln') на список Socket
+
+        Если в выводе нет колонки Netid, netid равен None.
+    """
+
+    sockets = []
+    lines = text.splitlines()
+    if not lines:
+        return sockets
+
+    hasNetid = lines[0].split()[:1] == ["Netid"]
+    for line in lines[1:]:
+        fields = line.split()
+        if not hasNetid:
+            fields = [None] + fields
+        if len(fields) < 6:
+            continue
+        netid, state, recvQ, sendQ, local, peer = fields[:6]
+        process = " ".join(fields[6:]) or None
+        sockets.append(Socket(netid, state, int(recvQ), int(sendQ), local, peer, process))
+    return sockets
+
+
+def parsePs(text: str):
+    """ Разбирает вывод 'ps -eo pid,user,pcpu,pmem,comm' на список Process """
+
+    processes = []
+    for line in text.splitlines()[1:]:
+        fields = line.split(None, 4)
+        if len(fields) < 5:
+            continue
+        try:
+            processes.append(Process(int(fields[0]), fields[1], float(fields[2]), float(fields[3]), fields[4]))
+        except ValueError:
+            continue
+    return processes
+
+
+# Пороги для предупреждений о состоянии сервера
+ALERT_THRESHOLDS = {
+    "diskUsePercent": int(os.getenv("ALERT_DISK_PERCENT", 90)),
+    "memoryUsePercent": int(os.getenv("ALERT_MEMORY_PERCENT", 90)),
+    "cpuIdlePercent": float(os.getenv("ALERT_CPU_IDLE_PERCENT", 10)),
+}
+
+
+def dfAlerts(filesystems: list):
+    """ Возвращает предупреждения о файловых системах, заполненных выше порога """
+
+    limit = ALERT_THRESHOLDS["diskUsePercent"]
+    return [f"⚠ {fs.mountPoint} ({fs.device}) заполнена на {fs.usePercent}%"
+            for fs in sorted(filesystems, key=lambda fs: fs.usePercent, reverse=True)
+            if fs.usePercent >= limit]
+
+
+def memoryUsePercent(record: MemoryInfo):
+    """ Возвращает процент использованной памяти или None, если total равен нулю
+
+        Для Mem учитывается available, то есть кэш считается свободным.
+    """
+
+    if not record.total:
         return None
+    used = record.total - record.available if record.available is not None else record.used
+    return used * 100 / record.total
+
+
+def memoryAlerts(records: list):
+    """ Возвращает предупреждения об использовании памяти выше порога """
+
+    limit = ALERT_THRESHOLDS["memoryUsePercent"]
+    alerts = []
+    for record in records:
+        percent = memoryUsePercent(record)
+        if percent is not None and percent >= limit:
+            alerts.append(f"⚠ {record.kind}: использовано {percent:.0f}%")
+    return alerts
+
+
+def cpuAlerts(stats: list):
+    """ Возвращает предупреждения о процессорах с простоем ниже порога """
+
+    limit = ALERT_THRESHOLDS["cpuIdlePercent"]
+    return [f"⚠ CPU {stat.cpu}: простой {stat.idle:.1f}%" for stat in stats if stat.idle <= limit]
+
+
+# Расширения файлов, которые можно просканировать на email-ы и номера
+SCANNABLE_EXTENSIONS = (".txt", ".csv", ".log", ".gz")
+
+
+@contextmanager
+def openTextFile(path: str):
+    """ Открывает файл на чтение как текст UTF-8, распаковывая gzip на лету
+
+        Некорректные UTF-8 последовательности заменяются.
+
+        Yields:
+            Кортеж (исходный бинарный файл для отслеживания прогресса, текстовый поток).
+    """
+
+    with open(path, "rb") as raw:
+        gzipped = raw.read(2) == b"\x1f\x8b"
+        raw.seek(0)
+        stream = gzip.GzipFile(fileobj=raw) if gzipped else raw
+        yield raw, io.TextIOWrapper(stream, encoding="utf-8", errors="replace", newline="")
+
+
+def scanFileForContacts(path: str, progress=None, chunkSize: int = 1 << 20):
+    """ Ищет email-ы и телефонные номера в файле, читая его частями
+
+        Память ограничена размером части, а не размером файла.
+        Сжатые gzip файлы распаковываются на лету; некорректные
+        UTF-8 последовательности заменяются.
+
+        Args:
+            path: путь к файлу.
+            progress: функция progress(прочитано байт, всего байт),
+                вызываемая после каждой части.
+            chunkSize: количество символов в одной части.
+
+        Returns:
+            Возвращает TextExtractor с найденными значениями.
+    """
+
+    total = os.path.getsize(path)
+    extractor = TextExtractor()
+
+    with openTextFile(path) as (raw, reader):
+        while True:
+            chunk = reader.read(chunkSize)
+            if not chunk:
+                break
+            extractor.feed(chunk)
+            if progress is not None:
+                progress(raw.tell(), total)
+
+    return extractor.finish()
+
+
+# Классы символов пароля и размеры их алфавитов для оценки энтропии.
+# 'special' - спецсимволы, обязательные для сложного пароля, 'symbol' -
+# остальные печатные ASCII-символы, 'other' - символы вне ASCII.
+PASSWORD_SPECIALS = "!@#$%^&*()"
+PASSWORD_CLASSES = (
+    ("lower", frozenset(string.ascii_lowercase)),
+    ("upper", frozenset(string.ascii_uppercase)),
+    ("digit", frozenset(string.digits)),
+    ("special", frozenset(PASSWORD_SPECIALS)),
+    ("symbol", frozenset(string.punctuation + " ") - frozenset(PASSWORD_SPECIALS)),
+)
+PASSWORD_ASCII = frozenset().union(*(alphabet for _, alphabet in PASSWORD_CLASSES))
+CHARSET_SIZES = {name: len(alphabet) for name, alphabet in PASSWORD_CLASSES}
+CHARSET_SIZES["other"] = 100
+REQUIRED_CLASSES = ("lower", "upper", "digit", "special")
+
+PasswordScore = namedtuple("PasswordScore", ["length", "classes", "entropy", "strong", "common"])
+
+
+def scorePassword(password: str, common=None):
+    """ Оценивает пароль за один проход по его символам
+
+        Args:
+            password: исходный пароль.
+            common: множество распространенных паролей (CommonPasswords) или None.
+
+        Returns:
+            Возвращает PasswordScore: длина, классы символов, энтропия в
+            битах (длина * log2 размера алфавита), соответствие требованиям
+            verifyPassword и наличие в списке распространенных паролей.
+    """
+
+    chars = set(password)
+    classes = frozenset(name for name, alphabet in PASSWORD_CLASSES if not chars.isdisjoint(alphabet))
+    if not chars <= PASSWORD_ASCII:
+        classes |= {"other"}
+
+    pool = sum(CHARSET_SIZES[name] for name in classes)
+    entropy = len(password) * math.log2(pool) if pool else 0.0
+    strong = len(password) >= 8 and all(name in classes for name in REQUIRED_CLASSES)
+    isCommon = common is not None and (password in common or password.lower() in common)
+    return PasswordScore(len(password), classes, entropy, strong, isCommon)
 
 
 def verifyPassword(password: str):
@@ -102,156 +791,1958 @@ def verifyPassword(password: str):
             Возвращает строку, содержащую информацию о надежности пароля.
     """
 
-    if re.match(r'(?=.{8,})(?=.*[0-9])(?=.*[a-z])(?=.*[A-Z])(?=.*[!@#$%^&*()])', password):
+    if scorePassword(password.split("\n", 1)[0]).strong:
         return "Пароль сложный!"
     else:
         return "Пароль простой!"
 
 
-def remoteCmdExecutionBySSH(command: str):
-    """ Осуществляет удаленное выполнение команды
+class CommonPasswords:
+    """ Компактное множество распространенных паролей
 
-        Подключается к серверу по SSH, выполняет заданную команду
-        и возврщает ее вывод.
+        Пароли хранятся отсортированными в одном bytes-буфере, а их
+        смещения - в array, поэтому память примерно равна размеру
+        исходного списка. Поиск - двоичный, O(log n).
 
         Args:
-            command: команда для удаленного выполнения на сервере.
-
-        Returns:
-            Возвращает строку, содержащую вывод команды 'stdout+stderr'
+            passwords: итерируемый набор паролей.
     """
 
-    load_dotenv()
-    host = os.getenv("RM_HOST")
-    port = int(os.getenv("RM_PORT"))
-    username = os.getenv("RM_USER")
-    password = os.getenv("RM_PASSWORD")
+    def __init__(self, passwords):
+        items = sorted({password.encode("utf-8") for password in passwords if password})
+        self._data = b"".join(items)
+        self._offsets = array("Q", [0])
+        for item in items:
+            self._offsets.append(self._offsets[-1] + len(item))
 
-    client = paramiko.SSHClient()
-    client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-    client.connect(hostname=host, username=username, password=password, port=port)
-    stdin, stdout, stderr = client.exec_command(command)
-    data = stdout.read() + stderr.read()
-    client.close()
-    return data
+    @classmethod
+    def load(cls, path: str):
+        """ Загружает список паролей по одному в строке (в том числе .gz) """
 
+        if not os.path.exists(path):
+            return cls(())
+        with openTextFile(path) as (_, reader):
+            return cls(line.rstrip("\r\n") for line in reader)
 
-def getAllRowFromDBTable(table: str):
-    """ Возвращает все строки из таблицы table
+    def __len__(self):
+        return len(self._offsets) - 1
 
-        Args:
-            table: таблица, из которой получаются записи.
+    def __contains__(self, password: str):
+        key = password.encode("utf-8")
+        low, high = 0, len(self)
+        while low < high:
+            middle = (low + high) // 2
+            item = self._data[self._offsets[middle]:self._offsets[middle + 1]]
+            if item == key:
+                return True
+            if item < key:
+                low = middle + 1
+            else:
+                high = middle
+        return False
 
-        Returns:
-            Возвращает строку, содержащую записи
-            Например:
 
-            1: +7 090-034-51-21
-            2: +7 123-456-78-90
-            3: +7 888-456-78-90
-    """
+_commonPasswords = None
+_commonPasswordsLock = threading.Lock()
 
-    message = ""
-    connection = None
-    cursor = None
 
-    try:
-        connection = psycopg2.connect(user=os.getenv("DB_USER"),
-                                      password=os.getenv("DB_PASSWORD"),
-                                      host=os.getenv("DB_HOST"),
-                                      port=os.getenv("DB_PORT"),
-                                      database=os.getenv("DB_DATABASE"))
-
-        cursor = connection.cursor()
-        cursor.execute(f"SELECT * FROM {table};")
-        data = cursor.fetchall()
-        for row in data:
-            message += f"{row[0]}: {row[1]}\n"
-        logging.info("Команда успешно выполнена")
-    except (Exception, Error) as error:
-        message = "Ошибка при работе с PostgreSQL"
-        logging.error("Ошибка при работе с PostgreSQL: %s", error)
-    finally:
-        if connection is not None:
-            cursor.close()
-            connection.close()
+def getCommonPasswords():
+    """ Возвращает список распространенных паролей из COMMON_PASSWORDS_FILE, загружая его один раз """
 
-        return message
+    global _commonPasswords
+    with _commonPasswordsLock:
+        if _commonPasswords is None:
+            _commonPasswords = CommonPasswords.load(os.getenv("COMMON_PASSWORDS_FILE", "common_passwords.txt"))
+            logging.info("Загружено распространенных паролей: %s", len(_commonPasswords))
+        return _commonPasswords
 
 
-def insertInBDTable(table: str, column: str, data: str):
-    """ Производит запись указанных данных в таблицу
+# Границы корзин гистограммы энтропии в битах
+ENTROPY_BUCKETS = (28, 36, 60, 128)
 
-        Args:
-            table: таблица, в которую записываются данные.
-            column: колонка для записи.
-            data: данные для записи.
 
-        Returns:
-            Возвращает состояние успешности операции записи в БД
+class PasswordAudit:
+    """ Сводная статистика по набору паролей
+
+        Пароли добавляются по одному через add() и не сохраняются,
+        накапливаются только счетчики.
+
+        Args:
+            common: множество распространенных паролей (CommonPasswords) или None.
     """
 
-    state = False
-    connection = None
-    cursor = None
+    def __init__(self, common=None):
+        self.common = common
+        self.total = 0
+        self.strong = 0
+        self.commonCount = 0
+        self.entropySum = 0.0
+        self.entropyHistogram = [0] * (len(ENTROPY_BUCKETS) + 1)
+        self.missing = dict.fromkeys(REQUIRED_CLASSES, 0)
+        self.short = 0
 
-    try:
-        connection = psycopg2.connect(user=os.getenv("DB_USER"),
-                                      password=os.getenv("DB_PASSWORD"),
-                                      host=os.getenv("DB_HOST"),
-                                      port=os.getenv("DB_PORT"),
-                                      database=os.getenv("DB_DATABASE"))
-
-        cursor = connection.cursor()
-        cursor.execute(f"INSERT INTO {table} ({column}) VALUES ('{data}');")
-        connection.commit()
-        state = True
-        logging.info("Команда успешно выполнена")
-    except (Exception, Error) as error:
-        logging.error("Ошибка при работе с PostgreSQL: %s", error)
-    finally:
-        if connection is not None:
-            cursor.close()
-            connection.close()
-            logging.info("Соединение с PostgreSQL закрыто")
+    def add(self, password: str):
+        score = scorePassword(password, self.common)
+        self.total += 1
+        self.strong += score.strong
+        self.commonCount += score.common
+        self.entropySum += score.entropy
+        self.short += score.length < 8
+        self.entropyHistogram[sum(score.entropy >= bound for bound in ENTROPY_BUCKETS)] += 1
+        for name in REQUIRED_CLASSES:
+            if name not in score.classes:
+                self.missing[name] += 1
 
-        return state
+    def feed(self, lines):
+        """ Добавляет пароли из строк, пропуская пустые; возвращает сам объект """
 
+        for line in lines:
+            line = line.rstrip("\r\n")
+            if line:
+                self.add(line)
+        return self
 
-def rowExistsInBDTable(table: str, column: str, string: str):
-    """ Производит проверку на наличие записи в БД
+
+def auditPasswordFile(path: str, progress=None, common=None, progressLines: int = 10000):
+    """ Проверяет пароли из файла (по одному в строке), читая его построчно
 
         Args:
-            table: таблица, в которой производится проверка.
-            column: колонка с записью.
-            string: проверяемые на существование данные.
+            path: путь к файлу, возможно сжатому gzip.
+            progress: функция progress(прочитано байт, всего байт),
+                вызываемая каждые progressLines строк.
+            common: множество распространенных паролей (CommonPasswords) или None.
+            progressLines: количество строк между вызовами progress.
 
         Returns:
-            Возвращает True или False в зависимости от существования
-            записи в БД.
+            Возвращает PasswordAudit со статистикой.
     """
 
-    exists = False
-    connection = None
-    cursor = None
+    total = os.path.getsize(path)
+    audit = PasswordAudit(common)
 
-    try:
-        connection = psycopg2.connect(user=os.getenv("DB_USER"),
-                                      password=os.getenv("DB_PASSWORD"),
-                                      host=os.getenv("DB_HOST"),
-                                      port=os.getenv("DB_PORT"),
-                                      database=os.getenv("DB_DATABASE"))
-
-        cursor = connection.cursor()
-        cursor.execute(f"SELECT exists (SELECT 1 FROM {table} WHERE {column} = '{string}' LIMIT 1);")
-        data = cursor.fetchall()
-        exists = data[0][0]
-        logging.info("Команда успешно выполнена")
-    except (Exception, Error) as error:
-        logging.error("Ошибка при работе с PostgreSQL: %s", error)
-    finally:
-        if connection is not None:
-            cursor.close()
-            connection.close()
+    with openTextFile(path) as (raw, reader):
+        for number, line in enumerate(reader, 1):
+            audit.feed((line,))
+            if progress is not None and number % progressLines == 0:
+                progress(raw.tell(), total)
+
+    return audit
+
+
+# Ограничения на количество одновременных запросов к каждому бэкенду
+BACKEND_CONCURRENCY = {
+    "ssh": int(os.getenv("SSH_CONCURRENCY", 4)),
+    "db": int(os.getenv("DB_CONCURRENCY", 8)),
+    "scan": int(os.getenv("SCAN_CONCURRENCY", 2)),
+}
+
+_backendSemaphores = {backend: threading.BoundedSemaphore(limit)
+                      for backend, limit in BACKEND_CONCURRENCY.items()}
+
+# Семафоры лимитов бэкендов, занятые текущим обработчиком; admit()
+# освобождает их на время ожидания токенов
+_heldSlots = contextvars.ContextVar("heldSlots", default=())
+
+
+@contextmanager
+def backendSlot(backend: str):
+    """ Занимает одно место в лимите одновременных запросов к бэкенду
+
+        Args:
+            backend: имя бэкенда из BACKEND_CONCURRENCY ('ssh', 'db', 'scan').
+    """
+
+    semaphore = _backendSemaphores[backend]
+    with semaphore:
+        token = _heldSlots.set(_heldSlots.get() + (semaphore,))
+        try:
+            yield
+        finally:
+            _heldSlots.reset(token)
+
+
+class RateLimitExceeded(Exception):
+    """ Запрос превысил ограничение частоты
+
+        Args:
+            scope: сработавшее ограничение: 'user', 'command' или 'global'.
+            retryAfter: через сколько секунд запрос пройдет.
+    """
+
+    def __init__(self, scope: str, retryAfter: float):
+        super().__init__(f"Превышено ограничение частоты запросов ({scope}), повтор через {retryAfter:.1f} с")
+        self.scope = scope
+        self.retryAfter = retryAfter
+
+
+class RequestTooLarge(Exception):
+    """ Стоимость запроса больше, чем ограничитель частоты может пропустить когда-либо
+
+        Args:
+            maxCost: максимальная стоимость запроса в токенах.
+    """
+
+    def __init__(self, maxCost: int):
+        super().__init__(f"Слишком большой запрос, допустимо не больше {maxCost}")
+        self.maxCost = maxCost
+
+
+class TokenBucket:
+    """ Корзина токенов: rate токенов в секунду, не больше capacity
+
+        Токены можно занимать в долг (их количество становится
+        отрицательным): так последующие запросы выстраиваются в очередь
+        за уже допущенными.
+    """
+
+    __slots__ = ("rate", "capacity", "tokens", "updated")
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def refill(self, now: float):
+        if now > self.updated:
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+
+    def wait(self, cost: float):
+        """ Возвращает время в секундах, через которое в корзине будет cost токенов """
+
+        return max(0.0, (cost - self.tokens) / self.rate)
+
+
+class RateLimiter:
+    """ Ограничение частоты запросов к бэкендам на основе корзин токенов
+
+        Запрос проходит, только если токены есть сразу в трех корзинах:
+        пользователя, пары (пользователь, команда) и общей для бота.
+        Корзины пользователя и бота расходуются на стоимость запроса
+        (например, количество команд пакета), а корзина команды - на
+        один токен за запрос. Если токенов не хватает, но их ожидание
+        не дольше maxWait, запрос ставится в очередь: токены занимаются
+        в долг, и запрос ждет своей очереди. Иначе он отклоняется
+        исключением RateLimitExceeded, и токены не расходуются. Запрос
+        дороже maxCost() не пройдет никогда и отклоняется исключением
+        RequestTooLarge.
+
+        Args:
+            userRate: токенов в секунду для одного пользователя.
+            userBurst: емкость корзины пользователя.
+            globalRate: токенов в секунду для всего бота.
+            globalBurst: емкость общей корзины.
+            commandLimits: словарь {команда: (токенов в секунду, емкость)}
+                для корзин (пользователь, команда); команды не из словаря
+                ограничиваются только корзинами пользователя и бота.
+            maxWait: максимальное время ожидания в очереди в секундах.
+            maxBuckets: максимальное количество корзин пользователей и команд.
+    """
+
+    def __init__(self, userRate: float, userBurst: float, globalRate: float, globalBurst: float,
+                 commandLimits: dict = None, maxWait: float = 2, maxBuckets: int = 10000):
+        self.userRate = userRate
+        self.userBurst = userBurst
+        self.commandLimits = commandLimits or {}
+        self.maxWait = maxWait
+        self.maxBuckets = maxBuckets
+        self._global = TokenBucket(globalRate, globalBurst)
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+
+    def shareGlobal(self, workers: int):
+        """ Оставляет этому процессу 1/workers общего ограничения бота """
+
+        with self._lock:
+            self._global = TokenBucket(self._global.rate / workers, max(1.0, self._global.capacity / workers))
+
+    def maxCost(self):
+        """ Возвращает наибольшую стоимость запроса, которая может пройти из полных корзин """
+
+        with self._lock:
+            return math.floor(min(self.userBurst + self.userRate * self.maxWait,
+                                  self._global.capacity + self._global.rate * self.maxWait))
+
+    def _bucket(self, key, rate: float, capacity: float):
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            bucket = self._buckets[key] = TokenBucket(rate, capacity)
+            while len(self._buckets) > self.maxBuckets:
+                self._buckets.popitem(last=False)
+        else:
+            self._buckets.move_to_end(key)
+        return bucket
+
+    def acquire(self, userId: int, command: str, cost: float = 1):
+        """ Занимает cost токенов для запроса пользователя
+
+            Args:
+                userId: id пользователя.
+                command: имя команды (обработчика).
+                cost: стоимость запроса в токенах.
+
+            Returns:
+                Возвращает время в секундах, которое запрос должен
+                подождать перед обращением к бэкенду (0, если ждать не нужно).
+
+            Raises:
+                RateLimitExceeded: ожидание было бы дольше maxWait.
+                RequestTooLarge: cost больше maxCost().
+        """
+
+        maxCost = self.maxCost()
+        if cost > maxCost:
+            raise RequestTooLarge(maxCost)
+
+        with self._lock:
+            now = time.monotonic()
+            charges = [("user", self._bucket(("user", userId), self.userRate, self.userBurst), cost)]
+            if command in self.commandLimits:
+                charges.append(("command", self._bucket(("command", userId, command), *self.commandLimits[command]), 1))
+            charges.append(("global", self._global, cost))
+
+            for _, bucket, _ in charges:
+                bucket.refill(now)
+            scope, wait = max(((scope, bucket.wait(charge)) for scope, bucket, charge in charges),
+                              key=lambda item: item[1])
+            if wait > self.maxWait:
+                raise RateLimitExceeded(scope, wait)
+            for _, bucket, charge in charges:
+                bucket.tokens -= charge
+            return wait
+
+
+# Ограничения частоты для тяжелых команд: (токенов в секунду, емкость)
+COMMAND_RATE_LIMITS = {
+    "getAptListCommand": (0.2, 2),
+    "getReplLogCommand": (0.2, 2),
+    "getCriticalCommand": (0.2, 2),
+}
+
+rateLimiter = RateLimiter(float(os.getenv("RATE_USER_RATE", 1)), float(os.getenv("RATE_USER_BURST", 5)),
+                          float(os.getenv("RATE_GLOBAL_RATE", 20)), float(os.getenv("RATE_GLOBAL_BURST", 40)),
+                          COMMAND_RATE_LIMITS, float(os.getenv("RATE_MAX_WAIT", 2)))
+
+
+def admit(cost: float = 1):
+    """ Пропускает обращение к бэкенду через rateLimiter
+
+        Пользователь и команда берутся из logContext, поэтому
+        внутренние вызовы вне обработчиков (сборщик метрик, миграции)
+        не ограничиваются. Вызывается непосредственно перед обращением
+        к SSH или БД, поэтому ответы из кэша ограничение не расходуют.
+        При необходимости ждет своей очереди. На время ожидания места
+        в лимитах бэкендов (backendSlot), занятые обработчиком,
+        освобождаются и занимаются снова после него, поэтому
+        ограниченный пользователь не задерживает запросы других.
+
+        Args:
+            cost: стоимость обращения в токенах.
+
+        Raises:
+            RateLimitExceeded: запрос отклонен.
+            RequestTooLarge: запрос не пройдет никогда.
+    """
+
+    context = logContext.get()
+    if context.get("userId") is None:
+        return
+
+    try:
+        wait = rateLimiter.acquire(context["userId"], context.get("command"), cost)
+    except RateLimitExceeded as error:
+        RATE_LIMITED.inc(scope=error.scope, action="rejected")
+        raise
+    except RequestTooLarge:
+        RATE_LIMITED.inc(scope="cost", action="rejected")
+        raise
+    if wait:
+        RATE_LIMITED.inc(scope="queue", action="delayed")
+        held = _heldSlots.get()
+        for semaphore in held:
+            semaphore.release()
+        try:
+            time.sleep(wait)
+        finally:
+            for semaphore in held:
+                semaphore.acquire()
+
+
+StreamResult = namedtuple("StreamResult", ["exitCode", "size", "truncated", "timedOut"])
+
+
+class _SSHConnection:
+    """ Долгоживущее SSH-подключение к одному хосту
+
+        Хранит аутентифицированного клиента, время последнего
+        использования и семафор, ограничивающий количество
+        одновременно открытых каналов.
+    """
+
+    def __init__(self, client: "paramiko.SSHClient", maxChannels: int):
+        self.client = client
+        self.channels = threading.BoundedSemaphore(maxChannels)
+        self.inUse = 0
+        self.lastUsed = time.monotonic()
+
+    def isAlive(self):
+        """ Проверяет, что транспорт подключения активен """
+
+        transport = self.client.get_transport()
+        if transport is None or not transport.is_active():
+            return False
+        try:
+            transport.send_ignore()
+        except (paramiko.SSHException, EOFError, OSError):
+            return False
+        return True
+
+    def close(self):
+        try:
+            self.client.close()
+        except Exception:
+            pass
+
+
+class SSHConnectionManager:
+    """ Менеджер долгоживущих SSH-подключений
+
+        Держит по одному аутентифицированному транспорту на каждую
+        пару хост/пользователь и открывает на нем каналы для
+        выполнения команд, вместо полного подключения на каждую команду.
+        Перед выдачей подключения проверяет его живость, закрывает
+        простаивающие дольше idleTimeout секунд подключения и
+        переподключается при обрыве транспорта.
+
+        Args:
+            maxChannels: максимум одновременно открытых каналов на подключение.
+            idleTimeout: время простоя в секундах, после которого подключение закрывается.
+            keepalive: интервал keepalive-пакетов транспорта в секундах.
+            connectTimeout: таймаут установки TCP-подключения в секундах.
+    """
+
+    def __init__(self, maxChannels: int = 4, idleTimeout: float = 300,
+                 keepalive: int = 30, connectTimeout: float = 10):
+        self.maxChannels = maxChannels
+        self.idleTimeout = idleTimeout
+        self.keepalive = keepalive
+        self.connectTimeout = connectTimeout
+
+        self._connections = {}
+        self._hostLocks = {}
+        self._lock = threading.Lock()
+        self._reaper = None
+        self._stopped = threading.Event()
+
+    def _hostLock(self, key):
+        with self._lock:
+            if key not in self._hostLocks:
+                self._hostLocks[key] = threading.Lock()
+            return self._hostLocks[key]
+
+    def _connect(self, host: str, port: int, username: str, password: str):
+        client = paramiko.SSHClient()
+        client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+        try:
+            with SSH_CONNECT_SECONDS.time(host=host):
+                client.connect(hostname=host, username=username, password=password, port=port,
+                               timeout=self.connectTimeout)
+        except Exception:
+            SSH_ERRORS.inc(host=host)
+            raise
+        client.get_transport().set_keepalive(self.keepalive)
+        logging.info("SSH-подключение к %s:%s установлено", host, port, extra={"backend": "ssh", "host": host})
+        return _SSHConnection(client, self.maxChannels)
+
+    def _getConnection(self, host: str, port: int, username: str, password: str):
+        """ Возвращает живое подключение к хосту, при необходимости переподключаясь """
+
+        key = (host, port, username)
+        with self._hostLock(key):
+            connection = self._connections.get(key)
+
+            if connection is not None and not connection.isAlive():
+                logging.warning("SSH-подключение к %s:%s потеряно, переподключение", host, port,
+                                extra={"backend": "ssh", "host": host})
+                self._drop(key, connection)
+                connection = None
+
+            if connection is None:
+                connection = self._connect(host, port, username, password)
+                with self._lock:
+                    self._connections[key] = connection
+                self._startReaper()
+
+            return key, connection
+
+    def _drop(self, key, connection: _SSHConnection):
+        with self._lock:
+            if self._connections.get(key) is connection:
+                del self._connections[key]
+        connection.close()
+
+    def execCommand(self, host: str, port: int, username: str, password: str, command: str):
+        """ Выполняет команду в новом канале долгоживущего подключения
+
+            stdout и stderr читаются одновременно, поэтому команда не
+            зависает на переполненном буфере stderr.
+
+            Args:
+                host, port, username, password: параметры подключения.
+                command: команда для удаленного выполнения на сервере.
+
+            Returns:
+                Возвращает вывод команды 'stdout+stderr' в виде bytes.
+        """
+
+        stdout, stderr = [], []
+        self.streamCommand(host, port, username, password, command, stdout.append, stderr.append)
+        return b"".join(stdout) + b"".join(stderr)
+
+    def streamCommand(self, host: str, port: int, username: str, password: str, command: str,
+                      onStdout, onStderr=None, maxOutput: int = None, timeout: float = None,
+                      chunkSize: int = 32768):
+        """ Выполняет команду, передавая ее вывод частями по мере поступления
+
+            Оба канала вывода читаются одновременно частями не больше
+            chunkSize. При обрыве транспорта до получения первых данных
+            подключение пересоздается и команда выполняется повторно
+            один раз.
+
+            Args:
+                host, port, username, password: параметры подключения.
+                command: команда для удаленного выполнения на сервере.
+                onStdout: функция, получающая очередную часть stdout (bytes).
+                onStderr: функция для частей stderr, по умолчанию onStdout.
+                maxOutput: максимальный суммарный объем вывода в байтах,
+                    после которого чтение прекращается.
+                timeout: максимальное время выполнения в секундах.
+                chunkSize: максимальный размер одной части.
+
+            Returns:
+                Возвращает StreamResult(exitCode, size, truncated, timedOut).
+                exitCode равен None, если команда не завершилась.
+        """
+
+        if onStderr is None:
+            onStderr = onStdout
+
+        received = 0
+
+        def counted(handler):
+            def wrapper(data):
+                nonlocal received
+                received += len(data)
+                handler(data)
+            return wrapper
+
+        onStdout, onStderr = counted(onStdout), counted(onStderr)
+
+        for attempt in range(2):
+            key, connection = self._getConnection(host, port, username, password)
+            with connection.channels:
+                with self._lock:
+                    connection.inUse += 1
+                try:
+                    with SSH_EXEC_SECONDS.time(host=host):
+                        channel = connection.client.get_transport().open_session()
+                        try:
+                            channel.exec_command(command)
+                            return self._pump(channel, onStdout, onStderr, maxOutput, timeout, chunkSize)
+                        finally:
+                            channel.close()
+                except (paramiko.SSHException, EOFError, OSError) as error:
+                    SSH_ERRORS.inc(host=host)
+                    logging.warning("Ошибка SSH-канала к %s:%s: %s", host, port, error,
+                                    extra={"backend": "ssh", "host": host})
+                    self._drop(key, connection)
+                    if attempt or received:
+                        raise
+                finally:
+                    with self._lock:
+                        connection.inUse -= 1
+                        connection.lastUsed = time.monotonic()
+
+    @staticmethod
+    def _pump(channel, onStdout, onStderr, maxOutput, timeout, chunkSize):
+        deadline = None if timeout is None else time.monotonic() + timeout
+        size = 0
+        streams = ((channel.recv_ready, channel.recv, onStdout),
+                   (channel.recv_stderr_ready, channel.recv_stderr, onStderr))
+
+        while True:
+            wait = 0.5
+            if deadline is not None:
+                wait = min(wait, deadline - time.monotonic())
+                if wait <= 0:
+                    return StreamResult(None, size, False, True)
+            select.select([channel], [], [], wait)
+
+            for ready, recv, handler in streams:
+                while ready():
+                    data = recv(chunkSize)
+                    if maxOutput is not None and size + len(data) > maxOutput:
+                        data = data[:maxOutput - size]
+                        size += len(data)
+                        if data:
+                            handler(data)
+                        return StreamResult(None, size, True, False)
+                    size += len(data)
+                    handler(data)
+
+            if channel.exit_status_ready() and not channel.recv_ready() and not channel.recv_stderr_ready():
+                return StreamResult(channel.recv_exit_status(), size, False, False)
+
+    def warm(self, host: str, port: int, username: str, password: str):
+        """ Заранее устанавливает подключение к хосту, не выполняя команд """
+
+        self._getConnection(host, port, username, password)
+
+    def closeIdle(self):
+        """ Закрывает подключения, простаивающие дольше idleTimeout """
+
+        now = time.monotonic()
+        with self._lock:
+            idle = [(key, connection) for key, connection in self._connections.items()
+                    if connection.inUse == 0 and now - connection.lastUsed > self.idleTimeout]
+            for key, connection in idle:
+                del self._connections[key]
+
+        for (host, port, username), connection in idle:
+            connection.close()
+            logging.info("SSH-подключение к %s:%s закрыто по простою", host, port,
+                         extra={"backend": "ssh", "host": host})
+
+    def closeAll(self):
+        """ Закрывает все подключения и останавливает фоновую очистку """
+
+        self._stopped.set()
+        with self._lock:
+            connections = list(self._connections.values())
+            self._connections.clear()
+        for connection in connections:
+            connection.close()
+
+    def _startReaper(self):
+        with self._lock:
+            if self._reaper is not None:
+                return
+            self._reaper = threading.Thread(target=self._reap, name="ssh-reaper", daemon=True)
+            self._reaper.start()
+
+    def _reap(self):
+        interval = max(1.0, self.idleTimeout / 4)
+        while not self._stopped.wait(interval):
+            self.closeIdle()
+
+
+sshManager = SSHConnectionManager(
+    maxChannels=int(os.getenv("RM_MAX_CHANNELS", 4)),
+    idleTimeout=float(os.getenv("RM_IDLE_TIMEOUT", 300)),
+)
+
+
+def _sshParams():
+    config = getConfig()
+    return config.rmHost, config.rmPort, config.rmUser, config.rmPassword
+
+
+def remoteCmdExecutionBySSH(command: str):
+    """ Осуществляет удаленное выполнение команды
+
+        Выполняет заданную команду на сервере через долгоживущее
+        SSH-подключение из sshManager и возвращает ее вывод.
+
+        Args:
+            command: команда для удаленного выполнения на сервере.
+
+        Returns:
+            Возвращает строку, содержащую вывод команды 'stdout+stderr'
+    """
+
+    admit()
+    return sshManager.execCommand(*_sshParams(), command)
+
+
+def remoteStreamExecutionBySSH(command: str, onChunk, maxOutput: int = None, timeout: float = None):
+    """ Осуществляет удаленное выполнение команды с потоковой передачей вывода
+
+        Части stdout и stderr передаются в onChunk по мере поступления.
+        Объем вывода и время выполнения ограничены maxOutput и timeout,
+        по умолчанию RM_STREAM_MAX_OUTPUT (1 МБ) и RM_STREAM_TIMEOUT (60 с).
+
+        Args:
+            command: команда для удаленного выполнения на сервере.
+            onChunk: функция, получающая очередную часть вывода (bytes).
+            maxOutput: максимальный объем вывода в байтах.
+            timeout: максимальное время выполнения в секундах.
+
+        Returns:
+            Возвращает StreamResult(exitCode, size, truncated, timedOut).
+    """
+
+    if maxOutput is None:
+        maxOutput = int(os.getenv("RM_STREAM_MAX_OUTPUT", 1 << 20))
+    if timeout is None:
+        timeout = float(os.getenv("RM_STREAM_TIMEOUT", 60))
+
+    admit()
+    return sshManager.streamCommand(*_sshParams(), command, onChunk,
+                                    maxOutput=maxOutput, timeout=timeout)
+
+
+class Inventory:
+    """ Инвентарь хостов и групп для выполнения команд на нескольких серверах
+
+        Загружается из JSON-файла вида:
+
+            {
+                "hosts": {
+                    "db-1": {"host": "10.0.0.1"},
+                    "db-2": {"host": "10.0.0.2", "port": 2222, "user": "admin"}
+                },
+                "groups": {
+                    "db-cluster": ["db-1", "db-2"]
+                }
+            }
+
+        Незаданные порт, пользователь и пароль берутся из RM_PORT,
+        RM_USER и RM_PASSWORD. Хост из RM_HOST всегда доступен под
+        именем 'default', группа 'all' содержит все хосты.
+
+        Args:
+            hosts: словарь {имя: параметры подключения}.
+            groups: словарь {имя группы: список имен хостов}.
+    """
+
+    def __init__(self, hosts: dict, groups: dict):
+        self.hosts = hosts
+        self.groups = groups
+
+    @classmethod
+    def load(cls, path: str):
+        data = {}
+        if os.path.exists(path):
+            with open(path, encoding="utf-8") as file:
+                data = json.load(file)
+
+        hosts = dict(data.get("hosts", {}))
+        if getConfig().rmHost:
+            hosts.setdefault("default", {"host": getConfig().rmHost})
+        groups = dict(data.get("groups", {}))
+        groups.setdefault("all", list(hosts))
+        return cls(hosts, groups)
+
+    def resolve(self, targets: list):
+        """ Раскрывает имена хостов и групп в список имен хостов
+
+            Args:
+                targets: имена хостов или групп, с '@' в начале или без.
+
+            Returns:
+                Возвращает список уникальных имен хостов в порядке упоминания.
+
+            Raises:
+                KeyError: хост или группа не найдены в инвентаре.
+        """
+
+        names = {}
+        for target in targets:
+            target = target.lstrip("@")
+            if target in self.groups:
+                members = self.groups[target]
+            elif target in self.hosts:
+                members = [target]
+            else:
+                raise KeyError(target)
+            for member in members:
+                if member not in self.hosts:
+                    raise KeyError(member)
+                names.setdefault(member, None)
+        return list(names)
+
+    def params(self, name: str):
+        """ Возвращает параметры подключения (host, port, username, password) хоста """
+
+        entry = self.hosts[name]
+        config = getConfig()
+        return (entry["host"],
+                int(entry.get("port", config.rmPort)),
+                entry.get("user", config.rmUser),
+                entry.get("password", config.rmPassword))
+
+
+_inventory = None
+_inventoryLock = threading.Lock()
+
+
+def getInventory():
+    """ Возвращает инвентарь, загружая его из INVENTORY_FILE при первом обращении """
+
+    global _inventory
+    with _inventoryLock:
+        if _inventory is None:
+            _inventory = Inventory.load(os.getenv("INVENTORY_FILE", "inventory.json"))
+        return _inventory
+
+
+HostResult = namedtuple("HostResult", ["name", "output", "exitCode", "error", "duration", "timedOut"])
+
+
+def _runOnHost(name: str, command: str, timeout: float, maxOutput: int):
+    started = time.monotonic()
+    chunks = []
+    try:
+        result = sshManager.streamCommand(*getInventory().params(name), command, chunks.append,
+                                          maxOutput=maxOutput, timeout=timeout)
+    except Exception as error:
+        return HostResult(name, b"".join(chunks), None, str(error) or type(error).__name__,
+                          time.monotonic() - started, False)
+    return HostResult(name, b"".join(chunks), result.exitCode, None,
+                      time.monotonic() - started, result.timedOut)
+
+
+def fanOutCommand(names: list, command: str, concurrency: int = None, timeout: float = None,
+                  maxOutput: int = 1 << 20, cost: int = 1):
+    """ Выполняет команду на нескольких хостах параллельно
+
+        Хосты обрабатываются пулом не больше чем из concurrency потоков
+        (по умолчанию FANOUT_CONCURRENCY), выполнение на каждом хосте
+        ограничено timeout секундами (по умолчанию FANOUT_TIMEOUT).
+        Ошибка на одном хосте не прерывает остальные. Ограничитель
+        частоты списывает cost токенов за каждый хост сразу при вызове,
+        до обращения к хостам.
+
+        Args:
+            names: имена хостов из инвентаря.
+            command: команда для удаленного выполнения.
+            concurrency: максимум одновременно обрабатываемых хостов.
+            timeout: максимальное время выполнения на одном хосте.
+            maxOutput: максимальный объем вывода с одного хоста.
+            cost: стоимость выполнения на одном хосте, например
+                количество объединенных в command команд.
+
+        Returns:
+            Возвращает итератор HostResult(name, output, exitCode, error,
+            duration, timedOut) по мере ответа хостов.
+
+        Raises:
+            RateLimitExceeded: запрос отклонен.
+            RequestTooLarge: хостов или команд больше, чем пропустит ограничитель.
+    """
+
+    if concurrency is None:
+        concurrency = int(os.getenv("FANOUT_CONCURRENCY", 32))
+    if timeout is None:
+        timeout = float(os.getenv("FANOUT_TIMEOUT", 30))
+    if not names:
+        return iter(())
+
+    admit(cost * len(names))
+    return _fanOut(names, command, concurrency, timeout, maxOutput)
+
+
+def _fanOut(names: list, command: str, concurrency: int, timeout: float, maxOutput: int):
+    with ThreadPoolExecutor(max_workers=min(concurrency, len(names)), thread_name_prefix="fanout") as executor:
+        # Копия контекста на каждый хост: записи лога из потоков пула сохраняют команду и пользователя
+        futures = [executor.submit(contextvars.copy_context().run, _runOnHost, name, command, timeout, maxOutput)
+                   for name in names]
+        for future in as_completed(futures):
+            yield future.result()
+
+
+CommandResult = namedtuple("CommandResult", ["output", "exitCode"])
+
+
+def remoteBatchExecutionBySSH(commands: list):
+    """ Осуществляет удаленное выполнение нескольких команд за один запуск
+
+        Объединяет команды в один скрипт, выполняемый одним exec по SSH.
+        Каждая команда передается отдельному 'sh -c', поэтому ошибка
+        синтаксиса в одной команде не влияет на остальные. Вывод каждой
+        команды ('stdout+stderr') завершается строкой-
+        разделителем с уникальным маркером и кодом возврата, по которой
+        вывод разбирается обратно на отдельные результаты.
+
+        Args:
+            commands: список команд для удаленного выполнения на сервере.
+
+        Returns:
+            Возвращает список CommandResult(output, exitCode) в порядке
+            команд. Если вывод команды оборвался до разделителя,
+            exitCode равен None.
+    """
+
+    if not commands:
+        return []
+
+    marker = uuid4().hex
+    script = "\n".join(f"sh -c {shlex.quote(command)} 2>&1; printf '\\n{marker}:%d\\n' $?"
+                       for command in commands)
+    admit(len(commands))
+    data = sshManager.execCommand(*_sshParams(), script)
+
+    results = []
+    separator = f"\n{marker}:".encode()
+    for _ in commands:
+        output, found, data = data.partition(separator)
+        if not found:
+            results.append(CommandResult(output, None))
+            data = b""
+            continue
+        exitCode, _, data = data.partition(b"\n")
+        results.append(CommandResult(output, int(exitCode)))
+
+    return results
+
+
+class _Flight:
+    """ Выполняющаяся загрузка значения, которую ожидают другие потоки """
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.value = None
+        self.error = None
+
+
+class TTLCache:
+    """ Ограниченный по размеру LRU-кэш с временем жизни записей
+
+        Одновременные запросы одного и того же отсутствующего ключа
+        объединяются: загрузчик вызывается один раз, остальные потоки
+        ждут его результата (single-flight). Ошибки загрузчика не
+        кэшируются и передаются всем ожидающим.
+
+        Если задан shared - словарь, общий для нескольких процессов
+        (например, multiprocessing.Manager().dict()), то при локальном
+        промахе значение сначала ищется в нем, а загруженные значения
+        публикуются в него.
+
+        Args:
+            maxSize: максимальное количество записей в кэше.
+            shared: общий для процессов словарь {ключ: (срок годности по time.time(), значение)}.
+    """
+
+    def __init__(self, maxSize: int = 256, shared=None):
+        self.maxSize = maxSize
+        self.shared = shared
+        self.hits = 0
+        self.misses = 0
+
+        self._data = OrderedDict()
+        self._inflight = {}
+        self._lock = threading.Lock()
+
+    def get(self, key, loader, ttl: float, refresh: bool = False):
+        """ Возвращает значение по ключу, при необходимости загружая его
+
+            Args:
+                key: ключ записи.
+                loader: функция без аргументов, возвращающая значение.
+                ttl: время жизни записи в секундах, 0 отключает кэширование.
+                refresh: игнорировать сохраненное значение и загрузить заново.
+
+            Returns:
+                Возвращает закэшированное или только что загруженное значение.
+        """
+
+        if ttl <= 0:
+            return loader()
+
+        with self._lock:
+            entry = self._data.get(key)
+            if not refresh and entry is not None and entry[0] > time.monotonic():
+                self._data.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+
+            flight = self._inflight.get(key)
+            leader = flight is None
+            if leader:
+                flight = _Flight()
+                self._inflight[key] = flight
+                self.misses += 1
+
+        if not leader:
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.value
+
+        try:
+            entry = None if refresh else self._getShared(key)
+            if entry is not None:
+                flight.value = entry[1]
+                expires = time.monotonic() + entry[0] - time.time()
+            else:
+                flight.value = loader()
+                expires = time.monotonic() + ttl
+                self._putShared(key, (time.time() + ttl, flight.value))
+        except BaseException as error:
+            flight.error = error
+            raise
+        else:
+            with self._lock:
+                if entry is not None:
+                    self.misses -= 1
+                    self.hits += 1
+                self._data[key] = (expires, flight.value)
+                self._data.move_to_end(key)
+                while len(self._data) > self.maxSize:
+                    self._data.popitem(last=False)
+        finally:
+            with self._lock:
+                del self._inflight[key]
+            flight.done.set()
+
+        return flight.value
+
+    def _getShared(self, key):
+        if self.shared is None:
+            return None
+        try:
+            entry = self.shared.get(key)
+        except (OSError, EOFError):
+            return None
+        if entry is None or entry[0] <= time.time():
+            return None
+        return entry
+
+    def _putShared(self, key, entry):
+        if self.shared is None:
+            return
+        try:
+            self.shared[key] = entry
+            if len(self.shared) > self.maxSize:
+                now = time.time()
+                for staleKey, (expires, _) in list(self.shared.items()):
+                    if expires <= now:
+                        self.shared.pop(staleKey, None)
+        except (OSError, EOFError):
+            pass
+
+    def invalidate(self, key):
+        """ Удаляет запись из кэша """
+
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+
+# Время жизни результатов команд в секундах, по префиксу команды.
+# Команды, не попавшие в список, не кэшируются.
+COMMAND_TTL = [
+    ("uname", 3600),
+    ("apt show", 3600),
+    ("apt list", 3600),
+    ("systemctl list-units", 300),
+    ("df", 5),
+    ("free", 5),
+    ("uptime", 5),
+    ("mpstat", 5),
+    ("ps", 5),
+    ("ss", 5),
+    ("w", 5),
+]
+
+commandCache = TTLCache(maxSize=int(os.getenv("RM_CACHE_SIZE", 256)))
+
+CallbackMetric("command_cache_hits_total", "Попадания в кэш результатов команд",
+               lambda: commandCache.hits, kind="counter")
+CallbackMetric("command_cache_misses_total", "Промахи кэша результатов команд",
+               lambda: commandCache.misses, kind="counter")
+
+
+def commandTTL(command: str):
+    """ Возвращает время жизни кэша для команды по таблице COMMAND_TTL """
+
+    for prefix, ttl in COMMAND_TTL:
+        if command == prefix or command.startswith(prefix + " "):
+            return ttl
+    return 0
+
+
+def cachedRemoteCmdExecutionBySSH(command: str, refresh: bool = False):
+    """ Осуществляет удаленное выполнение команды через кэш
+
+        Результат хранится в commandCache в течение времени, заданного
+        для команды в COMMAND_TTL. Одновременные запросы одной команды
+        приводят к одному удаленному выполнению.
+
+        Args:
+            command: команда для удаленного выполнения на сервере.
+            refresh: принудительно выполнить команду, обновив кэш.
+
+        Returns:
+            Возвращает вывод команды 'stdout+stderr'
+    """
+
+    return commandCache.get(command, lambda: remoteCmdExecutionBySSH(command),
+                            commandTTL(command), refresh)
+
+
+def cachedRemoteBatchExecutionBySSH(commands: list, refresh: bool = False):
+    """ Осуществляет пакетное удаленное выполнение команд через кэш
+
+        Пакет кэшируется целиком с наименьшим из времен жизни
+        входящих в него команд.
+
+        Args:
+            commands: список команд для удаленного выполнения на сервере.
+            refresh: принудительно выполнить команды, обновив кэш.
+
+        Returns:
+            Возвращает список CommandResult(output, exitCode) в порядке команд.
+    """
+
+    ttl = min((commandTTL(command) for command in commands), default=0)
+    return commandCache.get(tuple(commands), lambda: remoteBatchExecutionBySSH(commands),
+                            ttl, refresh)
+
+
+def useSharedState(semaphores: dict, cache, workers: int, collected=None):
+    """ Подключает состояние, общее для процессов-воркеров
+
+        Вызывается в каждом воркере многопроцессного режима до начала
+        обработки обновлений.
+
+        Args:
+            semaphores: словарь {бэкенд: межпроцессный семафор} с лимитами
+                одновременных запросов, общими для всех воркеров.
+            cache: общий для процессов словарь для commandCache.
+            workers: количество воркеров; общее ограничение частоты
+                rateLimiter делится между ними поровну.
+            collected: общий для процессов словарь, в который публикует
+                замеры сборщик метрик процесса приема обновлений.
+    """
+
+    _backendSemaphores.update(semaphores)
+    commandCache.shared = cache
+    rateLimiter.shareGlobal(workers)
+    metricsCollector.shared = collected
+
+
+MetricPoint = namedtuple("MetricPoint", ["timestamp", "memory", "swap", "disk", "cpu"])
+
+# Команды, выполняемые сборщиком метрик; mpstat с интервалом дает
+# текущую загрузку, а не среднюю с момента загрузки системы
+COLLECTED_COMMANDS = {"free": "free -h", "df": "df", "mpstat": "mpstat -P ALL 1 1"}
+
+SPARK_CHARS = "▁▂▃▄▅▆▇█"
+
+
+def sparkline(values: list, width: int = 30, low: float = 0, high: float = 100):
+    """ Рисует значения строкой из символов ▁..█
+
+        Значения усредняются до width точек и масштабируются
+        в диапазон low..high.
+    """
+
+    values = [value for value in values if value is not None]
+    if not values:
+        return ""
+    step = max(1, -(-len(values) // width))
+    points = [sum(values[i:i + step]) / len(values[i:i + step]) for i in range(0, len(values), step)]
+    span = (high - low) or 1
+    last = len(SPARK_CHARS) - 1
+    return "".join(SPARK_CHARS[min(last, max(0, int((point - low) / span * last + 0.5)))] for point in points)
+
+
+class MetricsCollector:
+    """ Фоновый сборщик метрик free, df и mpstat основного сервера
+
+        Раз в interval секунд выполняет COLLECTED_COMMANDS одним пакетным
+        exec через постоянное SSH-подключение sshManager. Последний
+        вывод каждой команды хранится целиком, а история - компактными
+        точками MetricPoint (проценты памяти, swap, самого заполненного
+        раздела и загрузки процессора) в кольцевом буфере на history
+        секунд. Если задан spillPath, точки дописываются в файл строками
+        JSON и загружаются из него при запуске.
+
+        Если задан shared - словарь, общий для нескольких процессов,
+        запущенный сборщик публикует в него последние выводы и историю,
+        а сборщики других процессов, не запущенные у себя, читают их
+        оттуда. Так сервер опрашивает только один процесс.
+
+        Args:
+            interval: период опроса в секундах.
+            history: длительность хранимой истории в секундах.
+            spillPath: путь к файлу для сохранения истории или None.
+    """
+
+    def __init__(self, interval: float = 30, history: float = 3600, spillPath: str = None):
+        self.interval = interval
+        self.history = history
+        self.spillPath = spillPath
+        self.points = deque(maxlen=max(1, int(history // interval)))
+        self._latest = {}
+        self._spilled = 0
+        self.shared = None
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        """ Загружает историю из файла и запускает фоновый поток опроса """
+
+        if self._thread is not None:
+            return
+        self._loadSpill()
+        self._publish()
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="metrics-collector", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def _run(self):
+        while not self._stop.is_set():
+            started = time.monotonic()
+            try:
+                self.collectOnce()
+            except Exception as error:
+                logging.warning("Ошибка сбора метрик: %s", error, extra={"backend": "ssh"})
+            self._stop.wait(max(0, self.interval - (time.monotonic() - started)))
+
+    def collectOnce(self):
+        """ Выполняет один замер и добавляет его в историю
+
+            Returns:
+                Возвращает добавленную точку MetricPoint.
+        """
+
+        names = list(COLLECTED_COMMANDS)
+        results = remoteBatchExecutionBySSH([COLLECTED_COMMANDS[name] for name in names])
+        timestamp = time.time()
+        texts = {name: decodeOutput(result.output) for name, result in zip(names, results)}
+
+        memory = {record.kind: memoryUsePercent(record) for record in parseFree(texts["free"])}
+        filesystems = parseDf(texts["df"])
+        cpus = {stat.cpu: stat for stat in parseMpstat(texts["mpstat"])}
+        point = MetricPoint(timestamp, memory.get("Mem"), memory.get("Swap"),
+                            max((fs.usePercent for fs in filesystems), default=None),
+                            100 - cpus["all"].idle if "all" in cpus else None)
+
+        with self._lock:
+            for name, text in texts.items():
+                self._latest[name] = (timestamp, text)
+            self.points.append(point)
+        self._spill(point)
+        self._publish()
+        return point
+
+    def _publish(self):
+        if self.shared is None:
+            return
+        with self._lock:
+            snapshot = (dict(self._latest), [tuple(point) for point in self.points])
+        try:
+            self.shared["collector"] = snapshot
+        except (OSError, EOFError):
+            pass
+
+    def _snapshot(self):
+        """ Возвращает (последние выводы, точки истории) этого процесса или из shared """
+
+        if self._thread is None and self.shared is not None:
+            try:
+                latest, points = self.shared.get("collector", ({}, []))
+            except (OSError, EOFError):
+                return {}, []
+            return latest, [MetricPoint(*point) for point in points]
+        with self._lock:
+            return dict(self._latest), list(self.points)
+
+    def latest(self, name: str, maxAge: float = None):
+        """ Возвращает последний вывод команды из COLLECTED_COMMANDS
+
+            Args:
+                name: имя команды ('free', 'df' или 'mpstat').
+                maxAge: максимальный возраст замера в секундах,
+                    по умолчанию три периода опроса.
+
+            Returns:
+                Возвращает кортеж (время замера, текст) или None, если
+                замера нет или он устарел.
+        """
+
+        maxAge = 3 * self.interval if maxAge is None else maxAge
+        sample = self._snapshot()[0].get(name)
+        if sample is None or time.time() - sample[0] > maxAge:
+            return None
+        return sample
+
+    def window(self, seconds: float = None):
+        """ Возвращает точки истории за последние seconds секунд (по умолчанию всю историю) """
+
+        since = time.time() - (self.history if seconds is None else seconds)
+        return [point for point in self._snapshot()[1] if point.timestamp >= since]
+
+    def summary(self, field: str, seconds: float = None):
+        """ Возвращает (минимум, среднее, максимум, значения) поля MetricPoint за окно или None """
+
+        values = [getattr(point, field) for point in self.window(seconds)]
+        values = [value for value in values if value is not None]
+        if not values:
+            return None
+        return min(values), sum(values) / len(values), max(values), values
+
+    def _loadSpill(self):
+        if not self.spillPath or not os.path.exists(self.spillPath):
+            return
+        since = time.time() - self.history
+        try:
+            with open(self.spillPath, encoding="utf-8") as file:
+                for line in file:
+                    try:
+                        point = MetricPoint(*json.loads(line))
+                    except (ValueError, TypeError):
+                        continue
+                    if point.timestamp >= since:
+                        self.points.append(point)
+        except OSError as error:
+            logging.warning("Не удалось прочитать историю метрик: %s", error)
+            return
+        self._compactSpill()
+
+    def _spill(self, point: MetricPoint):
+        if not self.spillPath:
+            return
+        try:
+            # Файл перезаписывается только точками из буфера, когда в нем
+            # накопилось вдвое больше строк, чем помещается в буфер
+            if self._spilled >= 2 * self.points.maxlen:
+                self._compactSpill()
+            else:
+                with open(self.spillPath, "a", encoding="utf-8") as file:
+                    file.write(json.dumps(point) + "\n")
+                self._spilled += 1
+        except OSError as error:
+            logging.warning("Не удалось сохранить историю метрик: %s", error)
+
+    def _compactSpill(self):
+        with self._lock:
+            points = list(self.points)
+        temporary = self.spillPath + ".tmp"
+        with open(temporary, "w", encoding="utf-8") as file:
+            for point in points:
+                file.write(json.dumps(point) + "\n")
+        os.replace(temporary, self.spillPath)
+        self._spilled = len(points)
+
+
+# Интервал опроса в секундах задается COLLECTOR_INTERVAL, 0 отключает сборщик
+metricsCollector = MetricsCollector(getConfig().collectorInterval or 30,
+                                    float(os.getenv("COLLECTOR_HISTORY", 3600)),
+                                    os.getenv("COLLECTOR_FILE"))
+
+
+class DBConnectionPool:
+    """ Потокобезопасный ограниченный пул подключений к PostgreSQL
+
+        Общий для всех функций работы с БД. Подключения создаются
+        по требованию, но не больше maxSize; при исчерпании пула поток
+        ждет освобождения подключения не дольше checkoutTimeout секунд.
+        При выдаче подключение проверяется: закрытые подключения
+        отбрасываются, а простаивавшие дольше validateInterval секунд
+        проверяются запросом 'SELECT 1'. Подключения, на которых
+        произошла ошибка соединения (например, после переключения
+        мастера), в пул не возвращаются, и следующее подключение
+        создается заново.
+
+        Args:
+            maxSize: максимальное количество подключений.
+            checkoutTimeout: максимальное время ожидания подключения в секундах.
+            validateInterval: время простоя, после которого подключение проверяется.
+    """
+
+    def __init__(self, maxSize: int = 10, checkoutTimeout: float = 30, validateInterval: float = 30):
+        self.maxSize = maxSize
+        self.checkoutTimeout = checkoutTimeout
+        self.validateInterval = validateInterval
+
+        self._idle = []
+        self._size = 0
+        self._condition = threading.Condition()
+
+        self._checkouts = 0
+        self._waits = 0
+        self._timeouts = 0
+        self._checkoutTime = 0.0
+        self._maxCheckoutTime = 0.0
+
+    def _connect(self):
+        config = getConfig()
+        return psycopg2.connect(user=config.dbUser,
+                                password=config.dbPassword,
+                                host=config.dbHost,
+                                port=config.dbPort,
+                                database=config.dbDatabase)
+
+    def _isValid(self, connection, idleSince: float):
+        if connection.closed:
+            return False
+        if time.monotonic() - idleSince < self.validateInterval:
+            return True
+        try:
+            with connection.cursor() as cursor:
+                cursor.execute("SELECT 1;")
+            connection.rollback()
+            return True
+        except (psycopg2.OperationalError, psycopg2.InterfaceError):
+            return False
+
+    def _discard(self, connection):
+        try:
+            connection.close()
+        except Exception:
+            pass
+        with self._condition:
+            self._size -= 1
+            self._condition.notify()
+
+    def getconn(self):
+        """ Выдает проверенное подключение из пула
+
+            Returns:
+                Возвращает объект подключения psycopg2.
+
+            Raises:
+                PoolError: свободное подключение не появилось за checkoutTimeout.
+        """
+
+        started = time.monotonic()
+        deadline = started + self.checkoutTimeout
+
+        while True:
+            with self._condition:
+                waited = False
+                while not self._idle and self._size >= self.maxSize:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        self._timeouts += 1
+                        raise psycopg2Pool.PoolError("Превышено время ожидания подключения к PostgreSQL")
+                    waited = True
+                    self._condition.wait(remaining)
+                if waited:
+                    self._waits += 1
+
+                if self._idle:
+                    connection, idleSince = self._idle.pop()
+                else:
+                    connection, idleSince = None, None
+                    self._size += 1
+
+            if connection is None:
+                try:
+                    connection = self._connect()
+                except BaseException:
+                    with self._condition:
+                        self._size -= 1
+                        self._condition.notify()
+                    raise
+            elif not self._isValid(connection, idleSince):
+                logging.warning("Подключение к PostgreSQL недействительно, переподключение", extra={"backend": "db"})
+                self._discard(connection)
+                continue
+
+            elapsed = time.monotonic() - started
+            DB_CHECKOUT_SECONDS.observe(elapsed)
+            with self._condition:
+                self._checkouts += 1
+                self._checkoutTime += elapsed
+                self._maxCheckoutTime = max(self._maxCheckoutTime, elapsed)
+            return connection
+
+    def putconn(self, connection, broken: bool = False):
+        """ Возвращает подключение в пул
+
+            Незавершенная транзакция откатывается. Закрытые и сломанные
+            подключения закрываются и освобождают место в пуле.
+
+            Args:
+                connection: подключение, полученное из getconn.
+                broken: на подключении произошла ошибка соединения.
+        """
+
+        if not broken and not connection.closed:
+            try:
+                if connection.get_transaction_status() != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+                    connection.rollback()
+            except (psycopg2.OperationalError, psycopg2.InterfaceError):
+                broken = True
+
+        if broken or connection.closed:
+            self._discard(connection)
+            return
+
+        with self._condition:
+            self._idle.append((connection, time.monotonic()))
+            self._condition.notify()
+
+    @contextmanager
+    def connection(self):
+        """ Контекстный менеджер, выдающий подключение из пула и возвращающий его обратно """
+
+        connection = self.getconn()
+        broken = False
+        try:
+            yield connection
+        except (psycopg2.OperationalError, psycopg2.InterfaceError):
+            broken = True
+            raise
+        finally:
+            self.putconn(connection, broken)
+
+    def closeAll(self):
+        """ Закрывает все свободные подключения пула """
+
+        with self._condition:
+            idle, self._idle = self._idle, []
+        for connection, _ in idle:
+            self._discard(connection)
+
+    def stats(self):
+        """ Возвращает статистику пула
+
+            Returns:
+                Возвращает словарь с размером пула, количеством свободных
+                и выданных подключений, количеством выдач, ожиданий и
+                таймаутов, а также средним и максимальным временем
+                получения подключения в миллисекундах.
+        """
+
+        with self._condition:
+            return {
+                "size": self._size,
+                "idle": len(self._idle),
+                "inUse": self._size - len(self._idle),
+                "maxSize": self.maxSize,
+                "checkouts": self._checkouts,
+                "waits": self._waits,
+                "timeouts": self._timeouts,
+                "avgCheckoutMs": self._checkoutTime / self._checkouts * 1000 if self._checkouts else 0.0,
+                "maxCheckoutMs": self._maxCheckoutTime * 1000,
+            }
+
+
+dbPool = DBConnectionPool(maxSize=int(os.getenv("DB_POOL_SIZE", 10)))
+
+CallbackMetric("db_pool_connections", "Подключения пула PostgreSQL по состоянию",
+               lambda: {state: dbPool.stats()[state] for state in ("size", "idle", "inUse")},
+               labelName="state")
+CallbackMetric("db_pool_waits_total", "Ожидания свободного подключения в пуле PostgreSQL",
+               lambda: dbPool.stats()["waits"], kind="counter")
+
+
+def warmUp():
+    """ Заранее импортирует бэкенды и открывает SSH- и DB-подключения
+
+        Вызывается в фоне после запуска приема обновлений, чтобы первые
+        команды после перезапуска не ждали импорта paramiko и psycopg2
+        и установки подключений. Ошибки только логируются: подключение
+        будет установлено при первой команде, как и без прогрева.
+        Длительность каждого шага попадает в STARTUP.
+    """
+
+    config = getConfig()
+    steps = []
+    if config.rmHost:
+        steps.append(("warmup ssh", lambda: sshManager.warm(*_sshParams())))
+    if config.dbDatabase:
+        steps.append(("warmup db", lambda: dbPool.putconn(dbPool.getconn())))
+
+    for name, step in steps:
+        try:
+            with STARTUP.phase(name):
+                step()
+        except Exception as error:
+            logging.warning("Не удалось выполнить %s: %s", name, error)
+    logging.info("Время запуска: %s", STARTUP.report())
+
+
+def streamRowsFromDBTable(table: str, afterId: int = None, descending: bool = False,
+                          chunkSize: int = 500):
+    """ Построчно читает таблицу table серверным курсором
+
+        Строки упорядочены по колонке id и выдаются порциями по
+        chunkSize, поэтому память не зависит от размера таблицы.
+        Подключение возвращается в пул при исчерпании или закрытии
+        генератора.
+
+        Args:
+            table: таблица, из которой получаются записи.
+            afterId: выдавать только строки с id больше (или меньше при
+                descending) указанного.
+            descending: выдавать строки в порядке убывания id.
+            chunkSize: количество строк в одной порции.
+
+        Yields:
+            Списки строк таблицы длиной не более chunkSize.
+    """
+
+    order = "DESC" if descending else "ASC"
+    where = ""
+    params = ()
+    if afterId is not None:
+        where = "WHERE id < %s" if descending else "WHERE id > %s"
+        params = (afterId,)
+
+    with dbPool.connection() as connection:
+        with connection.cursor(name=f"stream_{uuid4().hex}") as cursor:
+            cursor.itersize = chunkSize
+            with DB_QUERY_SECONDS.time(query="stream"):
+                cursor.execute(f"SELECT * FROM {table} {where} ORDER BY id {order};", params)
+            while True:
+                rows = cursor.fetchmany(chunkSize)
+                if not rows:
+                    break
+                yield rows
+
+
+def getAllRowFromDBTable(table: str):
+    """ Возвращает все строки из таблицы table
+
+        Args:
+            table: таблица, из которой получаются записи.
+
+        Returns:
+            Возвращает строку, содержащую записи
+            Например:
+
+            1: +7 090-034-51-21
+            2: +7 123-456-78-90
+            3: +7 888-456-78-90
+    """
+
+    admit()
+    try:
+        with DB_QUERY_SECONDS.time(query="getAllRows"):
+            message = "".join(f"{row[0]}: {row[1]}\n"
+                              for rows in streamRowsFromDBTable(table)
+                              for row in rows)
+        logging.info("Команда успешно выполнена", extra={"backend": "db", "query": "getAllRows"})
+    except (Exception, psycopg2.Error) as error:
+        message = "Ошибка при работе с PostgreSQL"
+        logging.error("Ошибка при работе с PostgreSQL: %s", error,
+                      extra={"backend": "db", "query": "getAllRows"})
+        DB_ERRORS.inc(query="getAllRows")
+
+    return message
+
+
+DBTablePage = namedtuple("DBTablePage", ["text", "firstId", "lastId", "hasPrev", "hasNext"])
+
+
+def getDBTablePage(table: str, afterId: int = None, beforeId: int = None,
+                   maxRows: int = 50, maxLength: int = 4000):
+    """ Возвращает одну страницу записей таблицы table
+
+        Использует keyset-пагинацию по колонке id: следующая страница
+        начинается после последнего id текущей, предыдущая
+        заканчивается перед первым. Страница ограничена как по
+        количеству строк, так и по длине текста, чтобы поместиться
+        в одно сообщение Telegram.
+
+        Args:
+            table: таблица, из которой получаются записи.
+            afterId: id, после которого начинается страница.
+            beforeId: id, перед которым заканчивается страница.
+            maxRows: максимальное количество строк на странице.
+            maxLength: максимальная длина текста страницы.
+
+        Returns:
+            Возвращает DBTablePage(text, firstId, lastId, hasPrev, hasNext)
+            или None при ошибке работы с БД.
+    """
+
+    descending = beforeId is not None
+    lines = []
+    ids = []
+    length = 0
+    hasMore = False
+
+    admit()
+    chunks = streamRowsFromDBTable(table, beforeId if descending else afterId,
+                                   descending, chunkSize=maxRows + 1)
+    try:
+        with DB_QUERY_SECONDS.time(query="getPage"), closing(chunks):
+            for rows in chunks:
+                for row in rows:
+                    line = f"{row[0]}: {row[1]}\n"
+                    if len(lines) >= maxRows or length + len(line) > maxLength:
+                        hasMore = True
+                        break
+                    lines.append(line)
+                    ids.append(row[0])
+                    length += len(line)
+                if hasMore:
+                    break
+        logging.info("Команда успешно выполнена", extra={"backend": "db", "query": "getPage"})
+    except (Exception, psycopg2.Error) as error:
+        logging.error("Ошибка при работе с PostgreSQL: %s", error,
+                      extra={"backend": "db", "query": "getPage"})
+        DB_ERRORS.inc(query="getPage")
+        return None
+
+    if descending:
+        lines.reverse()
+        ids.reverse()
+        hasPrev, hasNext = hasMore, True
+    else:
+        hasPrev, hasNext = afterId is not None, hasMore
+
+    if not ids:
+        # пустая страница: границы указывают на исходную позицию,
+        # чтобы с нее можно было вернуться назад
+        if descending:
+            return DBTablePage("", None, beforeId - 1, False, True)
+        return DBTablePage("", None if afterId is None else afterId + 1, None, hasPrev, False)
+
+    return DBTablePage("".join(lines), ids[0], ids[-1], hasPrev, hasNext)
+
+
+def normalizeEmail(email: str):
+    """ Приводит email к виду для хранения в БД: без пробелов по краям, в нижнем регистре """
+
+    return email.strip().lower()
+
+
+def normalizePhoneNumber(phoneNumber: str):
+    """ Приводит телефонный номер к виду для хранения в БД
+
+        Остаются только цифры номера в формате E.164 без '+':
+        '8 (999) 123-45-67' и '+7-999-123-45-67' дают '79991234567'.
+    """
+
+    digits = re.sub(r"\D", "", phoneNumber)
+    if len(digits) == 11 and digits.startswith("8"):
+        return "7" + digits[1:]
+    if len(digits) == 10:
+        return "7" + digits
+    return digits
+
+
+# Нормализация значений колонок перед записью и поиском в БД
+NORMALIZERS = {
+    ("emails", "email"): normalizeEmail,
+    ("numbers", "number"): normalizePhoneNumber,
+}
+
+
+def normalizeValue(table: str, column: str, value: str):
+    """ Нормализует значение колонки по NORMALIZERS, остальные значения не меняются """
+
+    normalizer = NORMALIZERS.get((table, column))
+    return normalizer(value) if normalizer else value
+
+
+# Миграции схемы БД: (версия, описание, SQL). Применяются по порядку
+# версий, примененные версии записываются в таблицу schema_migrations.
+SCHEMA_MIGRATIONS = [
+    (1, "Таблицы emails и numbers",
+     "CREATE TABLE IF NOT EXISTS emails (id SERIAL PRIMARY KEY, email VARCHAR(255) NOT NULL);"
+     "CREATE TABLE IF NOT EXISTS numbers (id SERIAL PRIMARY KEY, number VARCHAR(255) NOT NULL);"),
+    (2, "Нормализация, удаление дубликатов и уникальные индексы",
+     "UPDATE emails SET email = lower(btrim(email)) WHERE email <> lower(btrim(email));"
+     "UPDATE numbers SET number = regexp_replace(number, '\\D', '', 'g') WHERE number ~ '\\D';"
+     "UPDATE numbers SET number = '7' || substr(number, 2) WHERE length(number) = 11 AND number LIKE '8%';"
+     "UPDATE numbers SET number = '7' || number WHERE length(number) = 10;"
+     "DELETE FROM emails a USING emails b WHERE a.email = b.email AND a.id > b.id;"
+     "DELETE FROM numbers a USING numbers b WHERE a.number = b.number AND a.id > b.id;"
+     "CREATE UNIQUE INDEX IF NOT EXISTS emails_email_key ON emails (email);"
+     "CREATE UNIQUE INDEX IF NOT EXISTS numbers_number_key ON numbers (number);"),
+]
+
+
+def migrateDB():
+    """ Применяет к БД еще не примененные миграции SCHEMA_MIGRATIONS
+
+        Каждая миграция выполняется в отдельной транзакции вместе с
+        записью ее версии, поэтому прерванная миграция не оставляет
+        схему в промежуточном состоянии, а повторный запуск продолжает
+        с первой непримененной. Миграция 2 нормализует существующие
+        значения и удаляет дубликаты (остается запись с наименьшим id)
+        до создания уникальных индексов.
+
+        Returns:
+            Возвращает список версий примененных миграций.
+    """
+
+    applied = []
+    with DB_QUERY_SECONDS.time(query="migrate"), dbPool.connection() as connection:
+        with connection.cursor() as cursor:
+            cursor.execute("CREATE TABLE IF NOT EXISTS schema_migrations "
+                           "(version INTEGER PRIMARY KEY, applied_at TIMESTAMPTZ NOT NULL DEFAULT now());")
+            cursor.execute("SELECT version FROM schema_migrations;")
+            done = {row[0] for row in cursor.fetchall()}
+        connection.commit()
+
+        for version, description, sql in sorted(SCHEMA_MIGRATIONS):
+            if version in done:
+                continue
+            try:
+                with connection.cursor() as cursor:
+                    cursor.execute(sql)
+                    cursor.execute("INSERT INTO schema_migrations (version) VALUES (%s);", (version,))
+                connection.commit()
+            except psycopg2.Error:
+                connection.rollback()
+                DB_ERRORS.inc(query="migrate")
+                raise
+            applied.append(version)
+            logging.info("Применена миграция %s: %s", version, description,
+                         extra={"backend": "db", "query": "migrate"})
+
+    return applied
+
+
+def insertInBDTable(table: str, column: str, data: str):
+    """ Производит запись указанных данных в таблицу
+
+        Args:
+            table: таблица, в которую записываются данные.
+            column: колонка для записи.
+            data: данные для записи.
+
+        Returns:
+            Возвращает состояние успешности операции записи в БД
+    """
+
+    state = False
+    data = normalizeValue(table, column, data)
+
+    admit()
+    try:
+        with DB_QUERY_SECONDS.time(query="insert"), dbPool.connection() as connection:
+            with connection.cursor() as cursor:
+                cursor.execute(f"INSERT INTO {table} ({column}) VALUES (%s);", (data,))
+            connection.commit()
+        state = True
+        logging.info("Команда успешно выполнена", extra={"backend": "db", "query": "insert"})
+    except (Exception, psycopg2.Error) as error:
+        logging.error("Ошибка при работе с PostgreSQL: %s", error,
+                      extra={"backend": "db", "query": "insert"})
+        DB_ERRORS.inc(query="insert")
+
+    return state
+
+
+def rowExistsInBDTable(table: str, column: str, string: str):
+    """ Производит проверку на наличие записи в БД
+
+        Args:
+            table: таблица, в которой производится проверка.
+            column: колонка с записью.
+            string: проверяемые на существование данные.
+
+        Returns:
+            Возвращает True или False в зависимости от существования
+            записи в БД.
+    """
+
+    exists = False
+    string = normalizeValue(table, column, string)
+
+    admit()
+    try:
+        with DB_QUERY_SECONDS.time(query="rowExists"), dbPool.connection() as connection:
+            with connection.cursor() as cursor:
+                cursor.execute(f"SELECT exists (SELECT 1 FROM {table} WHERE {column} = %s LIMIT 1);", (string,))
+                data = cursor.fetchall()
+        exists = data[0][0]
+        logging.info("Команда успешно выполнена", extra={"backend": "db", "query": "rowExists"})
+    except (Exception, psycopg2.Error) as error:
+        logging.error("Ошибка при работе с PostgreSQL: %s", error,
+                      extra={"backend": "db", "query": "rowExists"})
+        DB_ERRORS.inc(query="rowExists")
+
+    return exists
+
+
+def rowsExistInBDTable(table: str, column: str, values: list):
+    """ Производит проверку на наличие набора записей в БД одним запросом
+
+        Args:
+            table: таблица, в которой производится проверка.
+            column: колонка с записью.
+            values: проверяемые на существование данные.
+
+        Returns:
+            Возвращает множество значений из values, которые есть в БД
+            (значения сравниваются в нормализованном виде). При ошибке
+            работы с БД возвращает пустое множество.
+    """
+
+    existing = set()
+    if not values:
+        return existing
+
+    normalized = {}
+    for value in values:
+        normalized.setdefault(normalizeValue(table, column, value), []).append(value)
+
+    admit()
+    try:
+        with DB_QUERY_SECONDS.time(query="rowsExist"), dbPool.connection() as connection:
+            with connection.cursor() as cursor:
+                cursor.execute(f"SELECT DISTINCT {column} FROM {table} WHERE {column} = ANY(%s);",
+                               (list(normalized),))
+                existing = {value for row in cursor.fetchall() for value in normalized.get(row[0], ())}
+        logging.info("Команда успешно выполнена", extra={"backend": "db", "query": "rowsExist"})
+    except (Exception, psycopg2.Error) as error:
+        logging.error("Ошибка при работе с PostgreSQL: %s", error,
+                      extra={"backend": "db", "query": "rowsExist"})
+        DB_ERRORS.inc(query="rowsExist")
+
+    return existing
+
+
+def insertManyInBDTable(table: str, column: str, values: list):
+    """ Производит запись набора данных в таблицу одним запросом
+
+        Все значения записываются одной командой INSERT в одной
+        транзакции. Значения, уже присутствующие в таблице, а также
+        повторы внутри values пропускаются на стороне БД, поэтому
+        повторный вызов с теми же данными ничего не меняет. Значения
+        записываются в нормализованном виде, так что один номер в
+        разных форматах считается повтором.
+
+        Args:
+            table: таблица, в которую записываются данные.
+            column: колонка для записи.
+            values: данные для записи.
+
+        Returns:
+            Возвращает кортеж (записано, пропущено) или None
+            при ошибке работы с БД.
+    """
+
+    unique = list(dict.fromkeys(normalizeValue(table, column, value) for value in values))
+    if not unique:
+        return 0, 0
+
+    admit()
+    try:
+        with DB_QUERY_SECONDS.time(query="insertMany"), dbPool.connection() as connection:
+            with connection.cursor() as cursor:
+                cursor.execute(f"INSERT INTO {table} ({column}) "
+                               f"SELECT value FROM unnest(%s::text[]) AS value "
+                               f"WHERE NOT EXISTS (SELECT 1 FROM {table} WHERE {column} = value) "
+                               f"ON CONFLICT DO NOTHING;",
+                               (unique,))
+                inserted = cursor.rowcount
+            connection.commit()
+        logging.info("Команда успешно выполнена", extra={"backend": "db", "query": "insertMany"})
+    except (Exception, psycopg2.Error) as error:
+        logging.error("Ошибка при работе с PostgreSQL: %s", error,
+                      extra={"backend": "db", "query": "insertMany"})
+        DB_ERRORS.inc(query="insertMany")
+        return None
 
-        return exists
+    return inserted, len(unique) - inserted
@@ -0,0 +1,102 @@
+# /bin/bash
+""" Нагрузочный стенд для режима webhook
+
+    Отправляет на локально запущенный бот синтетические обновления
+    Telegram и измеряет пропускную способность приема. Доступ к
+    Telegram не нужен: бот запускается с BOT_MODE=webhook без
+    WEBHOOK_URL и любым токеном правильного формата, например:
+
+        TOKEN=123456:TEST BOT_MODE=webhook WEBHOOK_SECRET=secret python bot.py
+        python webhook_harness.py --secret secret --count 5000 --concurrency 32
+"""
+import json
+import time
+import argparse
+import urllib.error
+import urllib.request
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+
+def syntheticUpdate(updateId: int, userId: int, text: str):
+    """ Формирует JSON-обновление с текстовым сообщением пользователя
+
+        Args:
+            updateId: идентификатор обновления.
+            userId: идентификатор пользователя и чата.
+            text: текст сообщения, команды размечаются как bot_command.
+
+        Returns:
+            Возвращает словарь в формате Telegram Bot API.
+    """
+
+    message = {
+        "message_id": updateId,
+        "date": int(time.time()),
+        "chat": {"id": userId, "type": "private"},
+        "from": {"id": userId, "is_bot": False, "first_name": "Load"},
+        "text": text,
+    }
+    if text.startswith("/"):
+        message["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]
+
+    return {"update_id": updateId, "message": message}
+
+
+def postUpdate(url: str, secret: str, update: dict):
+    """ Отправляет одно обновление на webhook
+
+        Returns:
+            Возвращает кортеж (HTTP-статус, время ответа в секундах).
+    """
+
+    request = urllib.request.Request(url, data=json.dumps(update).encode(), method="POST",
+                                     headers={"Content-Type": "application/json",
+                                              "X-Telegram-Bot-Api-Secret-Token": secret})
+    started = time.perf_counter()
+    try:
+        with urllib.request.urlopen(request, timeout=10) as response:
+            status = response.status
+    except urllib.error.HTTPError as error:
+        status = error.code
+    except OSError:
+        status = 0
+    return status, time.perf_counter() - started
+
+
+def percentile(values: list, fraction: float):
+    """ Возвращает перцентиль fraction (0..1) отсортированного списка """
+
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Нагрузочный стенд webhook-режима бота")
+    parser.add_argument("--url", default="http://127.0.0.1:8443/webhook")
+    parser.add_argument("--secret", required=True)
+    parser.add_argument("--count", type=int, default=1000, help="количество обновлений")
+    parser.add_argument("--concurrency", type=int, default=16, help="параллельных отправителей")
+    parser.add_argument("--users", type=int, default=50, help="количество разных пользователей")
+    parser.add_argument("--text", default="/start", help="текст сообщений")
+    args = parser.parse_args()
+
+    updates = [syntheticUpdate(i + 1, 100000 + i % args.users, args.text) for i in range(args.count)]
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        results = list(executor.map(lambda update: postUpdate(args.url, args.secret, update), updates))
+    elapsed = time.perf_counter() - started
+
+    statuses = Counter(status for status, _ in results)
+    latencies = sorted(latency for _, latency in results)
+
+    print(f"Отправлено: {args.count} за {elapsed:.2f} с ({args.count / elapsed:.0f} обновлений/с)")
+    print("Статусы: " + ", ".join(f"{status}: {count}" for status, count in sorted(statuses.items())))
+    print(f"Задержка p50/p95/p99, мс: {percentile(latencies, 0.50) * 1000:.1f} / "
+          f"{percentile(latencies, 0.95) * 1000:.1f} / {percentile(latencies, 0.99) * 1000:.1f}")
+
+
+if __name__ == '__main__':
+    main()